@@ -15,12 +15,18 @@ Zoran Čučković
 """
 
 import argparse
+import logging
+import multiprocessing
 import numpy as np
 import os
+import time
 
 import gdal
 from tqdm import tqdm
 
+
+logger = logging.getLogger('TPI')
+
 # -------------- INPUT -----------------
 win_size = 121
 elevation_model = r"E:\disbr007\umn\ms_proj\data\2019apr19_umiat_detach_zone\dems\2m\masked\2017_DEM_masked.utm.tif"
@@ -30,15 +36,113 @@ output_model = r"E:\disbr007\umn\ms_proj\data\2019apr19_umiat_detach_zone\dems\2
 count_model = r"E:\disbr007\umn\ms_proj\data\2019apr19_umiat_detach_zone\dems\2m\masked\count{}.tif".format(win_size)
 
 
-def calc_TPI(win_size, elevation_model, output_model=None, count_model=None):
+def view(offset_y, offset_x, shape, step=1):
     """
-    TODO:
-    Write docstring.
+    Function returning two matching numpy views for moving window routines.
+    - 'offset_y' and 'offset_x' refer to the shift in relation to the analysed (central) cell
+    - 'shape' are 2 dimensions of the data matrix (not of the window!)
+    - 'view_in' is the shifted view and 'view_out' is the position of central cells
+    (see on LandscapeArchaeology.org/2018/numpy-loops/)
     """
-    if output_model is None:
-        output_model = os.path.join(os.path.split(elevation_model)[0],
-                                    '{}_TPI{}.tif'.format(os.path.basename(elevation_model), win_size))
+    size_y, size_x = shape
+    x, y = abs(offset_x), abs(offset_y)
+
+    x_in = slice(x, size_x, step)
+    x_out = slice(0, size_x - x, step)
+
+    y_in = slice(y, size_y, step)
+    y_out = slice(0, size_y - y, step)
+    # the swapping trick
+    if offset_x < 0:
+        x_in, x_out = x_out, x_in
+    if offset_y < 0:
+        y_in, y_out = y_out, y_in
+
+    # return window view (in) and main view (out)
+    return np.s_[y_in, x_in], np.s_[y_out, x_out]
+
+
+def integral_image(mx):
+    """
+    Summed-area table of mx, padded with a leading row and column of zeros so
+    that sat[i, j] is the sum of mx[:i, :j].
+    mx: 2D array
+
+    Returns
+    float64 array of shape (rows + 1, cols + 1)
+    """
+    sat = np.zeros((mx.shape[0] + 1, mx.shape[1] + 1))
+    np.cumsum(mx, axis=0, out=sat[1:, 1:])
+    np.cumsum(sat[1:, 1:], axis=1, out=sat[1:, 1:])
+
+    return sat
+
+
+def sat_segments(n, r, w):
+    """
+    Split the n cells along one axis into runs in which the first and the
+    one-past-last summed-area table index of each cell's window are either
+    clipped to the edge (constant) or advance by one per cell, so each run
+    can be looked up with basic slices.
+    n: number of cells along the axis
+    r: window radius
+    w: window size
+
+    Returns
+    list : (output slice, first index slice, one-past-last index slice),
+           constant indices as length 1 slices that broadcast
+    """
+    breaks = sorted(set([0, n] + [min(max(b, 0), n) for b in (r, n - w + r + 1)]))
+    segments = []
+    for a, b in zip(breaks[:-1], breaks[1:]):
+        if a == b:
+            continue
+        lo = a - r
+        hi = a - r + w
+        lo_s = slice(0, 1) if lo < 0 else slice(lo, lo + b - a)
+        hi_s = slice(n, n + 1) if hi > n else slice(hi, hi + b - a)
+        segments.append((slice(a, b), lo_s, hi_s))
+
+    return segments
 
+
+def window_sum(sat, win_shape):
+    """
+    Sum of the values under a win_shape window centred on every cell, read from
+    a summed-area table built by integral_image. Cells of the window that fall
+    outside the array are ignored, matching the shifted views of the shift engine.
+    The table is only read through basic slices (views), so apart from the
+    output the only temporaries are one run of cells at a time.
+    sat: summed-area table, shape (rows + 1, cols + 1)
+    win_shape: (win_y, win_x) size of the window in pixels
+
+    Returns
+    float64 array of shape (rows, cols)
+    """
+    rows, cols = sat.shape[0] - 1, sat.shape[1] - 1
+    win_y, win_x = win_shape
+
+    out = np.empty((rows, cols))
+    for oy, y_lo, y_hi in sat_segments(rows, win_y // 2, win_y):
+        for ox, x_lo, x_hi in sat_segments(cols, win_x // 2, win_x):
+            block = out[oy, ox]
+            block[...] = sat[y_hi, x_hi]
+            block -= sat[y_hi, x_lo]
+            block -= sat[y_lo, x_hi]
+            block += sat[y_lo, x_lo]
+
+    return out
+
+
+def tpi_shift(mx_z, win_size, nodata=0.0):
+    """
+    TPI by moving a copy of the entire DEM across the window, one offset at a time.
+    mx_z: DEM array with NoData already set to nodata
+    win_size: int, size of one side of the window in pixels
+
+    Returns
+    TPI array, nodata where the DEM is nodata
+    """
     # ----------  create the moving window  ------------
     # r= 5 #radius in pixels
     # win = np.ones((2* r +1, 2* r +1))
@@ -51,42 +155,6 @@ def calc_TPI(win_size, elevation_model, output_model=None, count_model=None):
     r_y, r_x = win.shape[0] // 2, win.shape[1] // 2
     win[r_y, r_x] = 0  # let's remove the central cell
 
-    def view(offset_y, offset_x, shape, step=1):
-        """
-        Function returning two matching numpy views for moving window routines.
-        - 'offset_y' and 'offset_x' refer to the shift in relation to the analysed (central) cell
-        - 'shape' are 2 dimensions of the data matrix (not of the window!)
-        - 'view_in' is the shifted view and 'view_out' is the position of central cells
-        (see on LandscapeArchaeology.org/2018/numpy-loops/)
-        """
-        size_y, size_x = shape
-        x, y = abs(offset_x), abs(offset_y)
-
-        x_in = slice(x, size_x, step)
-        x_out = slice(0, size_x - x, step)
-
-        y_in = slice(y, size_y, step)
-        y_out = slice(0, size_y - y, step)
-        # the swapping trick
-        if offset_x < 0:
-            x_in, x_out = x_out, x_in
-        if offset_y < 0:
-            y_in, y_out = y_out, y_in
-
-        # return window view (in) and main view (out)
-        return np.s_[y_in, x_in], np.s_[y_out, x_out]
-
-    # ----  main routine  -------
-
-    dem = gdal.Open(elevation_model)
-    dem_band = dem.GetRasterBand(1)
-    src_nodata = dem_band.GetNoDataValue()
-    mx_z = dem.ReadAsArray()
-    # Convert DEM NoData to 0.0
-    mx_z = np.where(mx_z == src_nodata, 0.0, mx_z)
-    # CURRENTLY ONLY WORKS IF NO DATA == 0, add line to change array's NoData to 0...? Real 0's vs NoData zeros...
-    nodata = 0.0
-
     # matrices for temporary data
     mx_temp = np.zeros(mx_z.shape)
     mx_count = np.zeros(mx_z.shape)
@@ -105,21 +173,327 @@ def calc_TPI(win_size, elevation_model, output_model=None, count_model=None):
         mx_count[view_out] += weight
         # Subtract number of times nodata value was included in the count
         # Where there is a zero in the moving window, substract 1 from the count, else do nothing (+0)
-        mx_count[view_out] = np.where(mx_z[view_in] == 0, mx_count[view_out] - 1, mx_count[view_out] + 0)
+        mx_count[view_out] = np.where(mx_z[view_in] == nodata, mx_count[view_out] - 1, mx_count[view_out] + 0)
 
     # Calculate TPI: (spot height – average neighbourhood height)
     # Mask any NoData in the DEM from the 'temp' summed matrix
     # mx_temp = np.where(mx_z == nodata, 0.0, mx_z)
     # np.seterr(divide='ignore', invalid='ignore')
     out = mx_z - mx_temp / mx_count
-    out = np.where(mx_z == 0.0, 0.0, out)
+    out = np.where(mx_z == nodata, nodata, out)
 
-    # Writing output TPI
+    return out
+
+
+def sat_tables(mx_z, nodata=0.0, squares=False):
+    """
+    Summed-area tables for a DEM, built once and shared by every window size.
+    mx_z: DEM array with NoData already set to nodata
+    squares: True to also build the table of squared elevations, needed for
+             the neighbourhood standard deviation
+
+    Returns
+    dict : valid mask, centred DEM and its tables
+    """
+    valid = mx_z != nodata
+    # Remove the mean elevation before summing to keep the tables small,
+    # TPI is unchanged by a constant offset
+    offset = mx_z[valid].mean() if valid.any() else 0.0
+    mx_c = np.where(valid, mx_z - offset, 0.0)
+
+    tables = {'valid': valid,
+              'mx_c': mx_c,
+              'sum': integral_image(mx_c),
+              'count': integral_image(valid)}
+    if squares:
+        tables['sum_sq'] = integral_image(mx_c * mx_c)
+
+    return tables
+
+
+def tpi_from_tables(tables, win_size, nodata=0.0, standardize=False):
+    """
+    TPI for one window size from the tables built by sat_tables. The central
+    cell and nodata cells are left out of the neighbourhood.
+    standardize: True to also return the TPI divided by the standard deviation
+                 of the neighbourhood (De Reu et al. 2013); requires tables
+                 built with squares=True
+
+    Returns
+    TPI array, or (TPI array, standardized TPI array), nodata where the DEM is nodata
+    """
+    valid = tables['valid']
+    mx_c = tables['mx_c']
+    win_shape = (win_size, win_size)
+
+    # Neighbourhood sums and counts, minus the central cell
+    mx_temp = window_sum(tables['sum'], win_shape) - mx_c
+    mx_count = window_sum(tables['count'], win_shape) - valid
+    mx_mean = mx_temp / mx_count
+
+    out = mx_c - mx_mean
+    out = np.where(valid, out, nodata)
+    if not standardize:
+        return out
+
+    mx_var = (window_sum(tables['sum_sq'], win_shape) - mx_c * mx_c) / mx_count - mx_mean * mx_mean
+    mx_std = np.sqrt(np.maximum(mx_var, 0.0))
+    dev = np.where(valid & (mx_std > 0), out / mx_std, nodata)
+
+    return out, dev
+
+
+def tpi_sat(mx_z, win_size, nodata=0.0):
+    """
+    TPI from summed-area tables of the DEM and of its valid-pixel mask. The
+    neighbourhood sum and count are four lookups per cell whatever the window
+    size. Gives the same result as tpi_shift: nodata cells are left out of the
+    count and the central cell is removed from the window.
+    mx_z: DEM array with NoData already set to nodata
+    win_size: int, size of one side of the window in pixels
+
+    Returns
+    TPI array, nodata where the DEM is nodata
+    """
+    return tpi_from_tables(sat_tables(mx_z, nodata=nodata), win_size, nodata=nodata)
+
+
+ENGINES = {'sat': tpi_sat,
+           'shift': tpi_shift}
+
+
+def tile_windows(x_sz, y_sz, tile_x, tile_y, halo):
+    """
+    Split a raster into tiles, each padded with a halo of neighbouring pixels.
+    x_sz, y_sz: raster size in pixels
+    tile_x, tile_y: tile size in pixels, before the halo is added
+    halo: int, pixels to add on each side of the tile (clipped to the raster)
+
+    Yields
+    Tuple: read window (xoff, yoff, xsize, ysize) including the halo,
+           core window (xoff, yoff, xsize, ysize) to be written
+    """
+    for yoff in range(0, y_sz, tile_y):
+        ysize = min(tile_y, y_sz - yoff)
+        for xoff in range(0, x_sz, tile_x):
+            xsize = min(tile_x, x_sz - xoff)
+            read_x0 = max(0, xoff - halo)
+            read_y0 = max(0, yoff - halo)
+            read_x1 = min(x_sz, xoff + xsize + halo)
+            read_y1 = min(y_sz, yoff + ysize + halo)
+
+            yield ((read_x0, read_y0, read_x1 - read_x0, read_y1 - read_y0),
+                   (xoff, yoff, xsize, ysize))
+
+
+def core_view(read_window, core_window):
+    """
+    Slice of an array read over read_window that covers core_window.
+    """
+    r_xoff, r_yoff, _, _ = read_window
+    c_xoff, c_yoff, c_xsize, c_ysize = core_window
+
+    return np.s_[c_yoff - r_yoff:c_yoff - r_yoff + c_ysize,
+                 c_xoff - r_xoff:c_xoff - r_xoff + c_xsize]
+
+
+def tile_shape(dem_band, tile_size):
+    """
+    Tile size to use for a band: tile_size rounded down to a whole number of the
+    band's natural blocks, or tile_size itself if a block is larger than that.
+    """
+    block_x, block_y = dem_band.GetBlockSize()
+    tile_x = tile_size // block_x * block_x if block_x <= tile_size else tile_size
+    tile_y = tile_size // block_y * block_y if block_y <= tile_size else tile_size
+
+    return min(tile_x, dem_band.XSize), min(tile_y, dem_band.YSize)
+
+
+def read_tile(dem_band, window, src_nodata, nodata=0.0):
+    """
+    Read a window of a DEM band, converting its NoData to nodata.
+    window: (xoff, yoff, xsize, ysize)
+    """
+    xoff, yoff, xsize, ysize = window
+    mx_z = dem_band.ReadAsArray(xoff, yoff, xsize, ysize)
+
+    return np.where(mx_z == src_nodata, nodata, mx_z)
+
+
+def create_output(dem, output_model, nodata=0.0, tiled=False, n_bands=1):
+    """
+    Create an empty Float32 GTiff matching the size, projection and
+    geotransform of dem.
+    """
+    options = ['TILED=YES', 'BIGTIFF=IF_SAFER'] if tiled else []
     driver = gdal.GetDriverByName('GTiff')
-    ds = driver.Create(output_model, mx_z.shape[1], mx_z.shape[0], 1, gdal.GDT_Float32)
+    ds = driver.Create(output_model, dem.RasterXSize, dem.RasterYSize, n_bands, gdal.GDT_Float32, options=options)
     ds.SetProjection(dem.GetProjection())
     ds.SetGeoTransform(dem.GetGeoTransform())
-    ds.GetRasterBand(1).SetNoDataValue(0.0)
+    for b in range(1, n_bands + 1):
+        ds.GetRasterBand(b).SetNoDataValue(nodata)
+
+    return ds
+
+
+# State of each process in the parallel pool, set once by init_worker
+worker_state = {}
+
+
+def init_worker(elevation_model, buffer_path, shape, win_size, method, nodata):
+    """
+    Open the DEM and the shared output buffer once per worker process.
+    """
+    dem = gdal.Open(elevation_model)
+    dem_band = dem.GetRasterBand(1)
+    worker_state.update(dem=dem,
+                        dem_band=dem_band,
+                        src_nodata=dem_band.GetNoDataValue(),
+                        out=np.memmap(buffer_path, dtype=np.float32, mode='r+', shape=shape),
+                        win_size=win_size,
+                        engine=ENGINES[method],
+                        nodata=nodata)
+
+
+def tpi_tile(windows):
+    """
+    Compute TPI for one halo'd tile and write its core into the shared output
+    buffer. Only the pixel count goes back to the parent process.
+    windows: (read window, core window) as yielded by tile_windows
+    """
+    read_window, core_window = windows
+    state = worker_state
+    mx_z = read_tile(state['dem_band'], read_window, state['src_nodata'], nodata=state['nodata'])
+    out = state['engine'](mx_z, state['win_size'], nodata=state['nodata'])
+    xoff, yoff, xsize, ysize = core_window
+    state['out'][yoff:yoff + ysize, xoff:xoff + xsize] = out[core_view(read_window, core_window)]
+
+    return xsize * ysize
+
+
+def calc_TPI_parallel(win_size, elevation_model, output_model, method='sat', tile_size=1024, n_jobs=None,
+                      nodata=0.0):
+    """
+    Compute TPI tiles across a pool of processes. Each worker reads its own
+    halo'd tiles and writes the result into a memory-mapped Float32 buffer next
+    to output_model, which is copied into the output GTiff once all tiles are done.
+    n_jobs: number of processes, default is the number of cores
+
+    Returns
+    float : throughput in pixels per second
+    """
+    if n_jobs is None:
+        n_jobs = multiprocessing.cpu_count()
+
+    dem = gdal.Open(elevation_model)
+    dem_band = dem.GetRasterBand(1)
+    shape = (dem.RasterYSize, dem.RasterXSize)
+    tile_x, tile_y = tile_shape(dem_band, tile_size)
+    windows = list(tile_windows(dem.RasterXSize, dem.RasterYSize, tile_x, tile_y, win_size // 2))
+
+    buffer_path = '{}.tpi_buffer'.format(output_model)
+    buffer = np.memmap(buffer_path, dtype=np.float32, mode='w+', shape=shape)
+    del buffer
+
+    start = time.time()
+    try:
+        pool = multiprocessing.Pool(n_jobs, initializer=init_worker,
+                                    initargs=(elevation_model, buffer_path, shape, win_size, method, nodata))
+        try:
+            n_pixels = 0
+            for tile_pixels in tqdm(pool.imap_unordered(tpi_tile, windows), total=len(windows)):
+                n_pixels += tile_pixels
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.close()
+            pool.join()
+        elapsed = time.time() - start
+        pixels_per_sec = n_pixels / elapsed if elapsed > 0 else float('inf')
+        logger.info('TPI computed for {} pixels in {:.1f}s using {} processes: {:.0f} pixels/s'.format(
+            n_pixels, elapsed, n_jobs, pixels_per_sec))
+
+        # Copy buffer to GTiff tile by tile
+        buffer = np.memmap(buffer_path, dtype=np.float32, mode='r', shape=shape)
+        ds = create_output(dem, output_model, nodata=nodata, tiled=True)
+        out_band = ds.GetRasterBand(1)
+        for _, (xoff, yoff, xsize, ysize) in windows:
+            out_band.WriteArray(np.asarray(buffer[yoff:yoff + ysize, xoff:xoff + xsize]), xoff, yoff)
+        ds = None
+        del buffer
+    finally:
+        # Remove the DEM sized buffer on failure or interrupt too
+        if os.path.exists(buffer_path):
+            os.remove(buffer_path)
+
+    return pixels_per_sec
+
+
+def calc_TPI(win_size, elevation_model, output_model=None, count_model=None, method='sat', tile_size=None,
+             n_jobs=1):
+    """
+    Calculate the Topographic Position Index of a DEM: the elevation of each cell
+    minus the mean elevation of the cells in the surrounding window (excluding
+    the cell itself and any NoData cells).
+    win_size: int, size of one side of the window in pixels
+    elevation_model: path to DEM
+    output_model: path to write TPI to, default elevation_model path + "TPI#"
+    method: 'sat' to use summed-area tables (constant cost per cell), or 'shift'
+            to accumulate one shifted copy of the DEM per window cell.
+            'sat' holds two float64 tables the size of the DEM (sums and
+            counts) on top of the DEM, so untiled it needs roughly twice the
+            memory of 'shift'; use tile_size to bound it.
+    tile_size: int, optional. Stream the DEM in tiles of about this many pixels
+               a side (rounded to the DEM's block size), each read with a halo of
+               win_size // 2 pixels and written as soon as it is computed.
+               Peak memory then depends on tile_size rather than the DEM size.
+               Default is to read the whole DEM at once.
+    n_jobs: int, number of processes to spread tiles across. Values above 1
+            imply tiling (tile_size defaults to 1024). None uses all cores.
+    """
+    if method not in ENGINES:
+        raise ValueError('Unsupported TPI method: {}. Must be one of: {}'.format(method, sorted(ENGINES)))
+    engine = ENGINES[method]
+
+    if output_model is None:
+        output_model = os.path.join(os.path.split(elevation_model)[0],
+                                    '{}_TPI{}.tif'.format(os.path.basename(elevation_model), win_size))
+
+    if n_jobs is None or n_jobs > 1:
+        calc_TPI_parallel(win_size, elevation_model, output_model, method=method,
+                          tile_size=tile_size if tile_size else 1024, n_jobs=n_jobs)
+        return
+
+    # ----  main routine  -------
+
+    dem = gdal.Open(elevation_model)
+    dem_band = dem.GetRasterBand(1)
+    src_nodata = dem_band.GetNoDataValue()
+    # CURRENTLY ONLY WORKS IF NO DATA == 0, add line to change array's NoData to 0...? Real 0's vs NoData zeros...
+    nodata = 0.0
+
+    if tile_size:
+        # Stream tiles: read with halo, compute, write the core of the tile
+        tile_x, tile_y = tile_shape(dem_band, tile_size)
+        ds = create_output(dem, output_model, nodata=nodata, tiled=True)
+        out_band = ds.GetRasterBand(1)
+        windows = list(tile_windows(dem.RasterXSize, dem.RasterYSize, tile_x, tile_y, win_size // 2))
+        for read_window, core_window in tqdm(windows):
+            mx_z = read_tile(dem_band, read_window, src_nodata, nodata=nodata)
+            out = engine(mx_z, win_size, nodata=nodata)
+            out_band.WriteArray(out[core_view(read_window, core_window)], core_window[0], core_window[1])
+        ds = None
+
+        return
+
+    # Convert DEM NoData to 0.0
+    mx_z = read_tile(dem_band, (0, 0, dem.RasterXSize, dem.RasterYSize), src_nodata, nodata=nodata)
+
+    out = engine(mx_z, win_size, nodata=nodata)
+
+    # Writing output TPI
+    ds = create_output(dem, output_model, nodata=nodata)
     ds.GetRasterBand(1).WriteArray(out)
     ds = None
 
@@ -132,16 +506,95 @@ def calc_TPI(win_size, elevation_model, output_model=None, count_model=None):
     # ds.GetRasterBand(1).SetNoDataValue(src_nodata)
     # ds = None
 
+def calc_TPI_multiscale(win_sizes, elevation_model, output_model=None, standardize=False, tile_size=None):
+    """
+    Calculate TPI at several window sizes from a single read of the DEM. The
+    summed-area tables are built once (per tile) and queried for every window
+    size, and the results are written as one band per window size.
+    win_sizes: list of int, sizes of one side of the windows in pixels
+    elevation_model: path to DEM
+    output_model: path to write the multi-band TPI to,
+                  default elevation_model path + "TPI#_#..."
+    standardize: True to add a band per window size of TPI divided by the
+                 standard deviation of the neighbourhood (De Reu et al. 2013),
+                 after the TPI bands
+    tile_size: int, optional. Stream the DEM in tiles as in calc_TPI, using a
+               halo of the largest window size // 2.
+    """
+    win_sizes = sorted(set(win_sizes))
+    if output_model is None:
+        output_model = os.path.join(os.path.split(elevation_model)[0],
+                                    '{}_TPI{}.tif'.format(os.path.basename(elevation_model),
+                                                          '_'.join(str(w) for w in win_sizes)))
+
+    dem = gdal.Open(elevation_model)
+    dem_band = dem.GetRasterBand(1)
+    src_nodata = dem_band.GetNoDataValue()
+    nodata = 0.0
+
+    x_sz, y_sz = dem.RasterXSize, dem.RasterYSize
+    if tile_size:
+        tile_x, tile_y = tile_shape(dem_band, tile_size)
+    else:
+        tile_x, tile_y = x_sz, y_sz
+    windows = list(tile_windows(x_sz, y_sz, tile_x, tile_y, max(win_sizes) // 2))
+
+    n_scales = len(win_sizes)
+    ds = create_output(dem, output_model, nodata=nodata, tiled=bool(tile_size),
+                       n_bands=n_scales * 2 if standardize else n_scales)
+    for i, w in enumerate(win_sizes):
+        ds.GetRasterBand(i + 1).SetDescription('TPI{}'.format(w))
+        if standardize:
+            ds.GetRasterBand(n_scales + i + 1).SetDescription('DEV{}'.format(w))
+
+    for read_window, core_window in tqdm(windows):
+        mx_z = read_tile(dem_band, read_window, src_nodata, nodata=nodata)
+        tables = sat_tables(mx_z, nodata=nodata, squares=standardize)
+        core = core_view(read_window, core_window)
+        for i, w in enumerate(win_sizes):
+            out = tpi_from_tables(tables, w, nodata=nodata, standardize=standardize)
+            if standardize:
+                out, dev = out
+                ds.GetRasterBand(n_scales + i + 1).WriteArray(dev[core], core_window[0], core_window[1])
+            ds.GetRasterBand(i + 1).WriteArray(out[core], core_window[0], core_window[1])
+    ds = None
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('win_size', type=int,
-                        help='Size of one side of moving kernel window in pixels.')
+    parser.add_argument('win_size', type=int, nargs='+',
+                        help='''Size of one side of moving kernel window in pixels. Give several sizes
+                        to write one band per size from a single pass over the DEM.''')
     parser.add_argument('elevation_model', type=str,
                         help='Path to DEM.')
     parser.add_argument('-o', '--output_model', type=str,
                         help='Path to write TPI to. Default to elevation_model path + "TPI#"')
+    parser.add_argument('-m', '--method', type=str, default='sat', choices=['sat', 'shift'],
+                        help='''TPI engine: "sat" uses summed-area tables, cost independent of window size.
+                        "shift" moves a copy of the DEM across every cell of the window. Default "sat".''')
+    parser.add_argument('-t', '--tile_size', type=int,
+                        help='''Process the DEM in tiles of about this many pixels a side to bound memory use.
+                        Default is to load the whole DEM.''')
+    parser.add_argument('-j', '--n_jobs', type=int, default=1,
+                        help='''Number of processes to compute tiles with. 0 uses all cores.
+                        More than 1 implies tiling. Default 1.''')
+    parser.add_argument('-s', '--standardize', action='store_true',
+                        help='''Also write TPI divided by the standard deviation of each window
+                        (De Reu et al. 2013) as extra bands.''')
 
     args = parser.parse_args()
 
-    calc_TPI(args.win_size, args.elevation_model, args.output_model)
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+
+    if len(args.win_size) > 1 or args.standardize:
+        # Multiscale TPI always uses summed-area tables in a single process
+        if args.method != 'sat':
+            parser.error('--method shift is not supported with several window sizes or --standardize.')
+        if args.n_jobs != 1:
+            parser.error('--n_jobs is not supported with several window sizes or --standardize.')
+        calc_TPI_multiscale(args.win_size, args.elevation_model, args.output_model,
+                            standardize=args.standardize, tile_size=args.tile_size)
+    else:
+        calc_TPI(args.win_size[0], args.elevation_model, args.output_model, method=args.method,
+                 tile_size=args.tile_size, n_jobs=args.n_jobs if args.n_jobs else None)
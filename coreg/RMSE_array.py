@@ -10,11 +10,15 @@ from osgeo import ogr, gdal, osr
 import rasterio
 from rasterio.features import shapes
 from shapely.geometry import shape, Point
+from shapely.prepared import prep
+from shapely.vectorized import contains
 import geopandas as gpd
 import pandas as pd
 import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1 import make_axes_locatable
-import random, argparse, os, logging
+import argparse, os, logging, sys
+
+from footprint_cache import raster_footprint, get_footprint
 
 
 def calc_rmse(l1, l2):
@@ -67,12 +71,47 @@ def raster_bounds(path):
     return bb
 
 
-def random_points_within(num_points, poly1, poly2):
+def overlap_bounds(ds1, ds2):
     '''
-    Creates num_points with the boundaries of poly1 and poly2,
-    returns a list of shapely Points
+    Intersection of the extents of two gdal datasets, from their geotransforms
+    only: minx, miny, maxx, maxy
+    '''
+    bounds = []
+    for ds in (ds1, ds2):
+        gt = ds.GetGeoTransform()
+        minx = gt[0]
+        maxy = gt[3]
+        maxx = minx + gt[1] * ds.RasterXSize
+        miny = maxy + gt[5] * ds.RasterYSize
+        bounds.append((minx, miny, maxx, maxy))
+    (minx1, miny1, maxx1, maxy1), (minx2, miny2, maxx2, maxy2) = bounds
+
+    return max(minx1, minx2), max(miny1, miny2), min(maxx1, maxx2), min(maxy1, maxy2)
+
+
+def bounds_window(ds, bounds):
+    '''
+    Pixel window (xoff, yoff, xsize, ysize) of a gdal dataset covering bounds
+    (minx, miny, maxx, maxy), clipped to the dataset.
+    '''
+    gt = ds.GetGeoTransform()
+    minx, miny, maxx, maxy = bounds
+    x0 = max(0, int(np.floor((minx - gt[0]) / gt[1])))
+    y0 = max(0, int(np.floor((maxy - gt[3]) / gt[5])))
+    x1 = min(ds.RasterXSize, int(np.ceil((maxx - gt[0]) / gt[1])))
+    y1 = min(ds.RasterYSize, int(np.ceil((miny - gt[3]) / gt[5])))
+
+    return x0, y0, max(0, x1 - x0), max(0, y1 - y0)
+
+
+def random_coords_within(num_points, poly1, poly2, max_tries=10000000):
+    '''
+    Creates num_points random coordinates within both poly1 and poly2.
+    Candidates are drawn in batches as arrays and tested against prepared
+    geometries in bulk, so the cost depends on the number of points rather
+    than on the number of vertices of the footprints.
+    Returns two arrays: x, y
     '''
-    print('Creating random points...')
     min_x1, min_y1, max_x1, max_y1 = poly1.bounds
     min_x2, min_y2, max_x2, max_y2 = poly2.bounds
     
@@ -81,67 +120,120 @@ def random_points_within(num_points, poly1, poly2):
     max_x = min(max_x1, max_x2)
     max_y = min(max_y1, max_y2)
     
-    points = []
+    prep1 = prep(poly1)
+    prep2 = prep(poly2)
+    
+    xs, ys = [], []
+    n_kept = 0
+    ctr = 0
+    while n_kept < num_points and ctr < max_tries:
+        # Draw enough candidates to fill the remaining points at the
+        # acceptance rate seen so far
+        accept_rate = n_kept / ctr if ctr else 1.0
+        n_draw = int(np.ceil((num_points - n_kept) / max(accept_rate, 0.001) * 1.1))
+        n_draw = min(max(n_draw, 1000), max_tries - ctr)
+        x = np.random.uniform(min_x, max_x, n_draw)
+        y = np.random.uniform(min_y, max_y, n_draw)
+        inside = contains(prep1, x, y) & contains(prep2, x, y)
+        xs.append(x[inside])
+        ys.append(y[inside])
+        n_kept += np.count_nonzero(inside)
+        ctr += n_draw
+    if n_kept < num_points:
+        logging.warning('Only {} points found within both footprints after {} tries.'.format(n_kept, ctr))
+    
+    return np.concatenate(xs)[:num_points], np.concatenate(ys)[:num_points]
 
-    while len(points) < num_points:
-        random_point = Point([random.uniform(min_x, max_x), random.uniform(min_y, max_y)])
-        if (random_point.within(poly1) and random_point.within(poly2)):
-            points.append(random_point)
+
+def random_points_within(num_points, poly1, poly2):
+    '''
+    Creates num_points with the boundaries of poly1 and poly2,
+    returns a list of shapely Points
+    '''
+    print('Creating random points...')
+    xs, ys = random_coords_within(num_points, poly1, poly2)
+    points = [Point(x, y) for x, y in zip(xs, ys)]
 
     return points
 
 
-def sample_points(dem1_path, dem2_path, num_pts=1000):
+def sample_points(dem1_path, dem2_path, num_pts=1000, overlap_only=True, footprint_cache=None):
     '''
     Samples num_pts from dem1 and dem2 and returns a dataframe of values, as well as 
     difference of dem1 - dem2
+    overlap_only: True to read only the window of each DEM that overlaps the
+                  other, and to build the data footprints from a downsampled
+                  read of that window. False reads both DEMs in full.
+    footprint_cache: True to look up the data footprints from sidecar files
+                     next to the DEMs, or a path to a GeoPackage of footprints,
+                     computing and storing them on first use (see footprint_cache.py)
     '''
-    # Read as array
     dem1_src = gdal.Open(dem1_path)
-#    dem1_nodata = dem1_src.GetRasterBand(1).GetNoDataValue()
-    dem1 = dem1_src.ReadAsArray()
+    dem1_nodata = dem1_src.GetRasterBand(1).GetNoDataValue()
     dem1_gt = dem1_src.GetGeoTransform()
             
     dem2_src = gdal.Open(dem2_path)
-#    dem2_nodata = dem2_src.GetRasterBand(1).GetNoDataValue()
-    dem2 = dem2_src.ReadAsArray()
+    dem2_nodata = dem2_src.GetRasterBand(1).GetNoDataValue()
     dem2_gt = dem2_src.GetGeoTransform()
     
-    ## Get extents of DEMs exluding NoData
-    dem1_bb = raster_bounds(dem1_path)
-    dem2_bb = raster_bounds(dem2_path)
+    if overlap_only:
+        # Windows of each DEM covering the geotransform overlap
+        bounds = overlap_bounds(dem1_src, dem2_src)
+        dem1_win = bounds_window(dem1_src, bounds)
+        dem2_win = bounds_window(dem2_src, bounds)
+        if min(dem1_win[2:] + dem2_win[2:]) == 0:
+            raise ValueError('DEMs do not overlap.')
+        ## Get extents of DEMs exluding NoData, within the overlap
+        if footprint_cache:
+            dem1_bb = get_footprint(dem1_path, cache=footprint_cache)
+            dem2_bb = get_footprint(dem2_path, cache=footprint_cache)
+        else:
+            dem1_bb = raster_footprint(dem1_path, dem1_win)
+            dem2_bb = raster_footprint(dem2_path, dem2_win)
+        if dem1_bb.is_empty or dem2_bb.is_empty:
+            raise ValueError('No valid data in overlap of DEMs.')
+        if not dem1_bb.intersects(dem2_bb):
+            raise ValueError('Valid data of DEMs do not overlap.')
+    else:
+        dem1_win = (0, 0, dem1_src.RasterXSize, dem1_src.RasterYSize)
+        dem2_win = (0, 0, dem2_src.RasterXSize, dem2_src.RasterYSize)
+        ## Get extents of DEMs exluding NoData
+        dem1_bb = raster_bounds(dem1_path)
+        dem2_bb = raster_bounds(dem2_path)
 #    bb_gdf = gpd.GeoDataFrame(geometry=[dem1_bb, dem2_bb])
 #    bb_gdf.to_file(r'V:\pgc\data\scratch\jeff\brash_island\dem\pc_align\dem_bb.shp', driver='ESRI Shapefile')
-            
+    
+    # Read as array
+    dem1 = dem1_src.GetRasterBand(1).ReadAsArray(*dem1_win)
+    dem2 = dem2_src.GetRasterBand(1).ReadAsArray(*dem2_win)
     
     ## Generate random points within data extents of DEMs
-    random_pts = random_points_within(num_pts, dem1_bb, dem2_bb)
-    
-    geoms = []
-    dem1_vals = []
-    dem2_vals = []
-    differences = []
-    
-    ## Sample z-values of DEMs at both points
-    for i, pt in enumerate(random_pts):
-        # Determine pixel locations using DEM Geotransform 
-        px1 = int((pt.x - dem1_gt[0]) / dem1_gt[1])
-        py1 = int((pt.y - dem1_gt[3]) / dem1_gt[5])
-        
-        px2 = int((pt.x - dem2_gt[0]) / dem2_gt[1])
-        py2 = int((pt.y - dem2_gt[3]) / dem2_gt[5])
-        
-        
-        dem1_val = dem1[py1][px1]
-        dem2_val = dem2[py2][px2]
-        
-        diff = dem1_val - dem2_val
-        
-        # Append to list for creating geodataframe
-        geoms.append(Point(pt.x, pt.y))
-        dem1_vals.append(dem1_val)
-        dem2_vals.append(dem2_val)
-        differences.append(diff)
+    print('Creating random points...')
+    xs, ys = random_coords_within(num_pts, dem1_bb, dem2_bb)
+    
+    ## Sample z-values of DEMs at all points
+    # Determine pixel locations using DEM Geotransform, relative to the window read
+    px1 = np.floor((xs - dem1_gt[0]) / dem1_gt[1]).astype(np.int64) - dem1_win[0]
+    py1 = np.floor((ys - dem1_gt[3]) / dem1_gt[5]).astype(np.int64) - dem1_win[1]
+    
+    px2 = np.floor((xs - dem2_gt[0]) / dem2_gt[1]).astype(np.int64) - dem2_win[0]
+    py2 = np.floor((ys - dem2_gt[3]) / dem2_gt[5]).astype(np.int64) - dem2_win[1]
+    inside = ((px1 >= 0) & (px1 < dem1.shape[1]) & (py1 >= 0) & (py1 < dem1.shape[0]) &
+              (px2 >= 0) & (px2 < dem2.shape[1]) & (py2 >= 0) & (py2 < dem2.shape[0]))
+    xs, ys = xs[inside], ys[inside]
+    
+    dem1_vals = dem1[py1[inside], px1[inside]]
+    dem2_vals = dem2[py2[inside], px2[inside]]
+    valid = ~np.isnan(dem1_vals) & ~np.isnan(dem2_vals)
+    if dem1_nodata is not None:
+        valid &= dem1_vals != dem1_nodata
+    if dem2_nodata is not None:
+        valid &= dem2_vals != dem2_nodata
+    xs, ys = xs[valid], ys[valid]
+    dem1_vals = dem1_vals[valid]
+    dem2_vals = dem2_vals[valid]
+    differences = dem1_vals - dem2_vals
+    geoms = [Point(x, y) for x, y in zip(xs, ys)]
     
     print('Final number of sample points (ignoring NoData pts): {}'.format(len(differences)))
     ## Create geodataframe of points with elevation 1, elevation 2, and difference
@@ -180,15 +272,30 @@ if __name__ == '__main__':
                         help='Option path to save plots: histogram of differences, scatter of values, map of sample points')
     parser.add_argument('-w', '--write_shp', type=str,
                         help='Optional path to write shapefile of sample points')
+    parser.add_argument('--footprint_cache', nargs='?', const=True, default=None,
+                        help='''Cache DEM data footprints for reuse. With no value they are stored next
+                        to each DEM, or give the path of a GeoPackage to store them in.''')
+    parser.add_argument('--full_read', action='store_true',
+                        help='Read both DEMs in full rather than only their overlap.')
+    parser.add_argument('--exact', action='store_true',
+                        help='''Compute RMSE, bias, NMAD and percentiles from every pixel of the
+                        overlap instead of sampling points. DEMs must be on aligned pixel grids.''')
     
     args = parser.parse_args()
     
+    if args.exact:
+        from rmse_sample_pts import dem_stats_exact
+        stats = dem_stats_exact(gdal.Open(args.dem1_path), gdal.Open(args.dem2_path))
+        for k, v in stats.items():
+            print('{}: {}'.format(k, v))
+        sys.exit()
     
     # Default 1000 sample points
     num_pts = args.num_pts if args.num_pts else 1000
 
     # Sample DEMs at random points
-    gdf = sample_points(args.dem1_path, args.dem2_path, num_pts=num_pts)
+    gdf = sample_points(args.dem1_path, args.dem2_path, num_pts=num_pts, overlap_only=not args.full_read,
+                        footprint_cache=args.footprint_cache)
 
     ## Calculate RMSE
     rmse_val = calc_rmse(list(gdf['DEM1_value']), list(gdf['DEM2_value']))    
@@ -10,10 +10,10 @@ import argparse
 import glob
 import logging
 import os
-import subprocess
-from subprocess import PIPE, STDOUT
 
 from lib.utils import constrict_pairs
+from executors import CODE_DIR, PYTHON, Job, QsubExecutor, add_executor_args, get_executor
+from job_manifest import JobManifest, add_manifest_args
 
 
 logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
@@ -45,28 +45,40 @@ def get_dems(src_dir):
     return dems
 
 
-def batch_RMSE_sample_pts(src_dir, overwrite, run_pairs_f, dryrun):
+def batch_RMSE_sample_pts(src_dir, overwrite, run_pairs_f, dryrun, executor=None, manifest=None):
     """
-    Run point2dem in batch on cluster using qsub
+    Run rmse_sample_pts.py in batch on cluster using qsub, or locally with a LocalExecutor.
     src_dir: dir holding subdirs of paired 
     dryrun: flag to just print commands with no job submission
+    executor: executors.QsubExecutor or executors.LocalExecutor, default qsub
+    manifest: job_manifest.JobManifest, to skip pairs by their recorded state
+              rather than by whether an rmse.txt exists
+
+    Returns
+    dict : pair -> exit code
     """
-    
+    if executor is None:
+        executor = QsubExecutor(dryrun=dryrun)
+
     def submit_job(src_dir, pair_dir):
         # Get DEMs in date order
         dem_files = get_dems(os.path.join(src_dir, pair_dir))  
         if len(dem_files) == 2:
             dem1, dem2 = dem_files[0], dem_files[1]
-        
-            # Build cmd
-            cmd = 'qsub -v p1="{}",p2="{}",p3="{}" ~/scratch/code/coreg/qsub_RMSE_sample_pts.sh'.format(dem1, dem2, method)
-    
-            if dryrun:
-                print(cmd)
-            else:
-                p = subprocess.Popen(cmd, shell=True, stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-                output = p.stdout.read()
-                print(output)
+            params = {'method': method}
+            outputs = [os.path.join(os.path.dirname(dem1), '{}_{}_rmse.txt'.format(pair_dir, method))]
+            if manifest and not overwrite and not manifest.needs_run(pair_dir, 'rmse', dem_files, params, outputs):
+                return
+
+            # Build job
+            job = Job(pair_dir,
+                      cmd=[PYTHON, os.path.join(CODE_DIR, 'rmse_sample_pts.py'), dem1, dem2, method],
+                      qsub_script='qsub_RMSE_sample_pts.sh',
+                      qsub_args=[dem1, dem2, method],
+                      log_path=os.path.join(src_dir, pair_dir, '{}_rmse.log'.format(method)))
+            if manifest and not dryrun:
+                manifest.track(job, 'rmse', dem_files, params, outputs)
+            executor.submit(job)
         else:
             logging.info(pair_dir)
             logging.info('Incorrect number of DEM files found: {}'.format(len(dem_files)))
@@ -88,13 +100,15 @@ def batch_RMSE_sample_pts(src_dir, overwrite, run_pairs_f, dryrun):
         rmse_match = [x for x in files if 'rmse.txt' in x]
 #        print('RMSE match files found: {}'.format(len(rmse_match)))
         
-        if len(rmse_match) == 0:
+        if len(rmse_match) == 0 or manifest:
             submit_job(src_dir, pair_dir)
         elif overwrite:
             submit_job(src_dir, pair_dir)
         else:
             pass
-            
+
+    return executor.wait()
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -108,10 +122,17 @@ if __name__ == '__main__':
                         help='Text file with one pair per line to run.')
     parser.add_argument('--dryrun', action='store_true',
                         help='Print qsub commands without submitting them.')
-    
+    add_executor_args(parser)
+    add_manifest_args(parser)
+
     args = parser.parse_args()
-    
+
+    executor = get_executor(local=args.local, workers=args.workers, retries=args.retries, dryrun=args.dryrun)
+    manifest = JobManifest(args.manifest) if args.manifest else None
+
     batch_RMSE_sample_pts(args.src_dir,
                           overwrite=args.overwrite,
                           run_pairs_f=args.run_pairs,
-                          dryrun=args.dryrun)
+                          dryrun=args.dryrun,
+                          executor=executor,
+                          manifest=manifest)
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""
+Apply a coregistration shift to a DEM raster directly, without converting it
+to a point cloud and regridding it with point2dem.
+
+A translation (dx, dy, dz) only needs the geotransform origin moved and dz
+added, with no resampling. When the output has to stay on the input's pixel
+grid (e.g. to difference it pixel for pixel against the reference), or the
+transform includes a rotation, the DEM is resampled block by block with
+bilinear or bicubic interpolation and streamed to the output.
+
+Transforms are 4x4 (or 3x4) matrices in the DEM's projected coordinates,
+mapping input points to output points. pc_align writes its transform in ECEF
+coordinates; projected_shift converts one to a translation in the DEM's
+coordinates.
+"""
+
+import argparse
+import logging
+import os
+
+import numpy as np
+from osgeo import gdal, osr
+
+
+logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+gdal.UseExceptions()
+
+# Rows and columns around a sample position read by each method
+KERNEL_RADIUS = {'bilinear': 1, 'bicubic': 2}
+
+
+def create_like(src_ds, out_path, gt=None, nodata=None, compress='LZW'):
+    """
+    Create a single band Float32 GTiff the size of src_ds.
+    """
+    out_ds = gdal.GetDriverByName('GTiff').Create(out_path, src_ds.RasterXSize, src_ds.RasterYSize, 1,
+                                                  gdal.GDT_Float32,
+                                                  options=['COMPRESS={}'.format(compress), 'TILED=YES',
+                                                           'BIGTIFF=IF_SAFER'])
+    out_ds.SetGeoTransform(gt if gt is not None else src_ds.GetGeoTransform())
+    out_ds.SetProjection(src_ds.GetProjection())
+    if nodata is not None:
+        out_ds.GetRasterBand(1).SetNoDataValue(nodata)
+
+    return out_ds
+
+
+def apply_translation(src_path, out_path, dx, dy, dz, block_rows=1024, compress='LZW'):
+    """
+    Write the DEM at src_path translated by (dx, dy, dz): the geotransform
+    origin moves by (dx, dy) and dz is added to every valid pixel, block by
+    block, with no resampling.
+    """
+    src_ds = gdal.Open(src_path)
+    band = src_ds.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    gt = list(src_ds.GetGeoTransform())
+    gt[0] += dx
+    gt[3] += dy
+    out_ds = create_like(src_ds, out_path, gt=gt, nodata=nodata, compress=compress)
+    out_band = out_ds.GetRasterBand(1)
+    for yoff in range(0, src_ds.RasterYSize, block_rows):
+        rows = min(block_rows, src_ds.RasterYSize - yoff)
+        arr = band.ReadAsArray(0, yoff, src_ds.RasterXSize, rows).astype(np.float32)
+        valid = ~np.isnan(arr)
+        if nodata is not None:
+            valid &= arr != nodata
+        arr[valid] += dz
+        out_band.WriteArray(arr, 0, yoff)
+    out_band.FlushCache()
+    out_ds = None
+
+    return out_path
+
+
+def cubic_weights(t, a=-0.5):
+    """
+    Keys cubic convolution weights of the four samples at offsets -1, 0, 1, 2
+    for fractional positions t.
+    """
+    def w_near(x):
+        return (a + 2) * x ** 3 - (a + 3) * x ** 2 + 1
+
+    def w_far(x):
+        return a * x ** 3 - 5 * a * x ** 2 + 8 * a * x - 4 * a
+
+    return [w_far(1 + t), w_near(t), w_near(1 - t), w_far(2 - t)]
+
+
+def interpolate(arr, rows, cols, method='bilinear'):
+    """
+    Values of arr at continuous pixel positions rows, cols (0 at the centre of
+    the first pixel). Positions whose kernel leaves arr or touches a NaN are
+    NaN.
+    """
+    r0 = np.floor(rows).astype(np.int64)
+    c0 = np.floor(cols).astype(np.int64)
+    fr = rows - r0
+    fc = cols - c0
+    if method == 'bilinear':
+        offsets = [0, 1]
+        wr = [1 - fr, fr]
+        wc = [1 - fc, fc]
+    elif method == 'bicubic':
+        offsets = [-1, 0, 1, 2]
+        wr = cubic_weights(fr)
+        wc = cubic_weights(fc)
+    else:
+        raise ValueError('Unsupported resampling method: {}'.format(method))
+
+    inside = ((r0 + offsets[0] >= 0) & (r0 + offsets[-1] < arr.shape[0]) &
+              (c0 + offsets[0] >= 0) & (c0 + offsets[-1] < arr.shape[1]))
+    out = np.zeros(rows.shape, dtype=np.float64)
+    for i, dr in enumerate(offsets):
+        r = np.clip(r0 + dr, 0, arr.shape[0] - 1)
+        for j, dc in enumerate(offsets):
+            c = np.clip(c0 + dc, 0, arr.shape[1] - 1)
+            out += wr[i] * wc[j] * arr[r, c]
+    out[~inside] = np.nan
+
+    return out
+
+
+def is_translation(matrix):
+    return np.allclose(matrix[:3, :3], np.eye(3))
+
+
+def apply_transform(src_path, out_path, matrix, method='bilinear', block_rows=512, compress='LZW'):
+    """
+    Resample the DEM at src_path through a rigid transform onto its own pixel
+    grid, block by block. For each output pixel the input position is found by
+    inverting the transform; the output elevation depends on the input
+    elevation when the transform rotates, so the position is refined with the
+    elevation sampled there.
+    matrix: 4x4 or 3x4 array mapping input (x, y, z) to output (x, y, z)
+    method: 'bilinear' or 'bicubic'
+    block_rows: number of output rows to compute at a time
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)[:3]
+    R, t = matrix[:, :3], matrix[:, 3]
+    R_inv = np.linalg.inv(R)
+    n_refine = 1 if is_translation(matrix) else 3
+    pad = KERNEL_RADIUS[method] + 1
+
+    src_ds = gdal.Open(src_path)
+    band = src_ds.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    out_nodata = nodata if nodata is not None else -9999.0
+    gt = src_ds.GetGeoTransform()
+    x_sz, y_sz = src_ds.RasterXSize, src_ds.RasterYSize
+    z_min, z_max = band.ComputeRasterMinMax(True)
+    # The approximate range may miss extremes
+    z_pad = 0.1 * (z_max - z_min) + 1.0
+    z_min, z_max = z_min - z_pad, z_max + z_pad
+
+    out_ds = create_like(src_ds, out_path, nodata=out_nodata, compress=compress)
+    out_band = out_ds.GetRasterBand(1)
+
+    xs = gt[0] + (np.arange(x_sz) + 0.5) * gt[1]
+    for yoff in range(0, y_sz, block_rows):
+        rows = min(block_rows, y_sz - yoff)
+        ys = gt[3] + (np.arange(yoff, yoff + rows) + 0.5) * gt[5]
+        X, Y = np.meshgrid(xs, ys)
+
+        def input_xy(Z):
+            p = np.einsum('ij,j...->i...', R_inv, np.stack([X - t[0], Y - t[1], Z - t[2]]))
+            return p[0], p[1]
+
+        # Input window covering every position over the range of elevations
+        corners = [input_xy(np.full(X.shape, z)) for z in (z_min, z_max)]
+        px = np.concatenate([c[0].ravel() for c in corners])
+        py = np.concatenate([c[1].ravel() for c in corners])
+        c_lo = int(np.clip(np.floor((px.min() - gt[0]) / gt[1]) - pad, 0, x_sz))
+        c_hi = int(np.clip(np.ceil((px.max() - gt[0]) / gt[1]) + pad, 0, x_sz))
+        r_lo = int(np.clip(np.floor((py.max() - gt[3]) / gt[5]) - pad, 0, y_sz))
+        r_hi = int(np.clip(np.ceil((py.min() - gt[3]) / gt[5]) + pad, 0, y_sz))
+        if c_hi <= c_lo or r_hi <= r_lo:
+            out_band.WriteArray(np.full((rows, x_sz), out_nodata, dtype=np.float32), 0, yoff)
+            continue
+        win = band.ReadAsArray(c_lo, r_lo, c_hi - c_lo, r_hi - r_lo).astype(np.float64)
+        if nodata is not None:
+            win[win == nodata] = np.nan
+
+        def sample(x, y):
+            return interpolate(win, (y - gt[3]) / gt[5] - 0.5 - r_lo, (x - gt[0]) / gt[1] - 0.5 - c_lo,
+                               method=method)
+
+        # Start from the mean elevation and refine with the sampled elevation
+        Z = np.full(X.shape, (z_min + z_max) / 2.0)
+        for _ in range(n_refine):
+            x_in, y_in = input_xy(Z)
+            z_in = sample(x_in, y_in)
+            z_out = R[2, 0] * x_in + R[2, 1] * y_in + R[2, 2] * z_in + t[2]
+            # Keep the previous estimate where the sample was NoData
+            Z = np.where(np.isnan(z_out), Z, z_out)
+
+        out = np.where(np.isnan(z_out), out_nodata, z_out).astype(np.float32)
+        out_band.WriteArray(out, 0, yoff)
+
+    out_band.FlushCache()
+    out_ds = None
+
+    return out_path
+
+
+def translation_matrix(dx, dy, dz):
+    matrix = np.eye(4)
+    matrix[:3, 3] = dx, dy, dz
+
+    return matrix
+
+
+def read_transform(transform_path):
+    """
+    Transform matrix from a text file, e.g. pc_align's <prefix>-transform.txt.
+    """
+    return np.loadtxt(transform_path)
+
+
+def projected_shift(matrix, dem_path):
+    """
+    Translation (dx, dy, dz) in a DEM's projected coordinates matching, at the
+    centre of the DEM, a transform in ECEF coordinates such as pc_align's
+    <prefix>-transform.txt. Only valid for transforms that are (close to) pure
+    translations over the extent of the DEM.
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    ds = gdal.Open(dem_path)
+    gt = ds.GetGeoTransform()
+    cx = gt[0] + gt[1] * ds.RasterXSize / 2.0
+    cy = gt[3] + gt[5] * ds.RasterYSize / 2.0
+    cz = np.mean(ds.GetRasterBand(1).ComputeRasterMinMax(True))
+
+    srs = osr.SpatialReference(wkt=ds.GetProjection())
+    ecef = osr.SpatialReference()
+    ecef.ImportFromEPSG(4978)
+    p = np.array(osr.CoordinateTransformation(srs, ecef).TransformPoint(cx, cy, cz))
+    q = matrix[:3, :3].dot(p) + matrix[:3, 3]
+    x, y, z = osr.CoordinateTransformation(ecef, srs).TransformPoint(*q)
+
+    return x - cx, y - cy, z - cz
+
+
+def apply_pc_align_transform(dem_path, transform_path, out_path, keep_grid=False, method='bilinear'):
+    """
+    Apply a pc_align (ECEF) transform to the DEM it was computed for, as a
+    translation, in place of regridding the transformed points with point2dem.
+    """
+    dx, dy, dz = projected_shift(read_transform(transform_path), dem_path)
+
+    return apply_shift(dem_path, out_path, dx=dx, dy=dy, dz=dz, keep_grid=keep_grid, method=method)
+
+
+def apply_shift(src_path, out_path, dx=0.0, dy=0.0, dz=0.0, matrix=None, keep_grid=False,
+                method='bilinear', block_rows=512, compress='LZW'):
+    """
+    Apply a translation (dx, dy, dz) or a transform matrix to a DEM.
+    Translations are applied to the geotransform with no resampling, unless
+    keep_grid is set and the shift is not a whole number of pixels. Transforms
+    with a rotation are always resampled.
+    matrix: 4x4 or 3x4 transform, used instead of dx, dy, dz
+    keep_grid: True to write the output on the input's pixel grid
+    method: 'bilinear' or 'bicubic' resampling
+
+    Returns
+    str : out_path
+    """
+    if matrix is None:
+        matrix = translation_matrix(dx, dy, dz)
+    matrix = np.asarray(matrix, dtype=np.float64)
+    if is_translation(matrix):
+        dx, dy, dz = matrix[:3, 3]
+        gt = gdal.Open(src_path).GetGeoTransform()
+        px, py = dx / gt[1], dy / gt[5]
+        whole_pixels = np.isclose(px, round(px)) and np.isclose(py, round(py))
+        if not keep_grid or whole_pixels:
+            logger.info('Translating geotransform by ({}, {}), adding {}'.format(dx, dy, dz))
+            return apply_translation(src_path, out_path, dx, dy, dz, compress=compress)
+    logger.info('Resampling ({}) through transform:\n{}'.format(method, matrix))
+
+    return apply_transform(src_path, out_path, matrix, method=method, block_rows=block_rows, compress=compress)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('src_dem', type=os.path.abspath,
+                        help='DEM to shift.')
+    parser.add_argument('out_dem', type=os.path.abspath,
+                        help='Path to write shifted DEM to.')
+    parser.add_argument('--dx', type=float, default=0.0,
+                        help='Shift in x, map units.')
+    parser.add_argument('--dy', type=float, default=0.0,
+                        help='Shift in y, map units.')
+    parser.add_argument('--dz', type=float, default=0.0,
+                        help='Shift in elevation.')
+    parser.add_argument('--transform', type=os.path.abspath,
+                        help='''Text file holding a 4x4 transform matrix in the DEM's projected
+                        coordinates, used instead of --dx --dy --dz.''')
+    parser.add_argument('--ecef', action='store_true',
+                        help='''The --transform is in ECEF coordinates, as written by pc_align. It is
+                        applied as the equivalent translation at the centre of the DEM.''')
+    parser.add_argument('--keep_grid', action='store_true',
+                        help='Resample onto the input pixel grid rather than moving the geotransform.')
+    parser.add_argument('--method', type=str, default='bilinear', choices=sorted(KERNEL_RADIUS),
+                        help='Resampling method. Default bilinear.')
+    parser.add_argument('--block_rows', type=int, default=512,
+                        help='Rows to resample at a time. Default 512.')
+
+    args = parser.parse_args()
+
+    matrix = read_transform(args.transform) if args.transform else None
+    if matrix is not None and args.ecef:
+        matrix = translation_matrix(*projected_shift(matrix, args.src_dem))
+
+    apply_shift(args.src_dem, args.out_dem, dx=args.dx, dy=args.dy, dz=args.dz, matrix=matrix,
+                keep_grid=args.keep_grid, method=args.method, block_rows=args.block_rows)
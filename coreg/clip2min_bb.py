@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Clip rasters to their minimum bounding box (common extent).
+
+Rasters are cropped to the projWin from rmse_sample_pts.minimum_bounding_box,
+either as VRTs, which are windows onto the source rasters and take no time or
+space to write, or as compressed GTiffs. VRTs can be materialized as GTiffs
+later, in parallel, when a full copy is needed.
+"""
+
+import argparse
+import glob
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from osgeo import gdal
+
+from rmse_sample_pts import minimum_bounding_box
+
+
+logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+gdal.UseExceptions()
+
+
+class RasterHeader:
+    """
+    The parts of a raster minimum_bounding_box needs, from the header only.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.data_src = gdal.Open(path)
+        self.geotransform = self.data_src.GetGeoTransform()
+        self.x_sz = self.data_src.RasterXSize
+        self.y_sz = self.data_src.RasterYSize
+
+
+def clip_name(raster_path, out_dir, out_suffix='', vrt=False):
+    """
+    Path of the clipped version of raster_path in out_dir.
+    """
+    name = os.path.basename(raster_path).split('.')[0]
+
+    return os.path.join(out_dir, '{}{}.{}'.format(name, out_suffix, 'vrt' if vrt else 'tif'))
+
+
+def gtiff_options(compress='LZW'):
+    return ['COMPRESS={}'.format(compress), 'TILED=YES', 'BIGTIFF=IF_SAFER']
+
+
+def clip_rasters(rasters, out_dir, out_suffix='', vrt=False, compress='LZW'):
+    """
+    Clip rasters to their common extent.
+    rasters: list of paths to rasters
+    out_dir: directory to write clipped rasters to
+    vrt: True to write VRTs, False to write compressed GTiffs
+    compress: compression of GTiffs
+
+    Returns
+    list : paths of clipped rasters
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    projWin = minimum_bounding_box([RasterHeader(r) for r in rasters])
+    if projWin[0] >= projWin[2] or projWin[1] <= projWin[3]:
+        raise ValueError('Rasters do not overlap: {}'.format(rasters))
+
+    out_paths = []
+    for r in rasters:
+        out_path = clip_name(r, out_dir, out_suffix=out_suffix, vrt=vrt)
+        if os.path.abspath(out_path) == os.path.abspath(r):
+            raise ValueError('Clipped raster would overwrite source, use out_dir or out_suffix: {}'.format(r))
+        logger.info('Clipping: {} -> {}'.format(os.path.basename(r), out_path))
+        if vrt:
+            gdal.Translate(out_path, r, format='VRT', projWin=projWin)
+        else:
+            gdal.Translate(out_path, r, format='GTiff', projWin=projWin,
+                           creationOptions=gtiff_options(compress))
+        out_paths.append(out_path)
+
+    return out_paths
+
+
+def clip2min_bb(src_dir, dst_dir, suffix='.tif', out_suffix='', vrt=False, compress='LZW'):
+    """
+    Clip all rasters in src_dir ending with suffix to their common extent.
+    """
+    rasters = sorted(glob.glob(os.path.join(src_dir, '*{}'.format(suffix))))
+    if len(rasters) < 2:
+        logger.warning('Fewer than two rasters found in {}, skipping.'.format(src_dir))
+        return []
+
+    return clip_rasters(rasters, dst_dir, out_suffix=out_suffix, vrt=vrt, compress=compress)
+
+
+def materialize(vrt_path, out_path=None, compress='LZW'):
+    """
+    Write a VRT out as a compressed GTiff, by default next to it with a .tif
+    extension.
+    """
+    if out_path is None:
+        out_path = '{}.tif'.format(os.path.splitext(vrt_path)[0])
+    gdal.Translate(out_path, vrt_path, format='GTiff', creationOptions=gtiff_options(compress))
+
+    return out_path
+
+
+def materialize_all(vrt_paths, compress='LZW', n_jobs=4):
+    """
+    Materialize many VRTs at once. GDAL releases the GIL while translating, so
+    threads write in parallel.
+    """
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        return list(pool.map(lambda v: materialize(v, compress=compress), vrt_paths))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('src_dir', type=os.path.abspath,
+                        help='Directory holding rasters to clip.')
+    parser.add_argument('-o', '--dst_dir', type=os.path.abspath,
+                        help='Directory to write clipped rasters to. Default is src_dir.')
+    parser.add_argument('-s', '--suffix', type=str, default='.tif',
+                        help='Suffix that all rasters to clip share.')
+    parser.add_argument('-c', '--compress', type=str, default='LZW',
+                        help='Compression of clipped GTiffs. Default LZW.')
+    parser.add_argument('--out_suffix', type=str, default='',
+                        help='Suffix to add to output raster names.')
+    parser.add_argument('--vrt', action='store_true',
+                        help='Write VRTs instead of GTiffs.')
+
+    args = parser.parse_args()
+
+    clip2min_bb(args.src_dir, args.dst_dir if args.dst_dir else args.src_dir,
+                suffix=args.suffix, out_suffix=args.out_suffix, vrt=args.vrt, compress=args.compress)
@@ -1,20 +1,40 @@
 """
-Wrapper for clip2min_bb.py to submit jobs to PBS.
+Wrapper for clip2min_bb.py to submit jobs to PBS, or to clip all pairs in
+this process (--in_process).
 
 bash: qsub_clip2minbb.sh
 """
 import argparse
+import glob
+import logging
 import os
-import subprocess
-from subprocess import PIPE, STDOUT
+from concurrent.futures import ThreadPoolExecutor
 
+from executors import CODE_DIR, PYTHON, Job, QsubExecutor, add_executor_args, get_executor
+from job_manifest import JobManifest, add_manifest_args
+from clip2min_bb import clip2min_bb, materialize_all
 
-def batch_clip2min_bb(src_dir, dst_dir, suffix, compress, dryrun):
+
+logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+def batch_clip2min_bb(src_dir, dst_dir, suffix, compress, dryrun, executor=None, manifest=None):
     """
-    batch/qsub function for submitting clip2min_bb.py to PBS.
+    batch/qsub function for submitting clip2min_bb.py to PBS, or running it
+    locally with a LocalExecutor.
 
     src
+    executor: executors.QsubExecutor or executors.LocalExecutor, default qsub
+    manifest: job_manifest.JobManifest, to skip pairs already clipped
+
+    Returns
+    dict : pair -> exit code
     """
+    if executor is None:
+        executor = QsubExecutor(dryrun=dryrun)
+
     # Paths
     if not os.path.exists(dst_dir):
         os.mkdir(dst_dir)
@@ -27,16 +47,63 @@ def batch_clip2min_bb(src_dir, dst_dir, suffix, compress, dryrun):
         if not os.path.exists(dst_path):
             os.mkdir(dst_path)
 
-        cmd = 'qsub -v p1="{}",p2="{}",p3="{}",p4="{}" ~/scratch/code/coreg/qsub_clip2min_bb.sh'.format(src_path,
-                                                                                                        dst_path,
-                                                                                                        suffix,
-                                                                                                        compress)
-        if dryrun:
-            print(cmd)
-        else:
-            p = subprocess.Popen(cmd, shell=True, stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-            output = p.stdout.read()
-            print(output)
+        inputs = sorted(glob.glob(os.path.join(src_path, '*{}'.format(suffix))))
+        params = {'suffix': suffix, 'compress': compress}
+        outputs = [os.path.join(dst_path, os.path.basename(x)) for x in inputs]
+        if manifest and not manifest.needs_run(pair, 'clip', inputs, params, outputs):
+            continue
+
+        job = Job(pair,
+                  cmd=[PYTHON, os.path.join(CODE_DIR, 'clip2min_bb.py'), src_path,
+                       '-o', dst_path, '-s', suffix, '-c', compress],
+                  qsub_script='qsub_clip2min_bb.sh',
+                  qsub_args=[src_path, dst_path, suffix, compress],
+                  log_path=os.path.join(dst_path, 'clip2min_bb.log'))
+        if manifest and not dryrun:
+            manifest.track(job, 'clip', inputs, params, outputs)
+        executor.submit(job)
+
+    return executor.wait()
+
+
+def batch_clip_in_process(src_dir, dst_dir, suffix, compress, out_suffix='', materialize=False, n_jobs=4):
+    """
+    Clip all pairs in this process, as VRTs onto the source rasters, with no
+    job submission. Pairs are clipped n_jobs at a time.
+    materialize: True to replace the VRTs with compressed GTiffs
+
+    Returns
+    dict : pair -> list of clipped raster paths, or None if the pair failed
+    """
+    if materialize and not out_suffix and os.path.abspath(src_dir) == os.path.abspath(dst_dir):
+        raise ValueError('Materialized rasters would overwrite sources, use a different dst_dir or out_suffix.')
+    if not os.path.exists(dst_dir):
+        os.mkdir(dst_dir)
+    pairs = [x for x in os.listdir(src_dir) if os.path.isdir(os.path.join(src_dir, x))]
+
+    def clip_pair(pair):
+        try:
+            return clip2min_bb(os.path.join(src_dir, pair), os.path.join(dst_dir, pair),
+                               suffix=suffix, out_suffix=out_suffix, vrt=True)
+        except (RuntimeError, ValueError) as e:
+            logger.warning('Could not clip {}: {}'.format(pair, e))
+            return None
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        results = dict(zip(pairs, pool.map(clip_pair, pairs)))
+    logger.info('Pairs clipped: {}, failed: {}'.format(len([x for x in results.values() if x is not None]),
+                                                       len([x for x in results.values() if x is None])))
+
+    if materialize:
+        vrts = [v for paths in results.values() if paths for v in paths]
+        tifs = materialize_all(vrts, compress=compress, n_jobs=n_jobs)
+        for v in vrts:
+            os.remove(v)
+        tifs = iter(tifs)
+        results = {pair: [next(tifs) for _ in paths] if paths else None for pair, paths in results.items()}
+
+    return results
+
 
 if __name__ == '__main__':
 
@@ -56,6 +123,14 @@ if __name__ == '__main__':
                         /LZMA/ZSTD/LERC/LERC_DEFLATE/LERC_ZSTD/WEBP/NONE''')
     parser.add_argument('--dryrun', action='store_true',
                         help='Print qsub commands without submitting.')
+    parser.add_argument('--in_process', action='store_true',
+                        help='Clip all pairs in this process, writing VRTs, rather than submitting jobs.')
+    parser.add_argument('--materialize', action='store_true',
+                        help='With --in_process, replace the VRTs with compressed GTiffs.')
+    parser.add_argument('--n_jobs', type=int, default=4,
+                        help='With --in_process, number of pairs to clip at once. Default 4.')
+    add_executor_args(parser)
+    add_manifest_args(parser)
     args = parser.parse_args()
 
     src_dir = args.src_dir
@@ -64,10 +139,18 @@ if __name__ == '__main__':
     suffix = args.suffix
     compress = args.compress
     dryrun = args.dryrun
+    executor = get_executor(local=args.local, workers=args.workers, retries=args.retries, dryrun=dryrun)
+    manifest = JobManifest(args.manifest) if args.manifest else None
 
-    batch_clip2min_bb(src_dir,
-                      dst_dir,
-                      # out_suffix=out_suffix,
-                      suffix=suffix,
-                      compress=compress,
-                      dryrun=dryrun)
+    if args.in_process:
+        batch_clip_in_process(src_dir, dst_dir, suffix=suffix, compress=compress, out_suffix=out_suffix,
+                              materialize=args.materialize, n_jobs=args.n_jobs)
+    else:
+        batch_clip2min_bb(src_dir,
+                          dst_dir,
+                          # out_suffix=out_suffix,
+                          suffix=suffix,
+                          compress=compress,
+                          dryrun=dryrun,
+                          executor=executor,
+                          manifest=manifest)
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+Run the coregistration steps for every pair as a pipeline:
+
+    clip -> pc_align -> point2dem -> rmse
+
+or, applying pc_align's transform in-process as a translation (see
+apply_shift.py) instead of running point2dem:
+
+    clip -> pc_align -> shift -> rmse
+
+or, with the in-process Nuth & Kaab solver (see nuth_kaab.py):
+
+    clip -> nuth -> rmse
+
+instead of running clip2min_bb_batch, pc_align_batch (pc_align, then
+point2dem) and RMSE_sample_pts_batch one after the other. Each stage has its
+own pool of workers, and a pair's next stage is queued as soon as its previous
+stage finishes, so stages of different pairs run at the same time and no
+stage waits for the slowest pair of the one before. Pair directories are
+listed once, each stage only looks inside its own pair's directory.
+
+Jobs run locally (see executors.LocalExecutor). Chaining qsub submissions
+with PBS job dependencies is not supported; use the batch tools for PBS.
+"""
+
+import argparse
+import functools
+import glob
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.utils import constrict_pairs
+from executors import CODE_DIR, PYTHON, Job, LocalExecutor
+from job_manifest import JobManifest, add_manifest_args
+from pc_align_batch import get_dems
+from clip2min_bb import clip2min_bb, clip_name
+from nuth_kaab import nuth_kaab_pair, trans_name
+from apply_shift import apply_pc_align_transform
+
+
+logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+STAGES = ('clip', 'pc_align', 'point2dem', 'shift', 'nuth', 'rmse')
+PC_ALIGN_STAGES = ('clip', 'pc_align', 'point2dem', 'rmse')
+SHIFT_STAGES = ('clip', 'pc_align', 'shift', 'rmse')
+NUTH_STAGES = ('clip', 'nuth', 'rmse')
+
+# A stage of one pair: the job to run (an executors.Job, or a function to call
+# in this process) and what the manifest records of it
+Step = namedtuple('Step', ['job', 'inputs', 'params', 'outputs'])
+
+
+def clip_step(pair, src_dir, dst_dir, suffix='.tif', compress='LZW', in_process=False):
+    src_path = os.path.join(src_dir, pair)
+    dst_path = os.path.join(dst_dir, pair)
+    if not os.path.exists(dst_path):
+        os.makedirs(dst_path)
+    inputs = sorted(glob.glob(os.path.join(src_path, '*{}'.format(suffix))))
+    if in_process:
+        # VRTs onto the source rasters, written in this process
+        return Step(functools.partial(clip2min_bb, src_path, dst_path, suffix=suffix, vrt=True),
+                    inputs, {'suffix': suffix, 'vrt': True},
+                    [clip_name(x, dst_path, vrt=True) for x in inputs])
+    job = Job(pair,
+              cmd=[PYTHON, os.path.join(CODE_DIR, 'clip2min_bb.py'), src_path,
+                   '-o', dst_path, '-s', suffix, '-c', compress],
+              qsub_script='qsub_clip2min_bb.sh',
+              qsub_args=[src_path, dst_path, suffix, compress],
+              log_path=os.path.join(dst_path, 'clip2min_bb.log'))
+
+    return Step(job, inputs, {'suffix': suffix, 'compress': compress},
+                [os.path.join(dst_path, os.path.basename(x)) for x in inputs])
+
+
+def pc_align_step(pair, pairs_dir):
+    dems_dir = os.path.join(pairs_dir, pair)
+    # Older DEM is translated to the newer
+    dem1, dem2 = get_dems(pairs_dir, pair)
+    prefix = os.path.join(dems_dir, os.path.basename(dem1).split('.')[0][:13])
+    job = Job(pair,
+              cmd=['pc_align', '--max-displacement', '10.0', '--save-transformed-source-points',
+                   dem2, dem1, '-o', prefix],
+              qsub_script='qsub_pc_align.sh',
+              qsub_args=[dem2, dem1, prefix],
+              log_path='{}_pc_align.log'.format(prefix))
+
+    return Step(job, [dem2, dem1], {'max_displacement': 10.0}, ['{}-trans_source.tif'.format(prefix)])
+
+
+def point2dem_step(pair, pairs_dir):
+    dem1, _ = get_dems(pairs_dir, pair)
+    prefix = os.path.join(pairs_dir, pair, os.path.basename(dem1).split('.')[0][:13])
+    trans_source = '{}-trans_source.tif'.format(prefix)
+    job = Job(pair,
+              cmd=['point2dem', trans_source, '-o', prefix],
+              qsub_script='qsub_point2dem.sh',
+              qsub_args=[trans_source, prefix],
+              log_path='{}_point2dem.log'.format(prefix))
+
+    return Step(job, [trans_source], None, ['{}-DEM.tif'.format(prefix)])
+
+
+def shift_step(pair, pairs_dir):
+    # Same output as point2dem, so the rmse stage is unchanged
+    dem1, _ = get_dems(pairs_dir, pair)
+    prefix = os.path.join(pairs_dir, pair, os.path.basename(dem1).split('.')[0][:13])
+    transform = '{}-transform.txt'.format(prefix)
+    out_path = '{}-DEM.tif'.format(prefix)
+
+    return Step(functools.partial(apply_pc_align_transform, dem1, transform, out_path),
+                [dem1, transform], {'method': 'translation'}, [out_path])
+
+
+def nuth_step(pair, pairs_dir):
+    dem1, dem2 = get_dems(pairs_dir, pair)
+
+    return Step(functools.partial(nuth_kaab_pair, os.path.join(pairs_dir, pair)),
+                [dem2, dem1], {'method': 'nuth_kaab'}, [trans_name(dem1)])
+
+
+def rmse_step(pair, pairs_dir, method='pc_align_reg', nuth=False):
+    # Reference DEM against the aligned DEM from point2dem, or from nuth_kaab
+    dem1, dem2 = get_dems(pairs_dir, pair)
+    if nuth:
+        aligned = trans_name(dem1)
+    else:
+        aligned = '{}-DEM.tif'.format(os.path.join(pairs_dir, pair, os.path.basename(dem1).split('.')[0][:13]))
+    job = Job(pair,
+              cmd=[PYTHON, os.path.join(CODE_DIR, 'rmse_sample_pts.py'), dem2, aligned, method],
+              qsub_script='qsub_RMSE_sample_pts.sh',
+              qsub_args=[dem2, aligned, method],
+              log_path=os.path.join(pairs_dir, pair, '{}_rmse.log'.format(method)))
+
+    return Step(job, [dem2, aligned], {'method': method},
+                [os.path.join(pairs_dir, pair, '{}_{}_rmse.txt'.format(pair, method))])
+
+
+class Pipeline:
+    """
+    Runs the stages of each pair in order, each stage in its own bounded pool.
+    stage_funcs: dict of stage name -> function(pair) returning a Step
+    limits: dict of stage name -> number of that stage's jobs to run at once
+    retries: number of times to rerun a failed job
+    manifest: job_manifest.JobManifest, to skip stages already done
+    """
+    def __init__(self, stage_funcs, limits, retries=0, manifest=None):
+        self.stages = [s for s in STAGES if s in stage_funcs]
+        self.stage_funcs = stage_funcs
+        self.pools = {s: ThreadPoolExecutor(max_workers=limits[s]) for s in self.stages}
+        # Only used for its run() method: logging and retries of one job
+        self.runner = LocalExecutor(workers=1, retries=retries)
+        self.manifest = manifest
+        self.results = {}
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+
+    def queue(self, pair, stage_idx):
+        with self.lock:
+            self.pending += 1
+        self.pools[self.stages[stage_idx]].submit(self.run_stage, pair, stage_idx)
+
+    def run_stage(self, pair, stage_idx):
+        stage = self.stages[stage_idx]
+        try:
+            step = self.stage_funcs[stage](pair)
+            if self.manifest and not self.manifest.needs_run(pair, stage, step.inputs, step.params, step.outputs):
+                exit_code = 0
+            elif not isinstance(step.job, Job):
+                # In-process step, failures raise
+                logger.info('{}: {}'.format(stage, pair))
+                step.job()
+                exit_code = 0
+                if self.manifest:
+                    self.manifest.record(pair, stage, step.inputs, step.params, exit_code=0, outputs=step.outputs)
+            else:
+                if self.manifest:
+                    self.manifest.track(step.job, stage, step.inputs, step.params, step.outputs)
+                logger.info('{}: {}'.format(stage, pair))
+                exit_code = self.runner.run(step.job)
+        except Exception as e:
+            logger.error('{}: {} could not run: {}'.format(stage, pair, e))
+            exit_code = -1
+
+        self.results[(pair, stage)] = exit_code
+        if exit_code == 0 and stage_idx + 1 < len(self.stages):
+            self.queue(pair, stage_idx + 1)
+        with self.lock:
+            self.pending -= 1
+            if self.pending == 0:
+                self.finished.set()
+
+    def run(self, pairs):
+        """
+        Run all stages for pairs, blocking until every pair has finished or
+        failed.
+
+        Returns
+        dict : (pair, stage) -> exit code, -1 if the stage could not be set up
+        """
+        if not pairs:
+            return self.results
+        start = time.time()
+        # Hold one pending count while queueing, so early finishers cannot
+        # signal the end before every pair is queued
+        with self.lock:
+            self.pending += 1
+        for pair in pairs:
+            self.queue(pair, 0)
+        with self.lock:
+            self.pending -= 1
+            if self.pending == 0:
+                self.finished.set()
+        self.finished.wait()
+        for pool in self.pools.values():
+            pool.shutdown()
+
+        for stage in self.stages:
+            codes = [code for (_, s), code in self.results.items() if s == stage]
+            logger.info('{}: {} pairs, {} failed'.format(stage, len(codes), len([c for c in codes if c != 0])))
+        logger.info('Pipeline finished in {:.1f}s'.format(time.time() - start))
+
+        return self.results
+
+
+def coreg_pipeline(src_dir, dst_dir=None, run_pairs_f=None, stages=PC_ALIGN_STAGES, limits=None,
+                   suffix='.tif', compress='LZW', method=None, retries=0, manifest=None,
+                   clip_in_process=False):
+    """
+    Run stages for every pair subdirectory of src_dir.
+    src_dir: directory holding pair subdirectories
+    dst_dir: directory to write clipped pairs to, and run later stages in.
+             Required if 'clip' is in stages, otherwise stages run in src_dir.
+    run_pairs_f: text file with one pair per line to run
+    stages: stages to run, a subset of STAGES, e.g. PC_ALIGN_STAGES,
+            SHIFT_STAGES or NUTH_STAGES
+    limits: dict of stage name -> jobs to run at once, default number of cores
+    suffix, compress: passed to clip2min_bb.py
+    method: coregistration method, used in RMSE file names. Default
+            pc_align_reg, or nuth_reg with the nuth stage.
+    clip_in_process: True to clip in this process to VRTs, rather than running
+                     clip2min_bb.py to write GTiffs
+
+    Returns
+    dict : (pair, stage) -> exit code
+    """
+    pairs = sorted(x for x in os.listdir(src_dir) if os.path.isdir(os.path.join(src_dir, x)))
+    if run_pairs_f:
+        pairs = constrict_pairs(run_pairs_f, pairs)
+    logger.info('Pairs found: {}'.format(len(pairs)))
+
+    nuth = 'nuth' in stages
+    if nuth and ('pc_align' in stages or 'point2dem' in stages or 'shift' in stages):
+        raise ValueError('Use either the nuth stage or the pc_align stages.')
+    if 'point2dem' in stages and 'shift' in stages:
+        raise ValueError('Use either the point2dem stage or the shift stage.')
+    if method is None:
+        method = 'nuth_reg' if nuth else 'pc_align_reg'
+
+    pairs_dir = src_dir
+    stage_funcs = {}
+    if 'clip' in stages:
+        if dst_dir is None:
+            raise ValueError('dst_dir is required to run the clip stage.')
+        stage_funcs['clip'] = lambda pair: clip_step(pair, src_dir, dst_dir, suffix=suffix, compress=compress,
+                                                     in_process=clip_in_process)
+        pairs_dir = dst_dir
+    if 'pc_align' in stages:
+        stage_funcs['pc_align'] = lambda pair: pc_align_step(pair, pairs_dir)
+    if 'point2dem' in stages:
+        stage_funcs['point2dem'] = lambda pair: point2dem_step(pair, pairs_dir)
+    if 'shift' in stages:
+        stage_funcs['shift'] = lambda pair: shift_step(pair, pairs_dir)
+    if nuth:
+        stage_funcs['nuth'] = lambda pair: nuth_step(pair, pairs_dir)
+    if 'rmse' in stages:
+        stage_funcs['rmse'] = lambda pair: rmse_step(pair, pairs_dir, method=method, nuth=nuth)
+
+    default_limit = multiprocessing.cpu_count()
+    limits = {s: (limits or {}).get(s) or default_limit for s in stage_funcs}
+
+    return Pipeline(stage_funcs, limits, retries=retries, manifest=manifest).run(pairs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('src_dir', type=os.path.abspath,
+                        help='Path to directory holding pair directories.')
+    parser.add_argument('-o', '--dst_dir', type=os.path.abspath,
+                        help='Directory to write clipped pair directories to. Required for the clip stage.')
+    parser.add_argument('--stages', nargs='+', choices=STAGES,
+                        help='Stages to run. Default: {}, with --shift: {}, with --nuth: {}'.format(
+                            ' '.join(PC_ALIGN_STAGES), ' '.join(SHIFT_STAGES), ' '.join(NUTH_STAGES)))
+    parser.add_argument('--shift', action='store_true',
+                        help='Apply the pc_align transform in-process as a translation instead of running point2dem.')
+    parser.add_argument('--nuth', action='store_true',
+                        help='Align pairs in-process with Nuth & Kaab instead of pc_align and point2dem.')
+    parser.add_argument('--run_pairs', type=os.path.abspath,
+                        help='Text file with one pair per line to run.')
+    parser.add_argument('-s', '--suffix', type=str, default='.tif',
+                        help='Suffix that all rasters to clip share.')
+    parser.add_argument('-c', '--compress', type=str, default='LZW',
+                        help='Compression of clipped rasters. Default is LZW.')
+    parser.add_argument('--clip_in_process', action='store_true',
+                        help='Clip pairs in this process to VRTs rather than running clip2min_bb.py.')
+    parser.add_argument('--method', type=str,
+                        help='Coregistration method, used for RMSE file naming. Default pc_align_reg or nuth_reg.')
+    for stage in STAGES:
+        parser.add_argument('--{}_jobs'.format(stage), type=int,
+                            help='Number of {} jobs to run at once. Default is the number of cores.'.format(stage))
+    parser.add_argument('--retries', type=int, default=0,
+                        help='Number of times to rerun a failed job. Default 0.')
+    add_manifest_args(parser)
+
+    args = parser.parse_args()
+
+    coreg_pipeline(args.src_dir,
+                   dst_dir=args.dst_dir,
+                   run_pairs_f=args.run_pairs,
+                   stages=args.stages if args.stages else (NUTH_STAGES if args.nuth else
+                                                           SHIFT_STAGES if args.shift else PC_ALIGN_STAGES),
+                   limits={s: getattr(args, '{}_jobs'.format(s)) for s in STAGES},
+                   suffix=args.suffix,
+                   compress=args.compress,
+                   method=args.method,
+                   retries=args.retries,
+                   manifest=JobManifest(args.manifest) if args.manifest else None,
+                   clip_in_process=args.clip_in_process)
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""
+Catalog of DEMs in a SQLite database with an R-tree index on their bounds.
+
+A directory tree is scanned once, recording each DEM's bounds, CRS,
+resolution, acquisition date (parsed from the filename the same way as
+get_dems in the batch tools) and NoData value. Overlap queries then go
+through the R-tree instead of opening rasters, and the pair list can be
+written as the pair subdirectories the coreg batch tools expect.
+"""
+
+import argparse
+import datetime
+import fnmatch
+import logging
+import os
+import sqlite3
+
+from osgeo import gdal, osr
+
+from footprint_cache import footprint_overlap
+
+
+logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+gdal.UseExceptions()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dems (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE,
+    mtime REAL,
+    size INTEGER,
+    crs TEXT,
+    epsg INTEGER,
+    res_x REAL,
+    res_y REAL,
+    acq_date TEXT,
+    nodata REAL,
+    minx REAL,
+    miny REAL,
+    maxx REAL,
+    maxy REAL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS dems_rtree USING rtree(id, minx, maxx, miny, maxy);
+"""
+
+
+def connect(catalog_path):
+    """
+    Open (creating if needed) a catalog database.
+    """
+    conn = sqlite3.connect(catalog_path)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+
+    return conn
+
+
+def acq_date(dem_path):
+    """
+    Acquisition date from a DEM filename of the form <sensor>_<YYYYMMDD>_...,
+    as YYYY-MM-DD, or None if the filename does not follow that pattern.
+    """
+    try:
+        date = os.path.split(dem_path)[1].split('_')[1]
+        return datetime.datetime.strptime(date[:8], '%Y%m%d').strftime('%Y-%m-%d')
+    except (IndexError, ValueError):
+        return None
+
+
+def dem_record(dem_path):
+    """
+    Header information of a DEM, without reading any pixels.
+    """
+    ds = gdal.Open(dem_path)
+    if ds is None:
+        raise RuntimeError('GDAL could not open {}'.format(dem_path))
+    gt = ds.GetGeoTransform()
+    minx = gt[0]
+    maxy = gt[3]
+    maxx = minx + gt[1] * ds.RasterXSize
+    miny = maxy + gt[5] * ds.RasterYSize
+    crs = ds.GetProjection()
+    srs = osr.SpatialReference(wkt=crs)
+    srs.AutoIdentifyEPSG()
+    epsg = srs.GetAuthorityCode(None)
+    st = os.stat(dem_path)
+
+    return {'path': os.path.abspath(dem_path),
+            'mtime': st.st_mtime,
+            'size': st.st_size,
+            'crs': crs,
+            'epsg': int(epsg) if epsg else None,
+            'res_x': gt[1],
+            'res_y': gt[5],
+            'acq_date': acq_date(dem_path),
+            'nodata': ds.GetRasterBand(1).GetNoDataValue(),
+            'minx': min(minx, maxx),
+            'miny': min(miny, maxy),
+            'maxx': max(minx, maxx),
+            'maxy': max(miny, maxy)}
+
+
+def scan(src_dir, catalog_path, pattern='*_dem.tif'):
+    """
+    Walk src_dir and add every DEM matching pattern to the catalog. DEMs whose
+    modification time and size are unchanged since the last scan are skipped,
+    and catalogued DEMs that no longer exist are removed.
+
+    Returns
+    int : number of DEMs added or updated
+    """
+    conn = connect(catalog_path)
+    known = {row['path']: (row['id'], row['mtime'], row['size'])
+             for row in conn.execute('SELECT id, path, mtime, size FROM dems')}
+    seen = set()
+    n_updated = 0
+    for root, dirs, files in os.walk(src_dir):
+        for f in fnmatch.filter(files, pattern):
+            dem_path = os.path.abspath(os.path.join(root, f))
+            seen.add(dem_path)
+            st = os.stat(dem_path)
+            if dem_path in known and known[dem_path][1:] == (st.st_mtime, st.st_size):
+                continue
+            try:
+                rec = dem_record(dem_path)
+            except RuntimeError as e:
+                logger.warning('Could not open {}: {}'.format(dem_path, e))
+                continue
+            if dem_path in known:
+                delete(conn, known[dem_path][0])
+            cur = conn.execute('INSERT INTO dems ({}) VALUES ({})'.format(
+                ', '.join(rec), ', '.join('?' * len(rec))), list(rec.values()))
+            conn.execute('INSERT INTO dems_rtree VALUES (?, ?, ?, ?, ?)',
+                         (cur.lastrowid, rec['minx'], rec['maxx'], rec['miny'], rec['maxy']))
+            n_updated += 1
+    # Drop DEMs that have gone from the part of the tree scanned
+    # Trailing separator so /data/dems does not match /data/dems2
+    src_prefix = os.path.join(os.path.abspath(src_dir), '')
+    for dem_path, (dem_id, _, _) in known.items():
+        if dem_path.startswith(src_prefix) and dem_path not in seen:
+            delete(conn, dem_id)
+    conn.commit()
+    conn.close()
+    logger.info('DEMs added or updated: {}'.format(n_updated))
+
+    return n_updated
+
+
+def delete(conn, dem_id):
+    conn.execute('DELETE FROM dems WHERE id = ?', (dem_id,))
+    conn.execute('DELETE FROM dems_rtree WHERE id = ?', (dem_id,))
+
+
+def bbox_area(minx, miny, maxx, maxy):
+    return max(0.0, maxx - minx) * max(0.0, maxy - miny)
+
+
+def overlapping(conn, bounds, min_overlap=0.0, epsg=None):
+    """
+    DEMs whose bounds overlap bounds (minx, miny, maxx, maxy) by at least
+    min_overlap, as a fraction of the area of bounds.
+    epsg: only return DEMs in this EPSG code
+
+    Returns
+    list of (sqlite3.Row, overlap fraction)
+    """
+    minx, miny, maxx, maxy = bounds
+    query_area = bbox_area(minx, miny, maxx, maxy)
+    rows = conn.execute("""SELECT dems.* FROM dems JOIN dems_rtree ON dems.id = dems_rtree.id
+                           WHERE dems_rtree.maxx >= ? AND dems_rtree.minx <= ?
+                           AND dems_rtree.maxy >= ? AND dems_rtree.miny <= ?""",
+                        (minx, maxx, miny, maxy))
+    matches = []
+    for row in rows:
+        if epsg is not None and row['epsg'] != epsg:
+            continue
+        inter = bbox_area(max(minx, row['minx']), max(miny, row['miny']),
+                          min(maxx, row['maxx']), min(maxy, row['maxy']))
+        frac = inter / query_area if query_area > 0 else 0.0
+        if frac >= min_overlap:
+            matches.append((row, frac))
+
+    return matches
+
+
+def query(catalog_path, dem_path, min_overlap=0.0):
+    """
+    Catalogued DEMs overlapping dem_path by at least min_overlap (fraction of
+    the area of dem_path's bounds), in the same CRS.
+
+    Returns
+    list of (path, overlap fraction), largest overlap first
+    """
+    rec = dem_record(dem_path)
+    conn = connect(catalog_path)
+    matches = overlapping(conn, (rec['minx'], rec['miny'], rec['maxx'], rec['maxy']),
+                          min_overlap=min_overlap, epsg=rec['epsg'])
+    conn.close()
+    results = [(row['path'], frac) for row, frac in matches if row['path'] != rec['path']]
+
+    return sorted(results, key=lambda x: x[1], reverse=True)
+
+
+def find_pairs(catalog_path, min_overlap=0.5, max_days=None, use_footprints=False):
+    """
+    Pairs of catalogued DEMs, in the same CRS, whose bounds overlap by at
+    least min_overlap of the smaller DEM.
+    max_days: only pair DEMs acquired at most this many days apart
+    use_footprints: True to check the overlap of the valid data of candidate
+                    pairs with the cached footprints (see footprint_cache.py)
+                    rather than only their bounds
+
+    Returns
+    list of (older DEM path, newer DEM path)
+    """
+    conn = connect(catalog_path)
+    dems = conn.execute('SELECT * FROM dems ORDER BY acq_date, path').fetchall()
+    order = {row['id']: i for i, row in enumerate(dems)}
+    pairs = []
+    for row in dems:
+        bounds = (row['minx'], row['miny'], row['maxx'], row['maxy'])
+        for other, _ in overlapping(conn, bounds, epsg=row['epsg']):
+            # Each pair once, older DEM first
+            if order[other['id']] <= order[row['id']]:
+                continue
+            inter = bbox_area(max(row['minx'], other['minx']), max(row['miny'], other['miny']),
+                              min(row['maxx'], other['maxx']), min(row['maxy'], other['maxy']))
+            min_area = min(bbox_area(*bounds),
+                           bbox_area(other['minx'], other['miny'], other['maxx'], other['maxy']))
+            if min_area <= 0 or inter / min_area < min_overlap:
+                continue
+            if max_days is not None and row['acq_date'] and other['acq_date']:
+                d1 = datetime.datetime.strptime(row['acq_date'], '%Y-%m-%d')
+                d2 = datetime.datetime.strptime(other['acq_date'], '%Y-%m-%d')
+                if abs((d2 - d1).days) > max_days:
+                    continue
+            if use_footprints and footprint_overlap(row['path'], other['path'])[1] < min_overlap:
+                continue
+            pairs.append((row['path'], other['path']))
+    conn.close()
+    logger.info('Pairs found: {}'.format(len(pairs)))
+
+    return pairs
+
+
+def pair_name(dem1, dem2):
+    """
+    Name of a pair subdirectory: the two DEM names without extension.
+    """
+    return '{}-{}'.format(os.path.basename(dem1).split('.')[0], os.path.basename(dem2).split('.')[0])
+
+
+def write_pairs(pairs, dst_dir, run_pairs_f=None, link=True):
+    """
+    Lay out pairs as the subdirectories the coreg batch tools read: one
+    directory per pair in dst_dir holding (links to) both DEMs. Optionally
+    also write the pair names one per line, for the batch tools' --run_pairs.
+    link: True to symlink the DEMs, False to only write the pair list
+    """
+    if not os.path.exists(dst_dir):
+        os.makedirs(dst_dir)
+    names = []
+    for dem1, dem2 in pairs:
+        name = pair_name(dem1, dem2)
+        names.append(name)
+        if link:
+            pair_dir = os.path.join(dst_dir, name)
+            if not os.path.exists(pair_dir):
+                os.mkdir(pair_dir)
+            for dem in (dem1, dem2):
+                dst = os.path.join(pair_dir, os.path.basename(dem))
+                if not os.path.lexists(dst):
+                    os.symlink(dem, dst)
+    if run_pairs_f:
+        with open(run_pairs_f, 'w') as dst:
+            dst.write('\n'.join(names))
+            dst.write('\n')
+
+    return names
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+
+    scan_parser = subparsers.add_parser('scan', help='Add DEMs under a directory to the catalog.')
+    scan_parser.add_argument('catalog', type=os.path.abspath,
+                             help='Path to catalog SQLite database.')
+    scan_parser.add_argument('src_dir', type=os.path.abspath,
+                             help='Directory to search recursively for DEMs.')
+    scan_parser.add_argument('--pattern', type=str, default='*_dem.tif',
+                             help='Filename pattern of DEMs. Default "*_dem.tif"')
+
+    query_parser = subparsers.add_parser('query', help='List catalogued DEMs overlapping a DEM.')
+    query_parser.add_argument('catalog', type=os.path.abspath,
+                              help='Path to catalog SQLite database.')
+    query_parser.add_argument('dem', type=os.path.abspath,
+                              help='DEM to find overlaps with.')
+    query_parser.add_argument('--min_overlap', type=float, default=0.0,
+                              help='Minimum overlap, as a percentage of the DEM\'s bounds. Default 0.')
+
+    pairs_parser = subparsers.add_parser('pairs', help='Write pair subdirectories for the batch tools.')
+    pairs_parser.add_argument('catalog', type=os.path.abspath,
+                              help='Path to catalog SQLite database.')
+    pairs_parser.add_argument('dst_dir', type=os.path.abspath,
+                              help='Directory to create pair subdirectories in.')
+    pairs_parser.add_argument('--min_overlap', type=float, default=50.0,
+                              help='Minimum overlap, as a percentage of the smaller DEM. Default 50.')
+    pairs_parser.add_argument('--max_days', type=int,
+                              help='Maximum number of days between acquisitions.')
+    pairs_parser.add_argument('--use_footprints', action='store_true',
+                              help='Check overlap of valid data using cached footprints.')
+    pairs_parser.add_argument('--run_pairs', type=os.path.abspath,
+                              help='Text file to write pair names to, one per line.')
+    pairs_parser.add_argument('--list_only', action='store_true',
+                              help='Only write the --run_pairs list, do not create subdirectories.')
+
+    args = parser.parse_args()
+
+    if args.command == 'scan':
+        scan(args.src_dir, args.catalog, pattern=args.pattern)
+    elif args.command == 'query':
+        for path, frac in query(args.catalog, args.dem, min_overlap=args.min_overlap / 100.0):
+            print('{}\t{:.1f}%'.format(path, frac * 100))
+    elif args.command == 'pairs':
+        pairs = find_pairs(args.catalog, min_overlap=args.min_overlap / 100.0, max_days=args.max_days,
+                           use_footprints=args.use_footprints)
+        write_pairs(pairs, args.dst_dir, run_pairs_f=args.run_pairs, link=not args.list_only)
+    else:
+        parser.print_help()
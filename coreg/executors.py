@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Executors for the coreg batch tools. A Job describes one command both as a
+PBS submission (qsub script plus p1, p2, ... variables) and as a command line
+to run directly. QsubExecutor submits jobs to PBS as the batch tools always
+have; LocalExecutor runs them on this machine with a bounded pool of workers,
+writing a log per job, retrying failures and recording exit codes.
+"""
+
+import logging
+import multiprocessing
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import PIPE, STDOUT
+
+
+logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Location of the qsub_*.sh scripts on the cluster
+QSUB_DIR = '~/scratch/code/coreg'
+# Location of the coreg python scripts for local runs
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+PYTHON = sys.executable
+
+
+class Job:
+    """
+    One unit of work in a batch.
+    name: unique name of the job, e.g. the pair directory
+    cmd: list, command line to run locally
+    qsub_script: name of the qsub_*.sh script in QSUB_DIR that runs the job on PBS
+    qsub_args: list, values passed to qsub_script as p1, p2, ...
+    log_path: file to write the output of a local run to
+    on_done: function called with the exit code when the job finishes, or
+             with the qsub exit code and submitted=True when it is submitted
+    """
+    def __init__(self, name, cmd, qsub_script, qsub_args, log_path=None, on_done=None):
+        self.name = name
+        self.cmd = [str(x) for x in cmd]
+        self.qsub_script = qsub_script
+        self.qsub_args = qsub_args
+        self.log_path = log_path
+        self.on_done = on_done
+
+    def qsub_cmd(self):
+        qsub_vars = ','.join('p{}="{}"'.format(i + 1, x) for i, x in enumerate(self.qsub_args))
+
+        return 'qsub -v {} {}'.format(qsub_vars, os.path.join(QSUB_DIR, self.qsub_script))
+
+
+class QsubExecutor:
+    """
+    Submit jobs to PBS with qsub, one blocking submission per job.
+    """
+    def __init__(self, dryrun=False):
+        self.dryrun = dryrun
+        self.results = {}
+
+    def submit(self, job):
+        cmd = job.qsub_cmd()
+        if self.dryrun:
+            print(cmd)
+            return
+        p = subprocess.Popen(cmd, shell=True, stdin=PIPE, stdout=PIPE, stderr=STDOUT)
+        output = p.stdout.read()
+        p.wait()
+        print(output)
+        self.results[job.name] = p.returncode
+        if job.on_done:
+            job.on_done(p.returncode, submitted=True)
+
+    def wait(self):
+        """
+        Exit codes of the qsub submissions (not of the jobs themselves).
+        """
+        return self.results
+
+
+class LocalExecutor:
+    """
+    Run jobs as local subprocesses, at most workers at a time.
+    workers: number of jobs to run at once, default the number of cores
+    retries: number of times to rerun a job that exits non-zero
+    log_dir: directory for logs of jobs without a log_path, default the
+             current directory
+    """
+    def __init__(self, workers=None, retries=0, log_dir=None, dryrun=False):
+        self.workers = workers if workers else multiprocessing.cpu_count()
+        self.retries = retries
+        self.log_dir = log_dir if log_dir else os.getcwd()
+        self.dryrun = dryrun
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        self.futures = {}
+
+    def log_path(self, job):
+        if job.log_path:
+            return job.log_path
+        return os.path.join(self.log_dir, '{}.log'.format(job.name))
+
+    def run(self, job):
+        """
+        Run job until it succeeds or retries are used up.
+
+        Returns
+        int : exit code of the last attempt
+        """
+        log_path = self.log_path(job)
+        returncode = None
+        for attempt in range(self.retries + 1):
+            with open(log_path, 'a') as log:
+                log.write('Attempt {}: {}\n'.format(attempt + 1, ' '.join(job.cmd)))
+                log.flush()
+                try:
+                    returncode = subprocess.call(job.cmd, stdout=log, stderr=STDOUT)
+                except OSError as e:
+                    log.write('{}\n'.format(e))
+                    returncode = 127
+                log.write('Exit code: {}\n'.format(returncode))
+            if returncode == 0:
+                break
+            logger.warning('{} failed with exit code {} (attempt {} of {}), log: {}'.format(
+                job.name, returncode, attempt + 1, self.retries + 1, log_path))
+        if job.on_done:
+            job.on_done(returncode)
+
+        return returncode
+
+    def submit(self, job):
+        if self.dryrun:
+            print(' '.join(job.cmd))
+            return
+        self.futures[job.name] = self.pool.submit(self.run, job)
+
+    def wait(self):
+        """
+        Block until all submitted jobs finish.
+
+        Returns
+        dict : job name -> exit code
+        """
+        results = {name: future.result() for name, future in self.futures.items()}
+        self.pool.shutdown()
+        failed = [name for name, code in results.items() if code != 0]
+        logger.info('Jobs run: {}, failed: {}'.format(len(results), len(failed)))
+        for name in failed:
+            logger.warning('Failed: {} (exit code {})'.format(name, results[name]))
+
+        return results
+
+
+def get_executor(local=False, workers=None, retries=0, dryrun=False):
+    """
+    Executor for the batch tools' --local, --workers, --retries and --dryrun
+    arguments.
+    """
+    if local:
+        return LocalExecutor(workers=workers, retries=retries, dryrun=dryrun)
+
+    return QsubExecutor(dryrun=dryrun)
+
+
+def add_executor_args(parser):
+    """
+    Add the executor arguments to a batch tool's argparse parser.
+    """
+    parser.add_argument('--local', action='store_true',
+                        help='Run jobs on this machine rather than submitting them with qsub.')
+    parser.add_argument('--workers', type=int,
+                        help='Number of jobs to run at once with --local. Default is the number of cores.')
+    parser.add_argument('--retries', type=int, default=0,
+                        help='Number of times to rerun a failed job with --local. Default 0.')
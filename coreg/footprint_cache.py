@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+Cached, simplified valid-data footprints of DEMs.
+
+The footprint of a DEM is polygonized once from a low resolution read of its
+NoData mask, simplified, and stored either in a sidecar file next to the DEM
+(<dem>.footprint.json) or in a single GeoPackage shared by many DEMs. Entries
+are keyed by the DEM's path, modification time and size, so a DEM that is
+rewritten gets a new footprint on the next lookup. GeoPackage rows are looked
+up and replaced one DEM at a time by path, and record the CRS of their DEM.
+"""
+
+import argparse
+import glob
+import json
+import logging
+import os
+
+import numpy as np
+from osgeo import gdal, ogr
+from affine import Affine
+from rasterio.features import shapes
+from shapely.geometry import shape, Polygon
+from shapely.ops import unary_union
+from shapely import wkt
+
+
+logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+gdal.UseExceptions()
+ogr.UseExceptions()
+
+SIDECAR_EXT = '.footprint.json'
+GPKG_LAYER = 'footprints'
+
+
+def raster_footprint(path, window=None, max_size=1024):
+    '''
+    Gets boundary of raster at path, ignoring no data values, from a
+    downsampled read of the window (xoff, yoff, xsize, ysize) rather than the
+    whole band at full resolution. GDAL uses the raster's overviews for the
+    read where it has them.
+    max_size: largest number of rows or columns to read the mask at
+
+    Returns
+    shapely Polygon or MultiPolygon of all valid data, empty if there is none
+    '''
+    src = gdal.Open(path)
+    rb = src.GetRasterBand(1)
+    nodata = rb.GetNoDataValue()
+    gt = src.GetGeoTransform()
+    if window is None:
+        window = (0, 0, src.RasterXSize, src.RasterYSize)
+    xoff, yoff, xsize, ysize = window
+
+    scale = max(1.0, max(xsize, ysize) / float(max_size))
+    buf_x = max(1, int(round(xsize / scale)))
+    buf_y = max(1, int(round(ysize / scale)))
+    arr = rb.ReadAsArray(xoff, yoff, xsize, ysize, buf_xsize=buf_x, buf_ysize=buf_y)
+    # Geotransform of the downsampled window
+    win_gt = (gt[0] + xoff * gt[1], gt[1] * xsize / float(buf_x), 0,
+              gt[3] + yoff * gt[5], 0, gt[5] * ysize / float(buf_y))
+
+    # Array of 1's and 0's
+    binary = np.where(arr <= nodata, 0, 1).astype(np.uint8) if nodata is not None else np.ones(arr.shape, np.uint8)
+    binary[np.isnan(arr)] = 0
+    mask = binary == 1
+    geoms = [shape(shp) for shp, value in shapes(binary, mask=mask, transform=Affine.from_gdal(*win_gt))
+             if value == 1]
+    if not geoms:
+        logger.warning('No valid data found: {}'.format(path))
+        return Polygon()
+    bb = unary_union(geoms)
+
+    return bb
+
+
+def file_key(path):
+    """
+    Cache key of a file: absolute path, modification time and size.
+    """
+    st = os.stat(path)
+
+    return os.path.abspath(path), st.st_mtime, st.st_size
+
+
+def read_sidecar(dem_path, key):
+    """
+    Footprint stored next to dem_path, or None if missing or out of date.
+    """
+    sidecar = dem_path + SIDECAR_EXT
+    if not os.path.exists(sidecar):
+        return None
+    with open(sidecar, 'r') as src:
+        entry = json.load(src)
+    if (entry['path'], entry['mtime'], entry['size']) != key:
+        return None
+
+    return wkt.loads(entry['wkt'])
+
+
+def write_sidecar(dem_path, key, footprint):
+    sidecar = dem_path + SIDECAR_EXT
+    path, mtime, size = key
+    with open(sidecar, 'w') as dst:
+        json.dump({'path': path, 'mtime': mtime, 'size': size, 'wkt': footprint.wkt}, dst)
+
+
+def open_gpkg(gpkg_path, update=False):
+    """
+    Footprint layer of a GeoPackage, created with an index on path when update
+    is True and it does not exist yet. Each row stores the CRS of its DEM, as
+    the DEMs in one cache can be in different projections.
+
+    Returns
+    Tuple: ogr DataSource, ogr Layer, or None, None if there is no layer
+    """
+    if os.path.exists(gpkg_path):
+        ds = ogr.Open(gpkg_path, 1 if update else 0)
+    elif update:
+        ds = ogr.GetDriverByName('GPKG').CreateDataSource(gpkg_path)
+    else:
+        return None, None
+    lyr = ds.GetLayerByName(GPKG_LAYER)
+    if lyr is None and update:
+        lyr = ds.CreateLayer(GPKG_LAYER, geom_type=ogr.wkbUnknown)
+        for name, field_type in (('path', ogr.OFTString), ('mtime', ogr.OFTReal),
+                                 ('size', ogr.OFTInteger64), ('crs', ogr.OFTString)):
+            lyr.CreateField(ogr.FieldDefn(name, field_type))
+        ds.ExecuteSQL('CREATE INDEX IF NOT EXISTS {0}_path ON {0} (path)'.format(GPKG_LAYER))
+    if lyr is None:
+        return None, None
+
+    return ds, lyr
+
+
+def path_filter(path):
+    return "path = '{}'".format(path.replace("'", "''"))
+
+
+def read_gpkg(gpkg_path, key):
+    """
+    Footprint stored in a GeoPackage for the DEM with cache key, or None if
+    missing or out of date. Only the rows for the DEM's path are read.
+    """
+    ds, lyr = open_gpkg(gpkg_path)
+    if lyr is None:
+        return None
+    lyr.SetAttributeFilter(path_filter(key[0]))
+    footprint = None
+    for feat in lyr:
+        if (feat.GetField('mtime'), feat.GetField('size')) == key[1:]:
+            geom = feat.GetGeometryRef()
+            # Empty footprints may be stored as null geometries
+            footprint = wkt.loads(geom.ExportToWkt()) if geom is not None else Polygon()
+            break
+    lyr = None
+    ds = None
+
+    return footprint
+
+
+def gpkg_keys(gpkg_path):
+    """
+    Cache keys of every footprint in a GeoPackage, reading no geometries.
+    """
+    ds, lyr = open_gpkg(gpkg_path)
+    if lyr is None:
+        return set()
+    lyr.SetIgnoredFields(['OGR_GEOMETRY', 'crs'])
+    keys = set((feat.GetField('path'), feat.GetField('mtime'), feat.GetField('size')) for feat in lyr)
+    lyr = None
+    ds = None
+
+    return keys
+
+
+def write_gpkg(gpkg_path, entries):
+    """
+    Add footprints to a GeoPackage in one transaction, replacing any out of
+    date rows for the same DEMs.
+    entries: list of (cache key, footprint, CRS WKT of the DEM)
+    """
+    ds, lyr = open_gpkg(gpkg_path, update=True)
+    lyr.StartTransaction()
+    for key, footprint, crs in entries:
+        lyr.SetAttributeFilter(path_filter(key[0]))
+        for fid in [feat.GetFID() for feat in lyr]:
+            lyr.DeleteFeature(fid)
+        feat = ogr.Feature(lyr.GetLayerDefn())
+        feat.SetField('path', key[0])
+        feat.SetField('mtime', key[1])
+        feat.SetField('size', key[2])
+        feat.SetField('crs', crs)
+        feat.SetGeometry(ogr.CreateGeometryFromWkt(footprint.wkt))
+        lyr.CreateFeature(feat)
+    lyr.SetAttributeFilter(None)
+    lyr.CommitTransaction()
+    lyr = None
+    ds = None
+
+
+def compute_footprint(dem_path, max_size=1024, tolerance=None):
+    """
+    Valid-data footprint of a DEM from a low resolution read, simplified.
+    tolerance: simplification tolerance in map units, default one pixel of the
+               low resolution mask
+    """
+    logger.info('Computing footprint: {}'.format(dem_path))
+    footprint = raster_footprint(dem_path, max_size=max_size)
+    if tolerance is None:
+        ds = gdal.Open(dem_path)
+        tolerance = abs(ds.GetGeoTransform()[1]) * max(1.0, max(ds.RasterXSize, ds.RasterYSize) / float(max_size))
+
+    return footprint.simplify(tolerance, preserve_topology=True)
+
+
+def get_footprint(dem_path, cache=True, max_size=1024, tolerance=None):
+    """
+    Valid-data footprint of a DEM, computed once from a low resolution read and
+    simplified, then looked up from the cache on later calls.
+    dem_path: path to DEM
+    cache: True to cache in a sidecar file next to the DEM, a path to a
+           GeoPackage to cache in, or False/None to not cache. Sidecar files are
+           safe for many jobs to write at once, a shared GeoPackage is not.
+    max_size: largest number of rows or columns to read the mask at
+    tolerance: simplification tolerance in map units, default one pixel of the
+               low resolution mask
+
+    Returns
+    shapely Polygon or MultiPolygon, empty if the DEM has no valid data
+    """
+    key = file_key(dem_path)
+    if cache is True:
+        footprint = read_sidecar(dem_path, key)
+    elif cache:
+        footprint = read_gpkg(cache, key)
+    else:
+        footprint = None
+    if footprint is not None:
+        return footprint
+
+    footprint = compute_footprint(dem_path, max_size=max_size, tolerance=tolerance)
+    if cache is True:
+        write_sidecar(dem_path, key, footprint)
+    elif cache:
+        write_gpkg(cache, [(key, footprint, gdal.Open(dem_path).GetProjection())])
+
+    return footprint
+
+
+def build_gpkg(dems, gpkg_path, max_size=1024, batch_size=1000):
+    """
+    Compute the footprints of the DEMs missing from a GeoPackage and write
+    them batch_size at a time, each batch in one transaction.
+
+    Returns
+    int : number of footprints computed
+    """
+    keys = gpkg_keys(gpkg_path)
+    missing = [dem for dem in dems if file_key(dem) not in keys]
+    logger.info('Footprints to compute: {} of {}'.format(len(missing), len(dems)))
+    for i in range(0, len(missing), batch_size):
+        entries = [(file_key(dem), compute_footprint(dem, max_size=max_size), gdal.Open(dem).GetProjection())
+                   for dem in missing[i:i + batch_size]]
+        write_gpkg(gpkg_path, entries)
+
+    return len(missing)
+
+
+def footprint_overlap(dem1_path, dem2_path, cache=True):
+    """
+    Overlap of the valid data of two DEMs, from their cached footprints.
+
+    Returns
+    Tuple: intersection polygon, intersection area as a fraction of the
+           smaller footprint
+    """
+    fp1 = get_footprint(dem1_path, cache=cache)
+    fp2 = get_footprint(dem2_path, cache=cache)
+    overlap = fp1.intersection(fp2)
+    min_area = min(fp1.area, fp2.area)
+    overlap_frac = overlap.area / min_area if min_area > 0 else 0.0
+
+    return overlap, overlap_frac
+
+
+def footprint_bounds(dem_path, cache=True):
+    """
+    Bounding box of the valid data of a DEM: minx, miny, maxx, maxy, or None
+    if the DEM has no valid data
+    """
+    footprint = get_footprint(dem_path, cache=cache)
+    if footprint.is_empty:
+        return None
+
+    return footprint.bounds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('src_dir', type=os.path.abspath,
+                        help='Directory to search (recursively) for DEMs to build footprints for.')
+    parser.add_argument('--pattern', type=str, default='*_dem.tif',
+                        help='Filename pattern of DEMs. Default "*_dem.tif"')
+    parser.add_argument('--gpkg', type=os.path.abspath,
+                        help='GeoPackage to store footprints in. Default is a sidecar file next to each DEM.')
+    parser.add_argument('--max_size', type=int, default=1024,
+                        help='Largest number of rows or columns to read each mask at. Default 1024.')
+
+    args = parser.parse_args()
+
+    dems = glob.glob(os.path.join(args.src_dir, '**', args.pattern), recursive=True)
+    logger.info('DEMs found: {}'.format(len(dems)))
+    if args.gpkg:
+        build_gpkg(dems, args.gpkg, max_size=args.max_size)
+    else:
+        for dem in dems:
+            get_footprint(dem, cache=True, max_size=args.max_size)
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent record of batch jobs, so that reruns of the coreg batch tools only
+submit what is left to do. For each pair and step the manifest stores a
+fingerprint of the input files, the parameters, the status, the exit code and
+the expected outputs. A job needs to run again if it has no record, its
+inputs or parameters changed, its last attempt failed, or its outputs are
+missing.
+
+Statuses:
+    submitted : handed to qsub, completion unknown
+    done      : finished with exit code 0 (or submitted and all outputs exist)
+    failed    : finished (or failed to submit) with a non-zero exit code
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+
+logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    pair TEXT,
+    step TEXT,
+    fingerprint TEXT,
+    params TEXT,
+    status TEXT,
+    exit_code INTEGER,
+    outputs TEXT,
+    updated TEXT,
+    PRIMARY KEY (pair, step)
+);
+"""
+
+# Bytes hashed from each end of a file
+FINGERPRINT_CHUNK = 1024 * 1024
+
+_fingerprints = {}
+
+
+def fingerprint(path, chunk=FINGERPRINT_CHUNK):
+    """
+    Content fingerprint of a file: its size and a hash of its first and last
+    chunk bytes. Cheap enough to compute for large rasters, and unchanged if
+    the file is only touched or copied. Cached by path, mtime and size.
+    """
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_mtime, st.st_size)
+    if key not in _fingerprints:
+        h = hashlib.sha1()
+        with open(path, 'rb') as src:
+            h.update(src.read(chunk))
+            if st.st_size > chunk:
+                src.seek(max(chunk, st.st_size - chunk))
+                h.update(src.read(chunk))
+        _fingerprints[key] = '{}:{}'.format(st.st_size, h.hexdigest())
+
+    return _fingerprints[key]
+
+
+def inputs_fingerprint(inputs):
+    """
+    Combined fingerprint of a list of input files, in the order given.
+    """
+    return json.dumps([[os.path.basename(x), fingerprint(x)] for x in inputs])
+
+
+class JobManifest:
+    """
+    Job state stored in a SQLite database. Safe to update from the worker
+    threads of an executors.LocalExecutor.
+    """
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.conn = sqlite3.connect(manifest_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+        self.lock = threading.Lock()
+
+    def get(self, pair, step):
+        with self.lock:
+            return self.conn.execute('SELECT * FROM jobs WHERE pair = ? AND step = ?',
+                                     (pair, step)).fetchone()
+
+    def record(self, pair, step, inputs, params=None, status='done', exit_code=None, outputs=None):
+        """
+        Store the state of a job, replacing any previous record.
+        """
+        row = (pair, step, inputs_fingerprint(inputs), json.dumps(params, sort_keys=True), status,
+               exit_code, json.dumps(outputs or []), datetime.datetime.now().isoformat())
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?)', row)
+            self.conn.commit()
+
+    def needs_run(self, pair, step, inputs, params=None, outputs=None):
+        """
+        True if the job has to be (re)run: no record, changed inputs or
+        parameters, a failed last attempt, or missing outputs. A submitted job
+        whose outputs all exist is marked done. A submitted job without its
+        outputs is assumed lost and run again, so rerun after the queue has
+        drained.
+        """
+        prev = self.get(pair, step)
+        if prev is None:
+            return True
+        if prev['fingerprint'] != inputs_fingerprint(inputs):
+            logger.info('{} {}: inputs changed'.format(pair, step))
+            return True
+        if prev['params'] != json.dumps(params, sort_keys=True):
+            logger.info('{} {}: parameters changed'.format(pair, step))
+            return True
+        outputs = outputs if outputs is not None else json.loads(prev['outputs'])
+        outputs_exist = all(os.path.exists(x) for x in outputs)
+        if prev['status'] == 'submitted' and outputs_exist and outputs:
+            self.record(pair, step, inputs, params, status='done', exit_code=0, outputs=outputs)
+            return False
+        if prev['status'] != 'done':
+            logger.info('{} {}: last attempt {}'.format(pair, step, prev['status']))
+            return True
+        if not outputs_exist:
+            logger.info('{} {}: outputs missing'.format(pair, step))
+            return True
+
+        return False
+
+    def track(self, job, step, inputs, params=None, outputs=None):
+        """
+        Record the result of an executors.Job in the manifest when the
+        executor finishes (or submits) it.
+        """
+        def on_done(exit_code, submitted=False):
+            if exit_code != 0:
+                status = 'failed'
+            elif submitted:
+                status = 'submitted'
+            else:
+                status = 'done'
+            self.record(job.name, step, inputs, params, status=status, exit_code=exit_code, outputs=outputs)
+
+        job.on_done = on_done
+
+        return job
+
+    def summary(self):
+        """
+        Number of jobs in each status, by step.
+        """
+        with self.lock:
+            rows = self.conn.execute('SELECT step, status, COUNT(*) FROM jobs GROUP BY step, status').fetchall()
+
+        return {(step, status): n for step, status, n in rows}
+
+    def close(self):
+        self.conn.close()
+
+
+def add_manifest_args(parser):
+    """
+    Add the manifest argument to a batch tool's argparse parser.
+    """
+    parser.add_argument('--manifest', type=os.path.abspath,
+                        help='''SQLite job manifest. Pairs whose inputs and parameters are unchanged
+                        since they last completed are skipped.''')
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+Nuth & Kääb (2011) coregistration of a pair of DEMs, in NumPy.
+
+The elevation differences between the DEM to align and the reference depend
+on the terrain's slope and aspect when the DEMs are offset horizontally:
+
+    dh / tan(slope) = a * cos(b - aspect) + c
+
+which is linear in cos(aspect), sin(aspect) and a constant. Solving it by
+least squares gives the horizontal shift, which is applied (by bilinear
+resampling of the DEM to align) and solved for again until the update is
+below a fraction of a pixel. The vertical shift is the median remaining
+difference. Only the overlap of the DEMs is read, optionally at reduced
+resolution, and slope and aspect come from dem_derivatives.derivative_arrays.
+"""
+
+import argparse
+import logging
+import os
+import time
+
+import numpy as np
+from osgeo import gdal
+
+from dem_derivatives import derivative_arrays
+from apply_shift import apply_translation
+from pc_align_batch import get_dems
+
+
+logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+gdal.UseExceptions()
+
+
+def dem_bounds(ds):
+    gt = ds.GetGeoTransform()
+    minx = gt[0]
+    maxy = gt[3]
+    maxx = minx + gt[1] * ds.RasterXSize
+    miny = maxy + gt[5] * ds.RasterYSize
+
+    return minx, miny, maxx, maxy
+
+
+def read_bounds(ds, bounds, scale=1.0):
+    """
+    Read the part of a DEM covering bounds (minx, miny, maxx, maxy), at 1 / scale
+    of its resolution, with NoData as NaN.
+
+    Returns
+    Tuple: array (float64), geotransform of the array
+    """
+    gt = ds.GetGeoTransform()
+    minx, miny, maxx, maxy = bounds
+    x0 = max(0, int(np.floor((minx - gt[0]) / gt[1])))
+    y0 = max(0, int(np.floor((maxy - gt[3]) / gt[5])))
+    x1 = min(ds.RasterXSize, int(np.ceil((maxx - gt[0]) / gt[1])))
+    y1 = min(ds.RasterYSize, int(np.ceil((miny - gt[3]) / gt[5])))
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError('DEMs do not overlap.')
+    xsize, ysize = x1 - x0, y1 - y0
+    buf_x = max(1, int(round(xsize / scale)))
+    buf_y = max(1, int(round(ysize / scale)))
+
+    band = ds.GetRasterBand(1)
+    arr = band.ReadAsArray(x0, y0, xsize, ysize, buf_xsize=buf_x, buf_ysize=buf_y).astype(np.float64)
+    nodata = band.GetNoDataValue()
+    if nodata is not None:
+        arr[arr == nodata] = np.nan
+    arr_gt = (gt[0] + x0 * gt[1], gt[1] * xsize / float(buf_x), 0,
+              gt[3] + y0 * gt[5], 0, gt[5] * ysize / float(buf_y))
+
+    return arr, arr_gt
+
+
+def sample_shifted(src, src_gt, dst_gt, dst_shape, dx, dy):
+    """
+    Bilinearly sample src, translated by (dx, dy) map units, at the pixel
+    centres of the grid dst_gt, dst_shape. Both grids must be north up, so the
+    sample positions separate into one set of rows and one set of columns.
+    Pixels outside src, or next to a NaN in src, are NaN.
+    """
+    xs = dst_gt[0] + (np.arange(dst_shape[1]) + 0.5) * dst_gt[1] - dx
+    ys = dst_gt[3] + (np.arange(dst_shape[0]) + 0.5) * dst_gt[5] - dy
+    # Continuous pixel indices, 0 at the centre of the first pixel
+    cols = (xs - src_gt[0]) / src_gt[1] - 0.5
+    rows = (ys - src_gt[3]) / src_gt[5] - 0.5
+    c0 = np.floor(cols).astype(np.int64)
+    r0 = np.floor(rows).astype(np.int64)
+    fc = cols - c0
+    fr = (rows - r0)[:, np.newaxis]
+    valid_c = (c0 >= 0) & (c0 + 1 < src.shape[1])
+    valid_r = (r0 >= 0) & (r0 + 1 < src.shape[0])
+    c0 = np.clip(c0, 0, src.shape[1] - 2)
+    r0 = np.clip(r0, 0, src.shape[0] - 2)
+
+    top = src[np.ix_(r0, c0)] * (1 - fc) + src[np.ix_(r0, c0 + 1)] * fc
+    bottom = src[np.ix_(r0 + 1, c0)] * (1 - fc) + src[np.ix_(r0 + 1, c0 + 1)] * fc
+    out = top * (1 - fr) + bottom * fr
+    out[~valid_r, :] = np.nan
+    out[:, ~valid_c] = np.nan
+
+    return out
+
+
+def nmad(arr):
+    return 1.4826 * np.median(np.abs(arr - np.median(arr)))
+
+
+def fit_shift(dh, slope, aspect, min_slope=3.0, max_slope=70.0, max_points=1000000, seed=0):
+    """
+    Least squares fit of dh / tan(slope) = A cos(aspect) + B sin(aspect) + C
+    over valid pixels, after subtracting the median difference and removing
+    differences more than 3 NMAD from it.
+
+    Returns
+    Tuple: remaining shift east, remaining shift north (map units), number of
+           points used
+    """
+    valid = ~np.isnan(dh) & (slope >= min_slope) & (slope <= max_slope) & (aspect >= 0)
+    dh = dh[valid]
+    if dh.size < 3:
+        raise ValueError('Too few valid pixels to fit a shift: {}'.format(dh.size))
+    slope = slope[valid]
+    aspect = aspect[valid]
+    # Remove the vertical offset first, dz / tan(slope) is not constant
+    dh = dh - np.median(dh)
+    inliers = np.abs(dh) <= 3 * max(nmad(dh), 1e-6)
+    dh, slope, aspect = dh[inliers], slope[inliers], aspect[inliers]
+    if dh.size > max_points:
+        idx = np.random.RandomState(seed).choice(dh.size, max_points, replace=False)
+        dh, slope, aspect = dh[idx], slope[idx], aspect[idx]
+
+    asp = np.radians(aspect)
+    y = dh / np.tan(np.radians(slope))
+    A = np.column_stack([np.cos(asp), np.sin(asp), np.ones_like(asp)])
+    coef = np.linalg.lstsq(A, y, rcond=None)[0]
+    # Aspect faces downslope, so dh = -tan(slope) * (shift_east * sin + shift_north * cos)
+    return -coef[1], -coef[0], dh.size
+
+
+def nuth_kaab(ref_path, src_path, max_iter=10, tolerance=0.01, max_shift=20.0, max_size=4096,
+              min_slope=3.0, max_slope=70.0):
+    """
+    Shift that aligns the DEM at src_path to the DEM at ref_path.
+    max_iter: maximum number of iterations
+    tolerance: stop when the shift update is smaller than this, in pixels
+    max_shift: largest expected shift, in map units. The DEM to align is read
+               this far beyond the overlap.
+    max_size: largest number of rows or columns to read the overlap at, larger
+              overlaps are read at reduced resolution. None for full resolution.
+    min_slope, max_slope: slopes (degrees) used in the fit
+
+    Returns
+    dict : dx, dy, dz (map units, to add to the DEM to align), iterations,
+           nmad_before, nmad_after
+    """
+    start = time.time()
+    ref_ds = gdal.Open(ref_path)
+    src_ds = gdal.Open(src_path)
+    r_minx, r_miny, r_maxx, r_maxy = dem_bounds(ref_ds)
+    s_minx, s_miny, s_maxx, s_maxy = dem_bounds(src_ds)
+    bounds = (max(r_minx, s_minx), max(r_miny, s_miny), min(r_maxx, s_maxx), min(r_maxy, s_maxy))
+    ref_gt = ref_ds.GetGeoTransform()
+    scale = 1.0
+    if max_size:
+        scale = max(1.0, (bounds[2] - bounds[0]) / ref_gt[1] / max_size,
+                    (bounds[3] - bounds[1]) / abs(ref_gt[5]) / max_size)
+
+    ref, ref_gt = read_bounds(ref_ds, bounds, scale=scale)
+    src_bounds = (bounds[0] - max_shift, bounds[1] - max_shift, bounds[2] + max_shift, bounds[3] + max_shift)
+    src, src_gt = read_bounds(src_ds, src_bounds, scale=scale)
+    pixel = abs(ref_gt[1])
+
+    derivs = derivative_arrays(ref, ['slope', 'aspect'], ref_gt, nodata=np.nan)
+    slope, aspect = derivs['slope'], derivs['aspect']
+
+    dx, dy = 0.0, 0.0
+    dh = sample_shifted(src, src_gt, ref_gt, ref.shape, dx, dy) - ref
+    nmad_before = nmad(dh[~np.isnan(dh)])
+    logger.info('Initial NMAD: {:.3f}'.format(nmad_before))
+    iteration = 0
+    for iteration in range(1, max_iter + 1):
+        step_x, step_y, n = fit_shift(dh, slope, aspect, min_slope=min_slope, max_slope=max_slope)
+        dx += step_x
+        dy += step_y
+        if np.hypot(dx, dy) > max_shift:
+            raise ValueError('Shift of ({:.2f}, {:.2f}) exceeds max_shift {}.'.format(dx, dy, max_shift))
+        dh = sample_shifted(src, src_gt, ref_gt, ref.shape, dx, dy) - ref
+        logger.info('Iteration {}: dx={:.3f} dy={:.3f} NMAD={:.3f} ({} points)'.format(
+            iteration, dx, dy, nmad(dh[~np.isnan(dh)]), n))
+        if np.hypot(step_x, step_y) < tolerance * pixel:
+            break
+
+    valid = ~np.isnan(dh)
+    dz = -np.median(dh[valid])
+    nmad_after = nmad(dh[valid])
+    logger.info('Shift: dx={:.3f} dy={:.3f} dz={:.3f}, NMAD {:.3f} -> {:.3f} ({:.1f}s)'.format(
+        dx, dy, dz, nmad_before, nmad_after, time.time() - start))
+
+    return {'dx': dx, 'dy': dy, 'dz': dz, 'iterations': iteration,
+            'nmad_before': nmad_before, 'nmad_after': nmad_after}
+
+
+def trans_name(dem_path):
+    """
+    Path of the aligned version of a DEM: <name>_trans.tif next to it, which
+    RMSE_sample_pts_batch picks up for the nuth_reg method.
+    """
+    return '{}_trans.tif'.format(os.path.splitext(dem_path)[0])
+
+
+def nuth_kaab_pair(pair_dir, **kwargs):
+    """
+    Align the older DEM of a pair directory to the newer, as pc_align_batch
+    does, and write <older DEM>_trans.tif in the pair directory.
+    kwargs: passed to nuth_kaab
+
+    Returns
+    Tuple: path of aligned DEM, dict of shift and statistics
+    """
+    dem1, dem2 = get_dems(os.path.dirname(pair_dir), os.path.basename(pair_dir))
+    shift = nuth_kaab(dem2, dem1, **kwargs)
+    out_path = apply_translation(dem1, trans_name(dem1), shift['dx'], shift['dy'], shift['dz'])
+
+    return out_path, shift
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('ref_dem', type=os.path.abspath,
+                        help='Reference DEM.')
+    parser.add_argument('src_dem', type=os.path.abspath,
+                        help='DEM to align to the reference.')
+    parser.add_argument('-o', '--out_dem', type=os.path.abspath,
+                        help='Path to write aligned DEM to. Default <src_dem>_trans.tif')
+    parser.add_argument('--max_iter', type=int, default=10,
+                        help='Maximum number of iterations. Default 10.')
+    parser.add_argument('--tolerance', type=float, default=0.01,
+                        help='Stop when the shift update is below this many pixels. Default 0.01.')
+    parser.add_argument('--max_shift', type=float, default=20.0,
+                        help='Largest expected horizontal shift, in map units. Default 20.')
+    parser.add_argument('--max_size', type=int, default=4096,
+                        help='''Largest number of rows or columns to read the overlap at. Larger overlaps
+                        are read at reduced resolution. 0 for full resolution. Default 4096.''')
+
+    args = parser.parse_args()
+
+    shift = nuth_kaab(args.ref_dem, args.src_dem, max_iter=args.max_iter, tolerance=args.tolerance,
+                      max_shift=args.max_shift, max_size=args.max_size)
+    apply_translation(args.src_dem, args.out_dem if args.out_dem else trans_name(args.src_dem),
+                      shift['dx'], shift['dy'], shift['dz'])
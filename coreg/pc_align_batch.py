@@ -9,10 +9,10 @@ Created on Sun Sep 22 13:36:22 2019
 import argparse
 import glob
 import os
-import subprocess
-from subprocess import PIPE, STDOUT
 
 from lib.utils import constrict_pairs
+from executors import Job, QsubExecutor, add_executor_args, get_executor
+from job_manifest import JobManifest, add_manifest_args
 
 
 def get_dems(src_dir, pair_dir):
@@ -24,8 +24,8 @@ def get_dems(src_dir, pair_dir):
     """
     # Abs path to subdirectory
     dems_dir = os.path.join(src_dir, pair_dir)
-    # Get all DEMs in subdir (should be two)
-    dems = glob.glob(dems_dir, '*_dem.tif')
+    # Get all DEMs in subdir (should be two), clipped pairs may be VRTs
+    dems = glob.glob(os.path.join(dems_dir, '*_dem.tif')) + glob.glob(os.path.join(dems_dir, '*_dem.vrt'))
 
     # Identify old and new dems
     # Included index (i) in date to account for the same date  to
@@ -37,12 +37,20 @@ def get_dems(src_dir, pair_dir):
     return dem1, dem2
 
 
-def batch_pc_align(src_dir, dryrun, run_pairs):
+def batch_pc_align(src_dir, dryrun, run_pairs, executor=None, manifest=None):
     """
-    Run ASP pc_align on cluster using qsub.
+    Run ASP pc_align on cluster using qsub, or locally with a LocalExecutor.
     src_dir: directory containing subdirectories of paired DEMs to align.
     dryrun:  flag to specify only printing commands, no job submission
+    run_pairs: text file with one pair per line to run
+    executor: executors.QsubExecutor or executors.LocalExecutor, default qsub
+    manifest: job_manifest.JobManifest, to skip pairs already aligned
+
+    Returns
+    dict : pair -> exit code
     """
+    if executor is None:
+        executor = QsubExecutor(dryrun=dryrun)
     # List subdirectory names
     pairs = os.listdir(src_dir)
     # If a restricted list is supplied, reduce pairs to that list
@@ -52,38 +60,43 @@ def batch_pc_align(src_dir, dryrun, run_pairs):
     for pair_dir in pairs:
         # Abs path to subdirectory
         dems_dir = os.path.join(src_dir, pair_dir)
-        # Get all DEMs in subdir (should be two)
-        dem_pattern = os.path.join(dems_dir, '*_dem.tif')
-        dems = glob.glob(dem_pattern)
-
-        # Identify old and new dems
-        # Included index (i) in date to account for the same date to
-        # prevent overwriting the key
-        # {date_[i]: dem_path}
-        dems_dict = {'{}_{}'.format(os.path.split(x)[1].split('_')[1], i):x for i, x in enumerate(dems)}
-        dem1, dem2 = dems_dict[sorted(dems_dict)[0]], dems_dict[sorted(dems_dict)[1]]
+        # Old and new DEMs in subdir, GTiffs or clipped VRTs
+        dem1, dem2 = get_dems(src_dir, pair_dir)
         # Use this for the prefix as the transformation is being applied to it
         dem1_name = os.path.basename(dem1).split('.')[0][:13]
         prefix = os.path.join(dems_dir, dem1_name)
-        # Build command
-        cmd = 'qsub -v p1="{}",p2="{}",p3="{}" ~/scratch/code/coreg/qsub_pc_align.sh'.format(dem2, dem1, prefix)
-
-        if dryrun:
-            print(cmd)
-        else:
-            p = subprocess.Popen(cmd, shell=True, stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-            output = p.stdout.read()
-            print(output)
-
-        # break
-
-
-def batch_point2dem(src_dir, dryrun):
+        inputs = [dem2, dem1]
+        params = {'max_displacement': 10.0}
+        outputs = ['{}-trans_source.tif'.format(prefix)]
+        if manifest and not manifest.needs_run(pair_dir, 'pc_align', inputs, params, outputs):
+            continue
+        # Build job
+        job = Job(pair_dir,
+                  cmd=['pc_align', '--max-displacement', '10.0', '--save-transformed-source-points',
+                       dem2, dem1, '-o', prefix],
+                  qsub_script='qsub_pc_align.sh',
+                  qsub_args=[dem2, dem1, prefix],
+                  log_path='{}_pc_align.log'.format(prefix))
+        if manifest and not dryrun:
+            manifest.track(job, 'pc_align', inputs, params, outputs)
+        executor.submit(job)
+
+    return executor.wait()
+
+
+def batch_point2dem(src_dir, dryrun, executor=None, manifest=None):
     """
-    Run point2dem in batch on cluster using qsub
+    Run point2dem in batch on cluster using qsub, or locally with a LocalExecutor.
     src_dir: dir holding subdirs of paired
     dryrun: flag to just print commands with no job submission
+    executor: executors.QsubExecutor or executors.LocalExecutor, default qsub
+    manifest: job_manifest.JobManifest, to skip pairs already aligned
+
+    Returns
+    dict : pair -> exit code
     """
+    if executor is None:
+        executor = QsubExecutor(dryrun=dryrun)
     # List subdirectory names
     pairs = os.listdir(src_dir)
 
@@ -102,18 +115,23 @@ def batch_point2dem(src_dir, dryrun):
             trans_source = trans_source_files[0]
             trans_source_name = os.path.basename(trans_source).split('.')[0].split('-trans')[0]
             prefix = os.path.join(dems_dir, trans_source_name)
-            # Build cmd
-            cmd = 'qsub -v p1="{}",p2="{}" ~/scratch/code/coreg/qsub_point2dem.sh'.format(trans_source, prefix)
-
-            if dryrun:
-                print(cmd)
-            else:
-                p = subprocess.Popen(cmd, shell=True, stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-                output = p.stdout.read()
-                print(output)
+            outputs = ['{}-DEM.tif'.format(prefix)]
+            if manifest and not manifest.needs_run(pair_dir, 'point2dem', [trans_source], outputs=outputs):
+                continue
+            # Build job
+            job = Job(pair_dir,
+                      cmd=['point2dem', trans_source, '-o', prefix],
+                      qsub_script='qsub_point2dem.sh',
+                      qsub_args=[trans_source, prefix],
+                      log_path='{}_point2dem.log'.format(prefix))
+            if manifest and not dryrun:
+                manifest.track(job, 'point2dem', [trans_source], outputs=outputs)
+            executor.submit(job)
         else:
             print('No trans_source file found. Skipping: {}'.format(pair_dir))
 
+    return executor.wait()
+
 
 if __name__ == '__main__':
 
@@ -123,18 +141,25 @@ if __name__ == '__main__':
                         help='Path to directory holding pair directories')
     parser.add_argument('tool', type=str,
                         help='ASP tool to run, either "pc_align" or "point2dem"')
+    parser.add_argument('--run_pairs', type=os.path.abspath,
+                        help='Text file with one pair per line to run.')
     parser.add_argument('--dryrun', action='store_true',
                         help='Print qsub commands without submitting')
-    
+    add_executor_args(parser)
+    add_manifest_args(parser)
+
     args = parser.parse_args()
 
     src_dir = args.src_dir
     tool = args.tool
     dryrun = args.dryrun
+    run_pairs = args.run_pairs
+    executor = get_executor(local=args.local, workers=args.workers, retries=args.retries, dryrun=dryrun)
+    manifest = JobManifest(args.manifest) if args.manifest else None
 
     if tool == 'pc_align':
-        batch_pc_align(src_dir, dryrun)
+        batch_pc_align(src_dir, dryrun, run_pairs, executor=executor, manifest=manifest)
     elif tool == 'point2dem':
-        batch_point2dem(src_dir, dryrun)
+        batch_point2dem(src_dir, dryrun, executor=executor, manifest=manifest)
     else:
         print('Unknown tool argument. Must be either: "pc_align" or "point2dem"')
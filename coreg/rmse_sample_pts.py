@@ -3,7 +3,6 @@ import logging
 import numpy as np
 import os
 from osgeo import gdal, osr
-import random
 
 from lib.RasterWrapper import Raster
 
@@ -78,9 +77,58 @@ def calc_rmse(l1, l2):
     return rmse_val
 
 
-def sample_random_points(dem1, dem2, n):
+def pixel_window(raster_obj, projWin):
+    """
+    Pixel window of raster_obj covering projWin [ulx, uly, lrx, lry], clipped to
+    the raster.
+
+    Returns
+    Tuple: xoff, yoff, xsize, ysize
+    """
+    gt = raster_obj.geotransform
+    ulx, uly, lrx, lry = projWin
+    x0 = max(0, int(np.floor((ulx - gt[0]) / gt[1])))
+    y0 = max(0, int(np.floor((uly - gt[3]) / gt[5])))
+    x1 = min(raster_obj.x_sz, int(np.ceil((lrx - gt[0]) / gt[1])))
+    y1 = min(raster_obj.y_sz, int(np.ceil((lry - gt[3]) / gt[5])))
+
+    return x0, y0, max(0, x1 - x0), max(0, y1 - y0)
+
+
+def read_window(raster_obj, projWin):
+    """
+    Read only the part of the first band of raster_obj that covers projWin.
+
+    Returns
+    Tuple: array, pixel window (xoff, yoff, xsize, ysize) it was read from
+    """
+    window = pixel_window(raster_obj, projWin)
+    arr = raster_obj.data_src.GetRasterBand(1).ReadAsArray(*window)
+
+    return arr, window
+
+
+def sample_array(arr, window, geotransform, xs, ys):
+    """
+    Values of arr, read over window of a raster with geotransform, at the map
+    coordinates xs, ys (arrays).
+    """
+    xoff, yoff, xsize, ysize = window
+    px = np.floor((xs - geotransform[0]) / geotransform[1]).astype(np.int64) - xoff
+    py = np.floor((ys - geotransform[3]) / geotransform[5]).astype(np.int64) - yoff
+    px = np.clip(px, 0, xsize - 1)
+    py = np.clip(py, 0, ysize - 1)
+
+    return arr[py, px]
+
+
+def sample_random_points(dem1, dem2, n, batch_size=1000000):
     """
     Generates n random points within projWin [ulx, uly, lrx, lry]
+    Points are drawn in batches as arrays and looked up in the overlapping
+    window of each DEM, dropping points that are NoData or NaN in either,
+    until n are kept.
+    batch_size: int, largest number of candidate points to draw at once
     """
     logger.info('Sampling DEMs at {} points.'.format(n))
     # Get DEM no data values
@@ -97,9 +145,13 @@ def sample_random_points(dem1, dem2, n):
     max_pix_height = min([dem1.pixel_height, dem2.pixel_height])
     max_pix_width = max([dem1.pixel_width, dem2.pixel_width])
     
+    # Read only the overlap of each DEM
+    dem1_arr, dem1_win = read_window(dem1, projWin)
+    dem2_arr, dem2_win = read_window(dem2, projWin)
 
     # Sample random points, storing the points+differences, and sampled values
-    sample_pts_vals = []
+    kept_ys, kept_xs, kept_val1, kept_val2 = [], [], [], []
+    n_kept = 0
     ctr = 0
     max_tries = 10000000
     
@@ -109,26 +161,38 @@ def sample_random_points(dem1, dem2, n):
     logging.info('low x: {}'.format(ulx))
     logging.info('upp x: {}'.format(lrx-max_pix_width))
     
-    while len(sample_pts_vals) < n:
-        pt = (round(random.uniform(lry-max_pix_height, uly),3),
-              round(random.uniform(ulx, lrx-max_pix_width),3))
+    while n_kept < n and ctr < max_tries:
+        # Draw enough candidates to fill the remaining points at the
+        # acceptance rate seen so far
+        accept_rate = n_kept / ctr if ctr else 1.0
+        n_draw = int(np.ceil((n - n_kept) / max(accept_rate, 0.001) * 1.1))
+        n_draw = min(max(n_draw, 1000), batch_size, max_tries - ctr)
+
+        ys = np.round(np.random.uniform(lry-max_pix_height, uly, n_draw), 3)
+        xs = np.round(np.random.uniform(ulx, lrx-max_pix_width, n_draw), 3)
         
-        val1 = dem1.SamplePoint(pt)
-        val2 = dem2.SamplePoint(pt)
+        val1 = sample_array(dem1_arr, dem1_win, dem1.geotransform, xs, ys)
+        val2 = sample_array(dem2_arr, dem2_win, dem2.geotransform, xs, ys)
         
-        if ((val1 != dem1_nodata and val2 != dem2_nodata) and 
-            (not np.isnan(val1) and not np.isnan(val2))):
-            sample_pts_vals.append((pt, val1, val2))
-        else:
-            pass
+        keep = ((val1 != dem1_nodata) & (val2 != dem2_nodata) &
+                ~np.isnan(val1) & ~np.isnan(val2))
+        kept_ys.append(ys[keep])
+        kept_xs.append(xs[keep])
+        kept_val1.append(val1[keep])
+        kept_val2.append(val2[keep])
+        n_kept += np.count_nonzero(keep)
         
-        ctr += 1
-        if ctr % 100000 == 0:
-            logging.info('Sample points tried: {}'.format(ctr))
-            logging.info('Sample points kept : {}'.format(len(sample_pts_vals)))
-        if ctr >= max_tries:
-            logging.debug('Max. sample tries reached: {}'.format(ctr))
-            break
+        ctr += n_draw
+        logging.info('Sample points tried: {}'.format(ctr))
+        logging.info('Sample points kept : {}'.format(n_kept))
+    if ctr >= max_tries:
+        logging.debug('Max. sample tries reached: {}'.format(ctr))
+
+    ys = np.concatenate(kept_ys)[:n]
+    xs = np.concatenate(kept_xs)[:n]
+    val1 = np.concatenate(kept_val1)[:n]
+    val2 = np.concatenate(kept_val2)[:n]
+    sample_pts_vals = list(zip(zip(ys.tolist(), xs.tolist()), val1, val2))
     logger.info('Total points sampled: {}'.format(len(sample_pts_vals)))
     
     return sample_pts_vals
@@ -153,6 +217,283 @@ def dem_RMSE(dem1_p, dem2_p, n):
     return sample_pts_vals, rmse
 
 
+def dem_extent(raster_obj):
+    """
+    Extent of a raster as projWin [ulx, uly, lrx, lry].
+    """
+    ulx, lry, lrx, uly = raster_bounds(raster_obj)
+
+    return [ulx, uly, lrx, lry]
+
+
+def union_bounding_box(raster_objs):
+    """
+    Extent covering all rasters, in the order of bounds specified for
+    gdal.Translate.
+    """
+    extents = np.array([dem_extent(r) for r in raster_objs])
+
+    return [extents[:, 0].min(), extents[:, 1].max(), extents[:, 2].max(), extents[:, 3].min()]
+
+
+def sample_dem(raster_obj, arr, window, xs, ys):
+    """
+    Look up the values of raster_obj at xs, ys from arr, read from it over
+    window with read_window. Points outside the raster, NoData and NaN are
+    returned as NaN.
+    """
+    ulx, uly, lrx, lry = dem_extent(raster_obj)
+    vals = np.full(xs.shape, np.nan, dtype=np.float64)
+    inside = (xs >= ulx) & (xs < lrx) & (ys <= uly) & (ys > lry)
+    if not inside.any():
+        return vals
+    sampled = sample_array(arr, window, raster_obj.geotransform, xs[inside], ys[inside]).astype(np.float64)
+    if raster_obj.nodata_val is not None:
+        sampled[sampled == raster_obj.nodata_val] = np.nan
+    vals[inside] = sampled
+
+    return vals
+
+
+def sample_shared_points(dems, n, overlap='common', oversample=1.2, max_rounds=10, batch_size=1000000):
+    """
+    Sample N DEMs at one shared set of random points. Each DEM is read once,
+    over the sampling extent, and the arrays are kept for every round of
+    drawing, so reads grow linearly with the number of DEMs. All N windows are
+    held in memory at once; with 'pairwise' each window is the whole DEM.
+    dems: list of Raster objects
+    n: int, number of points to keep
+    overlap: 'common' keeps points valid in every DEM, drawn in the common
+             extent. 'pairwise' keeps points valid in at least two DEMs, drawn
+             in the extent covering all DEMs, so each pair is compared over its
+             own overlap.
+    oversample: extra candidates to draw on top of the expected number needed
+    max_rounds: rounds of drawing before giving up on reaching n points
+    batch_size: int, largest number of candidate points to draw in a round,
+                bounding memory to batch_size x number of DEMs values
+
+    Returns
+    Tuple: xs, ys, values array (points x DEMs, NaN where invalid)
+    """
+    if overlap == 'common':
+        projWin = minimum_bounding_box(dems)
+        min_valid = len(dems)
+    elif overlap == 'pairwise':
+        projWin = union_bounding_box(dems)
+        min_valid = 2
+    else:
+        raise ValueError('Unknown overlap: {}'.format(overlap))
+    ulx, uly, lrx, lry = projWin
+    if ulx >= lrx or uly <= lry:
+        raise ValueError('DEMs do not overlap.')
+
+    logger.info('Reading {} DEMs...'.format(len(dems)))
+    windows = [read_window(dem, projWin) for dem in dems]
+
+    logger.info('Sampling {} DEMs at {} shared points.'.format(len(dems), n))
+    kept_xs, kept_ys, kept_vals = [], [], []
+    n_kept = 0
+    ctr = 0
+    for rnd in range(max_rounds):
+        accept_rate = n_kept / float(ctr) if ctr else 1.0
+        n_draw = int(np.ceil((n - n_kept) / max(accept_rate, 0.001) * oversample))
+        n_draw = min(max(n_draw, 1000), batch_size)
+        xs = np.round(np.random.uniform(ulx, lrx, n_draw), 3)
+        ys = np.round(np.random.uniform(lry, uly, n_draw), 3)
+        vals = np.empty((n_draw, len(dems)), dtype=np.float64)
+        for i, (dem, (arr, window)) in enumerate(zip(dems, windows)):
+            vals[:, i] = sample_dem(dem, arr, window, xs, ys)
+        keep = np.count_nonzero(~np.isnan(vals), axis=1) >= min_valid
+        kept_xs.append(xs[keep])
+        kept_ys.append(ys[keep])
+        kept_vals.append(vals[keep])
+        n_kept += np.count_nonzero(keep)
+        ctr += n_draw
+        logger.info('Round {}: sample points tried: {}, kept: {}'.format(rnd + 1, n_draw, n_kept))
+        if n_kept >= n:
+            break
+    if n_kept < n:
+        logger.warning('Only {} of {} valid points found after {} rounds.'.format(n_kept, n, max_rounds))
+
+    return (np.concatenate(kept_xs)[:n], np.concatenate(kept_ys)[:n],
+            np.concatenate(kept_vals)[:n])
+
+
+def rmse_matrix(values):
+    """
+    Pairwise comparison of the columns of values (points x DEMs), each pair
+    over the points valid (not NaN) in both.
+
+    Returns
+    Tuple: RMSE, bias (mean of row DEM - column DEM) and point count matrices
+    """
+    n_dems = values.shape[1]
+    rmse = np.full((n_dems, n_dems), np.nan)
+    bias = np.full((n_dems, n_dems), np.nan)
+    count = np.zeros((n_dems, n_dems), dtype=np.int64)
+    valid = ~np.isnan(values)
+    for i in range(n_dems):
+        rmse[i, i], bias[i, i], count[i, i] = 0.0, 0.0, np.count_nonzero(valid[:, i])
+        for j in range(i + 1, n_dems):
+            both = valid[:, i] & valid[:, j]
+            count[i, j] = count[j, i] = np.count_nonzero(both)
+            if not count[i, j]:
+                continue
+            diffs = values[both, i] - values[both, j]
+            rmse[i, j] = rmse[j, i] = np.sqrt(np.mean(diffs ** 2))
+            bias[i, j] = diffs.mean()
+            bias[j, i] = -bias[i, j]
+
+    return rmse, bias, count
+
+
+def dem_RMSE_matrix(dem_paths, n, overlap='common'):
+    """
+    Calculate the pairwise RMSE and bias of N DEMs from n shared sample points.
+
+    Returns
+    Tuple: xs, ys, sampled values, RMSE, bias and count matrices
+    """
+    dems = [Raster(p) for p in dem_paths]
+    xs, ys, values = sample_shared_points(dems, n, overlap=overlap)
+    rmse, bias, count = rmse_matrix(values)
+
+    return xs, ys, values, rmse, bias, count
+
+
+def grid_overlap(ds1, ds2, tolerance=0.001):
+    """
+    Pixel windows of two gdal datasets covering their common extent. The
+    datasets must share a pixel size and have origins a whole number of
+    pixels apart, so that the windows line up pixel for pixel.
+    tolerance: allowed misalignment, as a fraction of a pixel
+
+    Returns
+    Tuple: window in ds1, window in ds2, each (xoff, yoff, xsize, ysize)
+    """
+    gt1 = ds1.GetGeoTransform()
+    gt2 = ds2.GetGeoTransform()
+    if (abs(gt1[1] - gt2[1]) > tolerance * abs(gt1[1]) or
+            abs(gt1[5] - gt2[5]) > tolerance * abs(gt1[5])):
+        raise ValueError('DEMs have different pixel sizes: {}, {}'.format((gt1[1], gt1[5]), (gt2[1], gt2[5])))
+    shift_x = (gt2[0] - gt1[0]) / gt1[1]
+    shift_y = (gt2[3] - gt1[3]) / gt1[5]
+    if (abs(shift_x - round(shift_x)) > tolerance or
+            abs(shift_y - round(shift_y)) > tolerance):
+        raise ValueError('DEM pixel grids are not aligned, offset of ({:.3f}, {:.3f}) pixels. '
+                         'Resample one DEM to the grid of the other first.'.format(shift_x, shift_y))
+    shift_x, shift_y = int(round(shift_x)), int(round(shift_y))
+
+    # Overlap in ds1 pixel coordinates
+    x0 = max(0, shift_x)
+    y0 = max(0, shift_y)
+    x1 = min(ds1.RasterXSize, shift_x + ds2.RasterXSize)
+    y1 = min(ds1.RasterYSize, shift_y + ds2.RasterYSize)
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError('DEMs do not overlap.')
+
+    return (x0, y0, x1 - x0, y1 - y0), (x0 - shift_x, y0 - shift_y, x1 - x0, y1 - y0)
+
+
+def hist_percentile(counts, centres, q):
+    """
+    q-th percentile (0-100) of values summarised by a histogram.
+    """
+    cum = np.cumsum(counts)
+    idx = np.searchsorted(cum, q / 100.0 * cum[-1])
+
+    return centres[min(idx, len(centres) - 1)]
+
+
+def dem_stats_exact(ds1, ds2, block_size=1024, hist_range=50.0, bin_width=0.01):
+    """
+    Exact statistics of the difference ds1 - ds2 over every pixel where both
+    DEMs are valid, without random sampling. Both DEMs are streamed block by
+    block over their overlap window, accumulating count, sum, sum of squares,
+    min, max and a histogram of differences, so memory does not depend on the
+    size of the DEMs. Median, NMAD and percentiles come from the histogram and
+    are accurate to bin_width.
+    ds1, ds2: osgeo.gdal.Dataset, on aligned pixel grids (see grid_overlap)
+    block_size: int, rows and columns read at a time
+    hist_range: differences are binned between -hist_range and hist_range, values
+                beyond are counted in the outermost bins
+    bin_width: histogram bin width, in elevation units
+
+    Returns
+    dict : count, rmse, bias (mean difference), std, min, max, median, nmad,
+           and percentiles p1, p5, p25, p75, p95, p99
+    """
+    win1, win2 = grid_overlap(ds1, ds2)
+    band1 = ds1.GetRasterBand(1)
+    band2 = ds2.GetRasterBand(1)
+    nodata1 = band1.GetNoDataValue()
+    nodata2 = band2.GetNoDataValue()
+
+    n_bins = int(round(2 * hist_range / bin_width))
+    edges = np.linspace(-hist_range, hist_range, n_bins + 1)
+    counts = np.zeros(n_bins, dtype=np.int64)
+    n_outside = 0
+
+    count = 0
+    total = 0.0
+    total_sq = 0.0
+    diff_min = np.inf
+    diff_max = -np.inf
+
+    _, _, xsize, ysize = win1
+    for yoff in range(0, ysize, block_size):
+        block_y = min(block_size, ysize - yoff)
+        for xoff in range(0, xsize, block_size):
+            block_x = min(block_size, xsize - xoff)
+            arr1 = band1.ReadAsArray(win1[0] + xoff, win1[1] + yoff, block_x, block_y).astype(np.float64)
+            arr2 = band2.ReadAsArray(win2[0] + xoff, win2[1] + yoff, block_x, block_y).astype(np.float64)
+
+            valid = ~np.isnan(arr1) & ~np.isnan(arr2)
+            if nodata1 is not None:
+                valid &= arr1 != nodata1
+            if nodata2 is not None:
+                valid &= arr2 != nodata2
+            diffs = arr1[valid] - arr2[valid]
+            if diffs.size == 0:
+                continue
+
+            count += diffs.size
+            total += diffs.sum()
+            total_sq += np.dot(diffs, diffs)
+            diff_min = min(diff_min, diffs.min())
+            diff_max = max(diff_max, diffs.max())
+            n_outside += np.count_nonzero((diffs < -hist_range) | (diffs > hist_range))
+            counts += np.histogram(np.clip(diffs, -hist_range, hist_range), bins=edges)[0]
+
+    if count == 0:
+        logger.warning('No pixels valid in both DEMs.')
+        return {'count': 0}
+    if n_outside:
+        logger.warning('{} differences outside +/-{}, percentiles may be clipped.'.format(n_outside, hist_range))
+
+    centres = (edges[:-1] + edges[1:]) / 2
+    bias = total / count
+    median = hist_percentile(counts, centres, 50)
+    # Median absolute deviation from the same histogram
+    abs_dev = np.abs(centres - median)
+    order = np.argsort(abs_dev)
+    mad = hist_percentile(counts[order], abs_dev[order], 50)
+
+    stats = {'count': count,
+             'rmse': np.sqrt(total_sq / count),
+             'bias': bias,
+             'std': np.sqrt(max(total_sq / count - bias ** 2, 0.0)),
+             'min': diff_min,
+             'max': diff_max,
+             'median': median,
+             'nmad': 1.4826 * mad}
+    for q in (1, 5, 25, 75, 95, 99):
+        stats['p{}'.format(q)] = hist_percentile(counts, centres, q)
+    logger.info('RMSE: {}'.format(stats['rmse']))
+
+    return stats
+
+
 def write_results(rmse, sample_pts_vals, method, dem1_p, dem2_p):
     """
     Write the calculated RMSE to a text file.
@@ -175,11 +516,83 @@ def write_results(rmse, sample_pts_vals, method, dem1_p, dem2_p):
             opf.write('\n')
 
 
-def main(dem1_p, dem2_p, n, method):
+def write_stats(stats, method, dem1_p):
+    """
+    Write the RMSE and the full set of exact statistics to text files.
+    """
+    parent_dir = os.path.dirname(dem1_p)
+    pair_dir = os.path.split(parent_dir)[1]
+    out_rmse_file = os.path.join(parent_dir, '{}_{}_rmse.txt'.format(pair_dir, method))
+    out_stats_file = os.path.join(parent_dir, '{}_{}_stats.txt'.format(pair_dir, method))
+
+    logger.info('Writing RMSE to text file: {}'.format(out_rmse_file))
+    with open(out_rmse_file, 'w') as of:
+        of.write(str(stats.get('rmse')))
+    logger.info('Writing statistics to text file: {}'.format(out_stats_file))
+    with open(out_stats_file, 'w') as osf:
+        for k, v in stats.items():
+            osf.write('{},{}\n'.format(k, v))
+
+
+def dem_names(dem_paths):
+    return [os.path.splitext(os.path.basename(p))[0] for p in dem_paths]
+
+
+def write_matrix(matrix, names, out_path, fmt='%.6f'):
+    """
+    Write a square matrix as a CSV with the DEM names as header and first column.
+    """
+    with open(out_path, 'w') as of:
+        of.write('dem,{}\n'.format(','.join(names)))
+        for name, row in zip(names, matrix):
+            of.write('{},{}\n'.format(name, ','.join(fmt % v for v in row)))
+
+
+def write_matrix_results(xs, ys, values, rmse, bias, count, dem_paths, method, out_dir=None,
+                         parquet=False):
+    """
+    Write the RMSE, bias and count matrices to CSVs and the sampled values, one
+    column per DEM, to a CSV or, with parquet, a Parquet file (needs pandas and
+    pyarrow or fastparquet).
+    """
+    if out_dir is None:
+        out_dir = os.path.dirname(dem_paths[0])
+    names = dem_names(dem_paths)
+    for label, matrix, fmt in (('rmse', rmse, '%.6f'), ('bias', bias, '%.6f'), ('count', count, '%d')):
+        out_path = os.path.join(out_dir, '{}_{}_matrix.csv'.format(method, label))
+        logger.info('Writing {} matrix: {}'.format(label, out_path))
+        write_matrix(matrix, names, out_path, fmt=fmt)
+
+    if parquet:
+        import pandas as pd
+        out_pts_file = os.path.join(out_dir, '{}_sample_pts.parquet'.format(method))
+        logger.info('Writing sample points to parquet: {}'.format(out_pts_file))
+        df = pd.DataFrame(values, columns=names)
+        df.insert(0, 'x', xs)
+        df.insert(0, 'y', ys)
+        df.to_parquet(out_pts_file, index=False)
+    else:
+        out_pts_file = os.path.join(out_dir, '{}_sample_pts.csv'.format(method))
+        logger.info('Writing sample points to csv: {}'.format(out_pts_file))
+        np.savetxt(out_pts_file, np.column_stack([ys, xs, values]), delimiter=',', fmt='%.3f',
+                   header='y,x,{}'.format(','.join(names)), comments='')
+
+
+def main(dem1_p, dem2_p, n, method, exact=False):
+    if exact:
+        stats = dem_stats_exact(gdal.Open(dem1_p), gdal.Open(dem2_p))
+        write_stats(stats, method, dem1_p)
+        return
     sample_pt_vals, rmse = dem_RMSE(dem1_p, dem2_p, n)
     write_results(rmse, sample_pt_vals, method, dem1_p, dem2_p)
 
 
+def main_matrix(dem_paths, n, method, overlap='common', out_dir=None, parquet=False):
+    xs, ys, values, rmse, bias, count = dem_RMSE_matrix(dem_paths, n, overlap=overlap)
+    write_matrix_results(xs, ys, values, rmse, bias, count, dem_paths, method, out_dir=out_dir,
+                         parquet=parquet)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     
@@ -192,9 +605,29 @@ if __name__ == '__main__':
                         only for file naming''')
     parser.add_argument('-n', type=int, default=1000000,
                         help='Number of points to use in RMSE sample.')
+    parser.add_argument('--exact', action='store_true',
+                        help='''Use every pixel of the overlap instead of sampling points. Also writes
+                        bias, NMAD and percentiles. DEMs must be on aligned pixel grids.''')
+    parser.add_argument('--matrix', action='store_true',
+                        help='''Compare dem1, dem2 and any --dems at one shared set of points and
+                        write pairwise RMSE, bias and count matrices.''')
+    parser.add_argument('--dems', nargs='+', type=os.path.abspath, default=[],
+                        help='Further DEMs to include in the matrix. Implies --matrix.')
+    parser.add_argument('--overlap', choices=['common', 'pairwise'], default='common',
+                        help='''Matrix sampling: common keeps points valid in every DEM, pairwise
+                        keeps points valid in at least two, comparing each pair over its own
+                        overlap. Default common.''')
+    parser.add_argument('--out_dir', type=os.path.abspath,
+                        help='Directory to write matrix outputs to. Default is the directory of dem1.')
+    parser.add_argument('--parquet', action='store_true',
+                        help='Write matrix sample points to Parquet instead of CSV. Needs pandas.')
     
     args = parser.parse_args()
     
-    main(args.dem1_p, args.dem2_p, args.n, args.method)
+    if args.matrix or args.dems:
+        main_matrix([args.dem1_p, args.dem2_p] + args.dems, args.n, args.method, overlap=args.overlap,
+                    out_dir=args.out_dir, parquet=args.parquet)
+    else:
+        main(args.dem1_p, args.dem2_p, args.n, args.method, exact=args.exact)
 
     
\ No newline at end of file
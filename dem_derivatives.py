@@ -7,13 +7,13 @@ GDAL DEM Derivatives
 """
 
 ## Standard Libs
-import logging, os, sys
+import logging, os, sys, time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
 ## Third Party Libs
 import cv2
 from osgeo import gdal
-from scipy.ndimage.filters import generic_filter
 
 ## Local libs
 from misc_utils.RasterWrapper import Raster
@@ -26,7 +26,8 @@ def gdal_dem_derivative(input_dem, output_path, derivative, return_array=False,
     Take an input DEM and create a derivative product
     input_dem: DEM
     derivate: one of "hillshade", "slope", "aspect", "color-relief", "TRI", "TPI", "Roughness"
-    return_array: optional argument to return the computed derivative as an array. (slow IO as it just loads the new file.)
+    return_array: optional argument to return the computed derivative as an array. If
+                  output_path is None the product is only created in /vsimem/.
     Example usage: slope_array = dem_derivative(dem, 'slope', array=True)
     '''
 
@@ -39,43 +40,375 @@ def gdal_dem_derivative(input_dem, output_path, derivative, return_array=False,
 #    out_name = '{}_{}.tif'.format(os.path.basename(input_dem).split('.')[0], derivative)
 #    out_path = os.path.join(os.path.dirname(input_dem), out_name)
 
+    in_mem = output_path is None
+    if in_mem:
+        output_path = '/vsimem/{}_{}.tif'.format(os.path.basename(input_dem).split('.')[0], derivative)
 
-    gdal.DEMProcessing(output_path, input_dem, derivative, *args)
+    out_ds = gdal.DEMProcessing(output_path, input_dem, derivative, *args)
 
     if return_array:
-        from RasterWrapper import Raster
-        array = Raster(output_path).Array
+        # Read from the open dataset rather than reloading the new file
+        array = out_ds.GetRasterBand(1).ReadAsArray()
+        out_ds = None
+        if in_mem:
+            gdal.Unlink(output_path)
 
         return array
 
 
-def calc_tpi(dem, size):
+# Products dem_derivatives_batch can compute, and the data type and NoData
+# value gdaldem writes them with
+BATCH_DERIVATIVES = {'slope': (gdal.GDT_Float32, -9999.0),
+                     'aspect': (gdal.GDT_Float32, -9999.0),
+                     'hillshade': (gdal.GDT_Byte, 0),
+                     'TRI': (gdal.GDT_Float32, -9999.0),
+                     'TPI': (gdal.GDT_Float32, -9999.0),
+                     'Roughness': (gdal.GDT_Float32, -9999.0)}
+
+
+def derivative_arrays(dem, derivatives, geotransform, nodata=None, z_factor=1.0, scale=1.0,
+                      azimuth=315.0, altitude=45.0, out_nodata=None):
+    """
+    Compute several 3x3 derivative products from one DEM array using the same
+    formulas as gdaldem (Horn's method for slope, aspect and hillshade). Cells
+    on the edge of the array, or with a nodata cell in their window, are set to
+    the product's NoData value, as gdaldem does without -compute_edges.
+    dem: array
+    derivatives: list of names from BATCH_DERIVATIVES
+    geotransform: GDAL geotransform of dem, for the pixel sizes
+    nodata: NoData value of dem, or None
+    z_factor, scale, azimuth, altitude: as the gdaldem options of the same names
+    out_nodata: NoData value for every product, default the gdaldem value of each
+
+    Returns
+    dict : {derivative: array}
+    """
+    ewres, nsres = geotransform[1], geotransform[5]
+    dem = dem.astype(np.float64)
+    rows, cols = dem.shape
+
+    # The nine cells of each interior window:  a b c
+    #                                          d e f
+    #                                          g h i
+    a, b, c = dem[:-2, :-2], dem[:-2, 1:-1], dem[:-2, 2:]
+    d, e, f = dem[1:-1, :-2], dem[1:-1, 1:-1], dem[1:-1, 2:]
+    g, h, i = dem[2:, :-2], dem[2:, 1:-1], dem[2:, 2:]
+    win = (a, b, c, d, e, f, g, h, i)
+
+    # Windows without a nodata cell
+    if nodata is None:
+        valid = np.ones(e.shape, dtype=bool)
+    else:
+        invalid = np.isnan(dem) if np.isnan(nodata) else dem == nodata
+        valid = ~(invalid[:-2, :-2] | invalid[:-2, 1:-1] | invalid[:-2, 2:] |
+                  invalid[1:-1, :-2] | invalid[1:-1, 1:-1] | invalid[1:-1, 2:] |
+                  invalid[2:, :-2] | invalid[2:, 1:-1] | invalid[2:, 2:])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Horn gradients, west minus east and south minus north
+        west_east = (a + 2 * d + g) - (c + 2 * f + i)
+        south_north = (g + 2 * h + i) - (a + 2 * b + c)
+
+        products = {}
+        for derivative in derivatives:
+            if derivative == 'slope':
+                dx = west_east / ewres
+                dy = south_north / nsres
+                out = np.degrees(np.arctan(np.sqrt(dx * dx + dy * dy) / (8 * scale)))
+            elif derivative == 'aspect':
+                out = np.degrees(np.arctan2(south_north, west_east))
+                out = np.where(out > 90.0, 450.0 - out, 90.0 - out)
+                out = np.where(out == 360.0, 0.0, out)
+                # Flat cells have no aspect
+                out[(west_east == 0) & (south_north == 0)] = np.nan
+            elif derivative == 'hillshade':
+                z_scaled = z_factor / (8 * scale)
+                x = west_east / ewres
+                y = south_north / nsres
+                az = np.radians(azimuth)
+                alt = np.radians(altitude)
+                cang = ((np.sin(alt) - (y * np.cos(az) - x * np.sin(az)) * np.cos(alt) * z_scaled) /
+                        np.sqrt(1 + z_scaled * z_scaled * (x * x + y * y)))
+                out = np.where(cang <= 0.0, 1.0, 1.0 + 254.0 * cang)
+            elif derivative == 'TRI':
+                out = sum(np.abs(n - e) for n in win) / 8.0
+            elif derivative == 'TPI':
+                out = e - (sum(win) - e) / 8.0
+            elif derivative == 'Roughness':
+                out = np.maximum.reduce(win) - np.minimum.reduce(win)
+            else:
+                raise ValueError('Unsupported derivative type: {}. Must be one of: {}'.format(
+                    derivative, list(BATCH_DERIVATIVES)))
+
+            dtype, product_nodata = BATCH_DERIVATIVES[derivative]
+            if out_nodata is not None:
+                product_nodata = out_nodata
+            full = np.full((rows, cols), product_nodata, dtype=np.float64)
+            full[1:-1, 1:-1] = np.where(valid & ~np.isnan(out), out, product_nodata)
+            products[derivative] = full
+
+    return products
+
+
+def dem_derivatives_batch(input_dem, derivatives, out_dir=None, stack_path=None, return_arrays=False,
+                          block_rows=512, **kwargs):
+    """
+    Compute several derivative products from a DEM while decoding each block of
+    the DEM only once. Rows are read in strips (with a one row halo), every
+    requested product is computed from the strip by derivative_arrays, and each
+    is written out before the next strip is read.
+    input_dem: path to DEM
+    derivatives: list of "slope", "aspect", "hillshade", "TRI", "TPI", "Roughness"
+    out_dir: directory to write one GTiff per product to, named
+             <dem name>_<derivative>.tif
+    stack_path: path to write a single Float32 GTiff with one band per product
+                instead, in the order given (NoData -9999 for every band)
+    return_arrays: True to return the products as arrays. If neither out_dir nor
+                   stack_path is given, the products only exist in /vsimem/.
+    block_rows: number of rows to process at a time
+    kwargs: z_factor, scale, azimuth, altitude passed to derivative_arrays
+
+    Returns
+    dict : {derivative: output path}, or {derivative: array} if return_arrays
+    """
+    unsupported = [d for d in derivatives if d not in BATCH_DERIVATIVES]
+    if unsupported:
+        logging.error('Unsupported derivative type(s): {}. Must be one of: {}'.format(
+            unsupported, list(BATCH_DERIVATIVES)))
+        sys.exit()
+
+    dem = gdal.Open(input_dem)
+    dem_band = dem.GetRasterBand(1)
+    nodata = dem_band.GetNoDataValue()
+    gt = dem.GetGeoTransform()
+    x_sz, y_sz = dem.RasterXSize, dem.RasterYSize
+    dem_name = os.path.basename(input_dem).split('.')[0]
+
+    in_mem = out_dir is None and stack_path is None
+    if in_mem:
+        if not return_arrays:
+            out_dir = os.path.dirname(input_dem)
+        else:
+            out_dir = '/vsimem/'
+
+    driver = gdal.GetDriverByName('GTiff')
+    options = ['TILED=YES', 'BIGTIFF=IF_SAFER']
+    out_nodata = None
+    if stack_path:
+        # One band per product, in a common data type and NoData value
+        out_nodata = -9999.0
+        stack_ds = driver.Create(stack_path, x_sz, y_sz, len(derivatives), gdal.GDT_Float32, options=options)
+        stack_ds.SetGeoTransform(gt)
+        stack_ds.SetProjection(dem.GetProjection())
+        out_bands = {}
+        for band_num, derivative in enumerate(derivatives, start=1):
+            band = stack_ds.GetRasterBand(band_num)
+            band.SetNoDataValue(out_nodata)
+            band.SetDescription(derivative)
+            out_bands[derivative] = band
+        out_paths = {derivative: stack_path for derivative in derivatives}
+        out_datasets = [stack_ds]
+    else:
+        out_bands = {}
+        out_paths = {}
+        out_datasets = []
+        for derivative in derivatives:
+            dtype, product_nodata = BATCH_DERIVATIVES[derivative]
+            out_path = os.path.join(out_dir, '{}_{}.tif'.format(dem_name, derivative))
+            out_ds = driver.Create(out_path, x_sz, y_sz, 1, dtype, options=options)
+            out_ds.SetGeoTransform(gt)
+            out_ds.SetProjection(dem.GetProjection())
+            out_ds.GetRasterBand(1).SetNoDataValue(product_nodata)
+            out_bands[derivative] = out_ds.GetRasterBand(1)
+            out_paths[derivative] = out_path
+            out_datasets.append(out_ds)
+
+    for yoff in range(0, y_sz, block_rows):
+        ysize = min(block_rows, y_sz - yoff)
+        # Read the strip with a row of halo above and below where there is one
+        read_y0 = max(0, yoff - 1)
+        read_y1 = min(y_sz, yoff + ysize + 1)
+        strip = dem_band.ReadAsArray(0, read_y0, x_sz, read_y1 - read_y0)
+        products = derivative_arrays(strip, derivatives, gt, nodata=nodata, out_nodata=out_nodata, **kwargs)
+        # Drop the halo rows
+        core = np.s_[yoff - read_y0:yoff - read_y0 + ysize]
+        for derivative, array in products.items():
+            out_bands[derivative].WriteArray(array[core], 0, yoff)
+
+    if return_arrays:
+        arrays = {derivative: out_bands[derivative].ReadAsArray() for derivative in derivatives}
+        out_bands = None
+        out_datasets = None
+        if in_mem:
+            for out_path in set(out_paths.values()):
+                gdal.Unlink(out_path)
+
+        return arrays
+
+    out_bands = None
+    out_datasets = None
+
+    return out_paths
+
+
+def filter_strips(func, array, halo, n_jobs):
+    """
+    Apply a moving window function to an array in horizontal strips across a
+    pool of threads (OpenCV releases the GIL). Each strip is padded with halo
+    rows of its neighbours and its core is written straight into a shared output
+    array, so the result matches func(array). The output takes the dtype of
+    func's result on the first strip, so it does not depend on n_jobs.
+    func: function taking and returning a 2D array of the same shape
+    array: 2D array
+    halo: int, rows of padding needed by func on each side of a strip
+    n_jobs: int, number of threads
+
+    Returns
+    array
+    """
+    rows = array.shape[0]
+    bounds = np.linspace(0, rows, min(rows, n_jobs * 4) + 1).astype(int)
+    strips = list(zip(bounds[:-1], bounds[1:]))
+
+    def filter_strip(strip):
+        y0, y1 = strip
+        read_y0 = max(0, y0 - halo)
+        read_y1 = min(rows, y1 + halo)
+        return func(array[read_y0:read_y1])[y0 - read_y0:y1 - read_y0]
+
+    start = time.time()
+    first = filter_strip(strips[0])
+    out = np.empty(array.shape, dtype=first.dtype)
+    out[strips[0][0]:strips[0][1]] = first
+
+    def run_strip(strip):
+        out[strip[0]:strip[1]] = filter_strip(strip)
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        list(executor.map(run_strip, strips[1:]))
+    elapsed = time.time() - start
+    if elapsed > 0:
+        logging.info('Filtered {} pixels using {} threads: {:.0f} pixels/s'.format(
+            array.size, n_jobs, array.size / elapsed))
+
+    return out
+
+
+def box_mean(dem, size):
+    """
+    Mean of the size x size window around each cell, with the outermost rows
+    and columns replicated past the edges (cv2.BORDER_REPLICATE).
+    dem: array
+    size: int, kernel size in x and y directions (square kernel)
+    """
+    kernel = np.ones((size,size),np.float32)/(size*size)
+    # -1 indicates new output array
+    return cv2.filter2D(dem, -1, kernel, borderType=cv2.BORDER_REPLICATE)
+
+
+def valid_mask(dem, nodata):
+    """
+    Boolean array, True where dem is not nodata (or NaN if nodata is NaN).
+    """
+    if nodata is None or np.isnan(nodata):
+        return ~np.isnan(dem)
+    return dem != nodata
+
+
+def masked_box_mean(dem, size, valid, dtype=np.float32):
+    """
+    Normalized convolution: mean of the valid cells of each size x size window.
+    The data with nodata set to zero and the validity mask are box filtered the
+    same way and divided, so nodata never enters a neighbourhood mean.
+    dem: array
+    size: int, kernel size in x and y directions (square kernel)
+    valid: boolean array, True for cells to include
+    dtype: dtype of the filter buffers
+
+    Returns
+    Tuple: mean array (NaN where a window holds no valid cells), fraction of the
+           window that is valid
+    """
+    data_sum = box_mean(np.where(valid, dem, 0).astype(dtype), size)
+    valid_frac = box_mean(valid.astype(dtype), size)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(valid_frac > 0, data_sum / valid_frac, np.nan)
+
+    return mean, valid_frac
+
+
+def calc_tpi(dem, size, n_jobs=1, nodata=None):
     """
     OpenCV implementation of TPI
     dem: array
     size: int, kernel size in x and y directions (square kernel)
+    n_jobs: int, number of threads to split the array across, None for all cores
+    nodata: optional NoData value of dem. If given, the neighbourhood mean is a
+            normalized convolution over valid cells only, so voids do not need
+            filling first; nodata cells stay nodata in the output.
     Note - borderType determines handline of edge cases. REPLICATE will take the outermost row and columns and extend
     them as far as is needed for the given kernel size.
     """
-    kernel = np.ones((size,size),np.float32)/(size*size)
-    # -1 indicates new output array
-    dem_conv = cv2.filter2D(dem, -1, kernel, borderType=cv2.BORDER_REPLICATE)
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+    if n_jobs > 1:
+        return filter_strips(lambda strip: calc_tpi(strip, size, nodata=nodata), dem, size, n_jobs)
+
+    if nodata is not None:
+        valid = valid_mask(dem, nodata)
+        dem_conv, _ = masked_box_mean(dem, size, valid)
+        tpi = np.where(valid, dem - dem_conv, nodata).astype(np.float32)
+
+        return tpi
+
+    dem_conv = box_mean(dem, size)
     tpi = dem - dem_conv
 
     return tpi
 
 
-def calc_tpi_dev(dem, size):
+def calc_tpi_dev(dem, size, n_jobs=1, nodata=None):
     """
     Based on (De Reu 2013)
     Calculates the tpi/standard deviation of the kernel to account for surface roughness.
+    The standard deviation comes from running sums of x and x^2 over the same
+    box filter as calc_tpi, so it costs one extra filter pass.
     dem: array
     size: int, kernel size in x and y directions (square kernel)
+    n_jobs: int, number of threads to split the array across, None for all cores
+    nodata: optional NoData value of dem, nodata cells are left out of the
+            window mean and standard deviation (see calc_tpi)
     """
-    tpi = calc_tpi(dem, size)
-    # Calculate the standard deviation of each cell, mode='nearest' == cv2.BORDER_REPLICATE
-    std_array = generic_filter(dem, np.std, size=size, mode='nearest')
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+    if n_jobs > 1:
+        return filter_strips(lambda strip: calc_tpi_dev(strip, size, nodata=nodata), dem, size, n_jobs)
+
+    if nodata is not None:
+        valid = valid_mask(dem, nodata)
+        offset = dem[valid].mean(dtype=np.float64) if valid.any() else 0.0
+        dem_c = np.where(valid, dem.astype(np.float64) - offset, 0.0)
+        dem_conv, _ = masked_box_mean(dem_c, size, valid, dtype=np.float64)
+        mean_sq, _ = masked_box_mean(dem_c * dem_c, size, valid, dtype=np.float64)
+        var_array = mean_sq - dem_conv * dem_conv
+        std_array = np.sqrt(np.maximum(var_array, 0.0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tpi_dev = np.where(valid & (std_array > 0), (dem_c - dem_conv) / std_array, nodata)
+
+        return tpi_dev.astype(np.float32)
+
+    # Work in float64 about the mean elevation so x^2 does not lose precision.
+    # The mean skips NaN cells so they only blank the windows they fall in.
+    finite = np.isfinite(dem)
+    offset = dem[finite].mean(dtype=np.float64) if finite.any() else 0.0
+    dem_c = dem.astype(np.float64) - offset
+    dem_conv = box_mean(dem_c, size)
+    tpi = dem_c - dem_conv
+    # Standard deviation of each window: sqrt(E[x^2] - E[x]^2), border replicated
+    # as generic_filter(mode='nearest')
+    var_array = box_mean(dem_c * dem_c, size) - dem_conv * dem_conv
+    std_array = np.sqrt(np.maximum(var_array, 0.0))
 
     tpi_dev = tpi / std_array
 
-    return tpi_dev
+    return tpi_dev.astype(np.result_type(dem.dtype, np.float32))
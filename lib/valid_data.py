@@ -5,14 +5,19 @@ Created on Wed Nov 13 12:46:20 2019
 @author: disbr007
 """
 
+import argparse
+import csv
+import glob
 import os
 import logging
+import uuid
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
 import numpy as np
+from tqdm import tqdm
 
 from osgeo import gdal, ogr, osr
 
-from clip2shp_bounds import warp_rasters
-
 
 #### Logging setup
 # create logger
@@ -34,57 +39,269 @@ logger.addHandler(ch)
 
 #logger.debug('Log file created at: {}'.format(log))
 
+gdal.UseExceptions()
+ogr.UseExceptions()
+
+
+def block_windows(rb, window=None):
+    """
+    Pixel windows covering a raster band, one per natural block of the band
+    (a tile or a strip), so reads line up with how the raster is stored.
+    rb      (osgeo.gdal.Band):    raster band
+    window  (tuple)          :    (xoff, yoff, xsize, ysize) to cover only
+                                  this part of the band, blocks are clipped
+                                  to it
+
+    Yields
+    Tuple:  xoff, yoff, xsize, ysize
+    """
+    block_x, block_y = rb.GetBlockSize()
+    win_x, win_y, win_xsize, win_ysize = window if window else (0, 0, rb.XSize, rb.YSize)
+    x_end, y_end = win_x + win_xsize, win_y + win_ysize
+    for yoff in range(win_y - win_y % block_y, y_end, block_y):
+        y0 = max(yoff, win_y)
+        y1 = min(yoff + block_y, y_end)
+        for xoff in range(win_x - win_x % block_x, x_end, block_x):
+            x0 = max(xoff, win_x)
+            yield x0, y0, min(xoff + block_x, x_end) - x0, y1 - y0
+
+
+def valid_mask(arr, no_data_val):
+    """
+    Boolean array, True where arr is not NoData and not NaN.
+    """
+    if no_data_val is None:
+        mask = np.ones(arr.shape, dtype=bool)
+    elif np.isnan(no_data_val):
+        mask = ~np.isnan(arr)
+    else:
+        mask = arr != no_data_val
+    if arr.dtype.kind == 'f':
+        mask &= ~np.isnan(arr)
+
+    return mask
+
+
+def create_mask_raster(out_path, gdal_ds, rb):
+    """
+    Create a 1-bit GTiff on the grid of gdal_ds to hold a valid data mask,
+    tiled like the source band when the source is tiled.
+    """
+    block_x, block_y = rb.GetBlockSize()
+    options = ['NBITS=1', 'COMPRESS=LZW']
+    if block_x < gdal_ds.RasterXSize and block_x % 16 == 0 and block_y % 16 == 0:
+        options += ['TILED=YES', 'BLOCKXSIZE={}'.format(block_x), 'BLOCKYSIZE={}'.format(block_y)]
+    driver = gdal.GetDriverByName('GTiff')
+    dst_ds = driver.Create(out_path, gdal_ds.RasterXSize, gdal_ds.RasterYSize, 1, gdal.GDT_Byte,
+                           options=options)
+    dst_ds.SetGeoTransform(gdal_ds.GetGeoTransform())
+    dst_ds.SetProjection(gdal_ds.GetProjectionRef())
+
+    return dst_ds
+
+
+def binomial_error(valid, n, total, z=3.0):
+    """
+    Error bound, in pixels of a raster of total pixels, of a valid fraction
+    estimated from n sampled pixels.
+    """
+    p = valid / float(n)
+
+    return float(z * np.sqrt(p * (1 - p) / n) * total)
+
+
+def overview_valid_data(rb, min_pixels=65536):
+    """
+    Count valid pixels in the coarsest overview of rb with at least
+    min_pixels pixels. Uses the overview of the band's mask band when the
+    mask is an internal mask or alpha band, otherwise applies NoData to the
+    overview of the band.
+
+    Returns
+    Tuple:  Count of valid pixels, count of pixels in the overview, or None
+            if rb has no overviews
+    """
+    flags = rb.GetMaskFlags()
+    use_mask = not flags & (gdal.GMF_NODATA | gdal.GMF_ALL_VALID)
+    src = rb.GetMaskBand() if use_mask else rb
+    if src.GetOverviewCount() == 0:
+        return None
+    overviews = [src.GetOverview(i) for i in range(src.GetOverviewCount())]
+    overviews = sorted(overviews, key=lambda o: o.XSize * o.YSize)
+    large = [o for o in overviews if o.XSize * o.YSize >= min_pixels]
+    ovr = large[0] if large else overviews[-1]
+
+    valid = 0
+    no_data_val = None if use_mask else rb.GetNoDataValue()
+    for xoff, yoff, xsize, ysize in block_windows(ovr):
+        arr = ovr.ReadAsArray(xoff, yoff, xsize, ysize)
+        if use_mask:
+            valid += int(np.count_nonzero(arr))
+        else:
+            valid += int(np.count_nonzero(valid_mask(arr, no_data_val)))
 
-def valid_data(gdal_ds, band_number=1, write_valid=False, out_path=None):
+    return valid, ovr.XSize * ovr.YSize
+
+
+def strided_valid_data(rb, max_blocks=64, z=3.0):
+    """
+    Count valid pixels in an evenly spaced subset of at most max_blocks of the
+    band's blocks and scale up to the whole band.
+
+    Returns
+    Tuple:  Estimated count of valid pixels, error bound (pixels)
+    """
+    windows = list(block_windows(rb))
+    stride = max(1, int(np.ceil(len(windows) / float(max_blocks))))
+    sample = windows[stride // 2::stride]
+    no_data_val = rb.GetNoDataValue()
+    valid = np.array([np.count_nonzero(valid_mask(rb.ReadAsArray(*w), no_data_val)) for w in sample],
+                     dtype=np.float64)
+    pixels = np.array([w[2] * w[3] for w in sample], dtype=np.float64)
+    total = rb.XSize * rb.YSize
+    p = valid.sum() / pixels.sum()
+    k = len(sample)
+    if k == len(windows):
+        error = 0.0
+    elif k < 2:
+        error = float(total)
+    else:
+        # Ratio estimator standard error, with finite population correction
+        resid = valid - p * pixels
+        se = np.sqrt((resid ** 2).sum() / (k * (k - 1))) / pixels.mean()
+        error = z * se * np.sqrt(1 - k / float(len(windows))) * total
+
+    return int(round(p * total)), float(min(error, total))
+
+
+def estimate_valid_data(gdal_ds, band_number=1, max_pixels=4194304, min_overview_pixels=65536,
+                        max_blocks=64):
+    """
+    Estimate the number of valid pixels without reading the full resolution
+    band, for screening. The cheapest available source is used:
+        - mask flags, when an integer band has no NoData or mask (all valid).
+          Float bands may still hold NaN, so are not taken as all valid.
+        - STATISTICS_VALID_PERCENT metadata, written when exact statistics
+          are computed. Approximate statistics are not used.
+        - overviews, of the mask band or the band
+        - an evenly spaced subset of the band's blocks
+    Rasters of at most max_pixels pixels are counted exactly.
+    gdal_ds             (osgeo.gdal.Dataset): osgeo.gdal.Dataset
+    band_number         (int)               : Band to count valid pixels in
+    max_pixels          (int)               : Largest raster to count exactly
+    min_overview_pixels (int)               : Smallest overview to use
+    max_blocks          (int)               : Blocks to read when subsampling
+
+    Returns
+    Tuple:  Estimated count of valid pixels, count of total pixels, error
+            bound of the estimate (pixels)
+    """
+    rb = gdal_ds.GetRasterBand(band_number)
+    total_pixels = gdal_ds.RasterXSize * gdal_ds.RasterYSize
+
+    is_float = gdal.GetDataTypeName(rb.DataType).startswith(('Float', 'CFloat'))
+    if rb.GetMaskFlags() & gdal.GMF_ALL_VALID and not is_float:
+        logger.debug('All pixels valid per mask flags.')
+        return total_pixels, total_pixels, 0.0
+
+    valid_percent = rb.GetMetadataItem('STATISTICS_VALID_PERCENT')
+    if valid_percent is not None and rb.GetMetadataItem('STATISTICS_APPROXIMATE') != 'YES':
+        logger.debug('Valid pixels from STATISTICS_VALID_PERCENT: {}'.format(valid_percent))
+        valid = int(round(float(valid_percent) / 100 * total_pixels))
+        # Percent is written with limited precision
+        return valid, total_pixels, 0.0005 * total_pixels
+
+    if total_pixels <= max_pixels:
+        valid, total = valid_data(gdal_ds, band_number=band_number)
+        return valid, total, 0.0
+
+    ovr_counts = overview_valid_data(rb, min_pixels=min_overview_pixels)
+    if ovr_counts is not None:
+        ovr_valid, ovr_total = ovr_counts
+        logger.debug('Valid pixels from overview: {} of {}'.format(ovr_valid, ovr_total))
+        valid = int(round(ovr_valid / float(ovr_total) * total_pixels))
+        return valid, total_pixels, binomial_error(ovr_valid, ovr_total, total_pixels)
+
+    logger.debug('Estimating valid pixels from a subset of blocks.')
+    valid, error = strided_valid_data(rb, max_blocks=max_blocks)
+
+    return valid, total_pixels, error
+
+
+def valid_data(gdal_ds, band_number=1, write_valid=False, out_path=None, estimate=False):
     """
     Takes a gdal datasource and determines the number of
     valid pixels in it. Optionally, writing out the valid
-    data as a binary raster.
+    data as a binary raster. The band is read one block
+    at a time, so memory use does not depend on raster size.
     gdal_ds      (osgeo.gdal.Dataset):    osgeo.gdal.Dataset
+    band_number  (int)               :    Band to count valid pixels in
     write_valid  (boolean)           :    True to write binary raster, 
                                           must supply out_path
     out_path     (str)               :    Path to write binary raster
+    estimate     (boolean)           :    True to estimate the count from
+                                          metadata, overviews or a subset of
+                                          blocks, see estimate_valid_data
 
     Writes 
-    (Optional) Valid data mask as raster
+    (Optional) Valid data mask as 1-bit raster, 1 = valid
 
     Returns
     Tuple:  Count of valid pixels, count of total pixels
     """
+    if estimate is True:
+        if write_valid is True:
+            raise ValueError('Cannot write valid data mask when estimating.')
+        valid_pixels, total_pixels, error = estimate_valid_data(gdal_ds, band_number=band_number)
+        logger.debug('Estimated valid pixels: {} +/- {:.0f}'.format(valid_pixels, error))
+        return valid_pixels, total_pixels
+
     # Get raster band
     rb = gdal_ds.GetRasterBand(band_number)
     no_data_val = rb.GetNoDataValue()
-    arr = rb.ReadAsArray()
-    # Create mask showing only valid data as 1's
-    mask = np.where(arr!=no_data_val, 1, 0)
-    # Count number of valid
-    valid_pixels = len(mask[mask==1])
-    total_pixels = mask.size
-    
-    # Write mask if desired
+    total_pixels = gdal_ds.RasterXSize * gdal_ds.RasterYSize
+
+    dst_band = None
     if write_valid is True:
-        if len(mask.shape) == 2:
-            rows, cols = mask.shape
-            depth = 1
-        else:
-            rows, cols, depth = mask.shape
-        driver = gdal.GetDriverByName('GTiff')
-        
-        dst_ds = driver.Create(out_path, ds.RasterXSize, ds.RasterYSize, 1, rb.DataType)
-        dst_ds.SetGeoTransform(ds.GetGeoTransform())
-        out_prj = osr.SpatialReference()
-        out_prj.ImportFromWkt(ds.GetProjectionRef())
-        dst_ds.SetProjection(out_prj.ExportToWkt())
-        for i in range(depth):
-            b = i+1
-            dst_ds.GetRasterBand(b).WriteArray(mask)
-            dst_ds.GetRasterBand(b).SetNoDataValue(no_data_val)
+        if out_path is None:
+            raise ValueError('out_path must be supplied to write valid data mask.')
+        dst_ds = create_mask_raster(out_path, gdal_ds, rb)
+        dst_band = dst_ds.GetRasterBand(1)
+
+    valid_pixels = 0
+    for xoff, yoff, xsize, ysize in block_windows(rb):
+        mask = valid_mask(rb.ReadAsArray(xoff, yoff, xsize, ysize), no_data_val)
+        valid_pixels += int(np.count_nonzero(mask))
+        if dst_band is not None:
+            dst_band.WriteArray(mask.astype(np.uint8), xoff, yoff)
+
+    if dst_band is not None:
+        dst_band = None
         dst_ds = None
 
     return valid_pixels, total_pixels
 
 
-def rasterize_shp2raster_extent(ogr_ds, gdal_ds, write_rasterized=False, out_path=None):
+def layer_window(ogr_lyr, gdal_ds):
+    """
+    Pixel window of gdal_ds covering the extent of ogr_lyr, clipped to the
+    raster. Sizes are 0 if they do not intersect.
+
+    Returns
+    Tuple:  xoff, yoff, xsize, ysize
+    """
+    gt = gdal_ds.GetGeoTransform()
+    minx, maxx, miny, maxy = ogr_lyr.GetExtent()
+    x0 = max(0, int(np.floor((minx - gt[0]) / gt[1])))
+    y0 = max(0, int(np.floor((maxy - gt[3]) / gt[5])))
+    x1 = min(gdal_ds.RasterXSize, int(np.ceil((maxx - gt[0]) / gt[1])))
+    y1 = min(gdal_ds.RasterYSize, int(np.ceil((miny - gt[3]) / gt[5])))
+
+    return x0, y0, max(0, x1 - x0), max(0, y1 - y0)
+
+
+def rasterize_shp2raster_extent(ogr_ds, gdal_ds, write_rasterized=False, out_path=None,
+                                burn_field=None, window=False):
     """
     Rasterize a ogr datasource to the extent, projection, resolution of a given
     gdal datasource object. Optionally write out the rasterized product.
@@ -92,16 +309,22 @@ def rasterize_shp2raster_extent(ogr_ds, gdal_ds, write_rasterized=False, out_pat
     gdal_ds          :    osgeo.gdal.Dataset
     write_rasterised :    True to write rasterized product, must provide out_path
     out_path         :    Path to write rasterized product
+    burn_field       :    Integer field of ogr_ds to burn instead of 1, into
+                          a UInt32 raster with 0 outside features
+    window           :    True to rasterize only the pixel window of gdal_ds
+                          covering the extent of ogr_ds, into a Byte raster
+                          (UInt32 with burn_field)
     
     Writes
     Rasterized dataset to file.
 
     Returns
-    osgeo.gdal.Dataset
+    osgeo.gdal.Dataset, in /vsimem/, to be removed with gdal.Unlink when done
     or
     None
+    With window, a tuple of that and the window (xoff, yoff, xsize, ysize) of
+    gdal_ds it covers. The dataset is None if the window is empty.
     """
-    # TODO: Add ability to provide field in ogr_ds to use to burn into raster.
     ## Get DEM attributes
     dem_no_data_val = gdal_ds.GetRasterBand(1).GetNoDataValue()
     dem_sr = gdal_ds.GetProjection()
@@ -110,31 +333,308 @@ def rasterize_shp2raster_extent(ogr_ds, gdal_ds, write_rasterized=False, out_pat
     y_max = dem_gt[3]
     x_res = dem_gt[1]
     y_res = dem_gt[5]
-    x_sz = ds.RasterXSize
-    y_sz = ds.RasterYSize
+    x_sz = gdal_ds.RasterXSize
+    y_sz = gdal_ds.RasterYSize
     x_max = x_min + x_res * x_sz
     y_min = y_max + y_res * y_sz
     
     ## Open shapefile
     ogr_lyr = ogr_ds.GetLayer()
     
-    # Create new raster in memory
+    if window:
+        win = layer_window(ogr_lyr, gdal_ds)
+        if win[2] == 0 or win[3] == 0:
+            return None, win
+        x_min = x_min + win[0] * x_res
+        y_max = y_max + win[1] * y_res
+        x_sz, y_sz = win[2], win[3]
+    
+    # Create new raster in memory, with a unique name so calls from
+    # several threads do not share a file
     if write_rasterized is False:
-        out_path = r'/vsimem/rasterized.tif'
-        if os.path.exists(out_path):
-            os.remove(out_path)
+        out_path = r'/vsimem/rasterized_{}.tif'.format(uuid.uuid4().hex)
+    elif out_path is None:
+        raise ValueError('out_path must be supplied to write rasterized product.')
     driver = gdal.GetDriverByName('GTiff')
     
-    out_ds = driver.Create(mem_p, x_sz, y_sz, 1, gdal.GDT_Float32)
-    out_ds.SetGeoTransform((x_min, x_res, 0, y_min, 0, -y_res))
+    if burn_field:
+        out_type = gdal.GDT_UInt32
+    elif window:
+        out_type = gdal.GDT_Byte
+    else:
+        out_type = gdal.GDT_Float32
+    out_ds = driver.Create(out_path, x_sz, y_sz, 1, out_type)
+    out_ds.SetGeoTransform((x_min, x_res, 0, y_max, 0, y_res))
     out_ds.SetProjection(dem_sr)
 #    band = out_ds.GetRasterBand(1)
 #    band.SetNoDataValue(dem_no_data_val) # fix to get no_data_val before(?) clipping rasters
 #    band.FlushCache()
     
-    gdal.RasterizeLayer(out_ds, [1], ogr_lyr, burn_values=[1])    
+    if burn_field:
+        gdal.RasterizeLayer(out_ds, [1], ogr_lyr, options=['ATTRIBUTE={}'.format(burn_field)])
+    else:
+        gdal.RasterizeLayer(out_ds, [1], ogr_lyr, burn_values=[1])    
     
     if write_rasterized is False:
-        return out_ds
+        return (out_ds, win) if window else out_ds
     else:
         out_ds = None
+        return (None, win) if window else None
+
+
+def aoi_coverage(gdal_ds, ogr_ds, band_number=1):
+    """
+    Count the valid pixels of gdal_ds inside the features of ogr_ds, which
+    must be in the same projection. Only the window of gdal_ds covering the
+    features is rasterized and read, one block at a time.
+    gdal_ds      (osgeo.gdal.Dataset):    osgeo.gdal.Dataset
+    ogr_ds       (osgeo.ogr.DataSource):  AOI polygons
+
+    Returns
+    Tuple:  Count of valid pixels in AOI, count of total pixels in AOI
+    """
+    aoi_ds, win = rasterize_shp2raster_extent(ogr_ds, gdal_ds, window=True)
+    if aoi_ds is None:
+        return 0, 0
+    aoi_path = aoi_ds.GetDescription()
+    aoi_band = aoi_ds.GetRasterBand(1)
+    rb = gdal_ds.GetRasterBand(band_number)
+    no_data_val = rb.GetNoDataValue()
+
+    aoi_valid, aoi_total = 0, 0
+    for xoff, yoff, xsize, ysize in block_windows(rb, window=win):
+        in_aoi = aoi_band.ReadAsArray(xoff - win[0], yoff - win[1], xsize, ysize) != 0
+        mask = valid_mask(rb.ReadAsArray(xoff, yoff, xsize, ysize), no_data_val)
+        aoi_valid += int(np.count_nonzero(mask & in_aoi))
+        aoi_total += int(np.count_nonzero(in_aoi))
+
+    aoi_band = None
+    aoi_ds = None
+    gdal.Unlink(aoi_path)
+
+    return aoi_valid, aoi_total
+
+
+FEATURE_INDEX_FIELD = 'feature_index'
+
+
+def index_layer(ogr_ds, id_field=None):
+    """
+    Copy the features of ogr_ds to an in-memory layer with a dense index,
+    1..k, in an integer field, FEATURE_INDEX_FIELD, to burn into a raster (0
+    is left for pixels outside every feature). Features sharing an ID share
+    an index. The raster and any bincount over it then depend on the number
+    of features rather than on the size of their IDs.
+    ogr_ds       (osgeo.ogr.DataSource):  AOI polygons
+    id_field     (str)               :    Integer field identifying features.
+                                          Default FID + 1.
+
+    Returns
+    Tuple:  osgeo.ogr.DataSource, list of feature IDs where item i is the ID
+            of index i + 1
+    """
+    src_lyr = ogr_ds.GetLayer()
+    if id_field is not None:
+        defn = src_lyr.GetLayerDefn()
+        field_idx = defn.GetFieldIndex(id_field)
+        if field_idx < 0:
+            raise ValueError('Field not found in AOI layer: {}'.format(id_field))
+        if defn.GetFieldDefn(field_idx).GetType() not in (ogr.OFTInteger, ogr.OFTInteger64):
+            raise ValueError('Feature ID field must be an integer field: {}'.format(id_field))
+
+    mem_ds = ogr.GetDriverByName('Memory').CreateDataSource('feature_index')
+    mem_lyr = mem_ds.CreateLayer('feature_index', srs=src_lyr.GetSpatialRef(),
+                                 geom_type=src_lyr.GetGeomType())
+    mem_lyr.CreateField(ogr.FieldDefn(FEATURE_INDEX_FIELD, ogr.OFTInteger))
+    indices = {}
+    for feat in src_lyr:
+        if id_field is None:
+            feature_id = feat.GetFID() + 1
+        elif feat.IsFieldNull(id_field):
+            raise ValueError('Feature {} has no {}.'.format(feat.GetFID(), id_field))
+        else:
+            feature_id = feat.GetFieldAsInteger64(id_field)
+        index = indices.setdefault(feature_id, len(indices) + 1)
+        out_feat = ogr.Feature(mem_lyr.GetLayerDefn())
+        out_feat.SetGeometry(feat.GetGeometryRef())
+        out_feat.SetField(FEATURE_INDEX_FIELD, index)
+        mem_lyr.CreateFeature(out_feat)
+    src_lyr.ResetReading()
+    ids = sorted(indices, key=indices.get)
+
+    return mem_ds, ids
+
+
+def feature_coverage(gdal_ds, ogr_ds, id_field=None, band_number=1):
+    """
+    Count the valid and total pixels of gdal_ds inside each feature of ogr_ds,
+    with one rasterization of a dense feature index and one bincount per block.
+    Where features overlap, pixels count towards the feature burned last.
+    gdal_ds      (osgeo.gdal.Dataset):    osgeo.gdal.Dataset
+    ogr_ds       (osgeo.ogr.DataSource):  AOI polygons, same projection
+    id_field     (str)               :    Integer field identifying features.
+                                          Default FID + 1.
+
+    Returns
+    dict : {feature id: (count of valid pixels, count of total pixels)}
+    """
+    index_ds, ids = index_layer(ogr_ds, id_field=id_field)
+    n_bins = len(ids) + 1
+
+    valid = np.zeros(n_bins, dtype=np.int64)
+    total = np.zeros(n_bins, dtype=np.int64)
+    id_ds, win = rasterize_shp2raster_extent(index_ds, gdal_ds, burn_field=FEATURE_INDEX_FIELD, window=True)
+    if id_ds is None:
+        return {i: (0, 0) for i in ids}
+    id_path = id_ds.GetDescription()
+    id_band = id_ds.GetRasterBand(1)
+    rb = gdal_ds.GetRasterBand(band_number)
+    no_data_val = rb.GetNoDataValue()
+
+    for xoff, yoff, xsize, ysize in block_windows(rb, window=win):
+        id_arr = id_band.ReadAsArray(xoff - win[0], yoff - win[1], xsize, ysize).astype(np.int64)
+        mask = valid_mask(rb.ReadAsArray(xoff, yoff, xsize, ysize), no_data_val)
+        total += np.bincount(id_arr.ravel(), minlength=n_bins)
+        valid += np.bincount(id_arr[mask], minlength=n_bins)
+
+    id_band = None
+    id_ds = None
+    gdal.Unlink(id_path)
+
+    return {i: (int(valid[k + 1]), int(total[k + 1])) for k, i in enumerate(ids)}
+
+
+def percent(count, total):
+    return round(100.0 * count / total, 3) if total else None
+
+
+def screen_raster(raster_p, band_number=1, estimate=False, aoi_p=None, per_feature=False,
+                  id_field=None):
+    """
+    Coverage of one raster, as rows of the screening report: one for the
+    raster and, with per_feature, one for each AOI feature. Errors are
+    recorded in the row rather than raised, so one bad file does not stop a
+    batch.
+    """
+    row = {'path': raster_p}
+    rows = [row]
+    try:
+        gdal_ds = gdal.Open(raster_p)
+        valid, total = valid_data(gdal_ds, band_number=band_number, estimate=estimate)
+        row.update({'valid': valid, 'total': total, 'valid_pct': percent(valid, total)})
+        if aoi_p:
+            ogr_ds = ogr.Open(aoi_p)
+            if per_feature:
+                # Features do not share pixels in the ID raster, so they sum to the AOI
+                coverage = feature_coverage(gdal_ds, ogr_ds, id_field=id_field, band_number=band_number)
+                aoi_valid = sum(c[0] for c in coverage.values())
+                aoi_total = sum(c[1] for c in coverage.values())
+                for feature, (f_valid, f_total) in sorted(coverage.items()):
+                    rows.append({'path': raster_p, 'feature': feature, 'aoi_valid': f_valid,
+                                 'aoi_total': f_total, 'aoi_valid_pct': percent(f_valid, f_total)})
+            else:
+                aoi_valid, aoi_total = aoi_coverage(gdal_ds, ogr_ds, band_number=band_number)
+            row.update({'aoi_valid': aoi_valid, 'aoi_total': aoi_total,
+                        'aoi_valid_pct': percent(aoi_valid, aoi_total)})
+            ogr_ds = None
+        gdal_ds = None
+    except Exception as e:
+        logger.error('Error screening {}: {}'.format(raster_p, e))
+        row['error'] = str(e)
+
+    return rows
+
+
+def _screen_raster(args):
+    return screen_raster(*args)
+
+
+def raster_paths(inputs, ext='.tif'):
+    """
+    Rasters to screen from a list of directories (searched for ext), text
+    files listing one raster per line, and rasters.
+    """
+    paths = []
+    for i in inputs:
+        if os.path.isdir(i):
+            paths.extend(sorted(glob.glob(os.path.join(i, '*{}'.format(ext)))))
+        elif i.endswith('.txt'):
+            with open(i, 'r') as src:
+                paths.extend(l.strip() for l in src if l.strip())
+        else:
+            paths.append(i)
+
+    return paths
+
+
+def screen_rasters(raster_ps, band_number=1, estimate=False, aoi_p=None, per_feature=False,
+                   id_field=None, n_jobs=4, processes=False):
+    """
+    Screen the coverage of many rasters in parallel. GDAL releases the GIL
+    while reading, so threads are used by default.
+    processes    (boolean)           :    True to use processes instead
+
+    Returns
+    list : report rows, in the order of raster_ps
+    """
+    pool_type = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    tasks = [(r, band_number, estimate, aoi_p, per_feature, id_field) for r in raster_ps]
+    with pool_type(max_workers=n_jobs) as pool:
+        rows = [row for raster_rows in tqdm(pool.map(_screen_raster, tasks), total=len(tasks))
+                for row in raster_rows]
+
+    return rows
+
+
+REPORT_FIELDS = ['path', 'feature', 'valid', 'total', 'valid_pct', 'aoi_valid', 'aoi_total', 'aoi_valid_pct', 'error']
+
+
+def write_report(rows, out_path):
+    """
+    Write screening report rows to a CSV, or to Parquet (needs pandas) if
+    out_path ends with .parquet.
+    """
+    fields = [f for f in REPORT_FIELDS if any(f in r for r in rows)]
+    if out_path.endswith('.parquet'):
+        import pandas as pd
+        pd.DataFrame(rows, columns=fields).to_parquet(out_path, index=False)
+    else:
+        with open(out_path, 'w', newline='') as dst:
+            writer = csv.DictWriter(dst, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(rows)
+    logger.info('Report written to: {}'.format(out_path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('inputs', nargs='+',
+                        help='Directories of rasters, text files listing rasters, or rasters.')
+    parser.add_argument('-o', '--out_report', type=os.path.abspath, required=True,
+                        help='Path to write report to, .csv or .parquet.')
+    parser.add_argument('--ext', type=str, default='.tif',
+                        help='Extension of rasters to screen in directories. Default .tif')
+    parser.add_argument('--aoi', type=os.path.abspath,
+                        help='Shapefile of AOI polygons to also report coverage within.')
+    parser.add_argument('--per_feature', action='store_true',
+                        help='Also report coverage within each AOI feature, one row per feature.')
+    parser.add_argument('--id_field', type=str,
+                        help='Integer field identifying AOI features. Default FID + 1.')
+    parser.add_argument('-b', '--band', type=int, default=1,
+                        help='Band to count valid pixels in. Default 1.')
+    parser.add_argument('--estimate', action='store_true',
+                        help='Estimate valid pixels from metadata, overviews or a subset of blocks.')
+    parser.add_argument('-j', '--n_jobs', type=int, default=4,
+                        help='Number of rasters to screen at once. Default 4.')
+    parser.add_argument('--processes', action='store_true',
+                        help='Use processes instead of threads.')
+
+    args = parser.parse_args()
+
+    raster_ps = raster_paths(args.inputs, ext=args.ext)
+    logger.info('Screening {} rasters...'.format(len(raster_ps)))
+    rows = screen_rasters(raster_ps, band_number=args.band, estimate=args.estimate, aoi_p=args.aoi,
+                          per_feature=args.per_feature, id_field=args.id_field, n_jobs=args.n_jobs,
+                          processes=args.processes)
+    write_report(rows, args.out_report)